@@ -0,0 +1,280 @@
+import logging
+import multiprocessing
+import queue
+import time
+from multiprocessing.shared_memory import SharedMemory
+from threading import Thread
+
+import numpy as np
+import serial
+
+from commands import CommandQueue, CommandWriter
+from framing import FrameLayout, FrameParser
+from instrumentation import metrics, SnapshotExporter
+from parsing import RowParser, ROW_LENGTH
+from recording import Recorder
+from ringbuffer import RingBuffer
+from sources import createSource, isPtyUrl, isSourceUrl, openSource, startPtyFeeder, PTY_PREFIX
+from timing import SampleClock
+
+DEFAULT_PORT = "/dev/rfcomm3"
+# seconds write() waits for room in the command queue of the process before queue.Full
+COMMAND_TIMEOUT = 0.1
+
+# the serial settings of the firmware
+SERIAL_SETTINGS = dict(baudrate=115200,
+                       bytesize=serial.EIGHTBITS,
+                       parity=serial.PARITY_NONE,
+                       stopbits=serial.STOPBITS_ONE,
+                       xonxoff=0,
+                       rtscts=0)
+
+def openSerial(port=DEFAULT_PORT, timeout=1):
+    """
+    Opens the serial link to the motor controller with the settings of the firmware.
+    port is a device path, a pySerial URL (loop://, socket://host:port, ...), a
+    synthetic:// or replay:// source URL, see sources.openSource, or such a source URL
+    behind pty+ (pty+synthetic://?rate=1000), which feeds the source into a pseudo
+    terminal and opens its slave side as a real serial device.
+    """
+    if isPtyUrl(port):
+        path, stop = startPtyFeeder(createSource(port[len(PTY_PREFIX):]))
+        try:
+            return PtySerial(stop, path, timeout=timeout, **SERIAL_SETTINGS)
+        except serial.SerialException:
+            stop()
+            raise
+    if isSourceUrl(port):
+        return openSource(port, timeout=timeout)
+    return serial.serial_for_url(port, timeout=timeout, **SERIAL_SETTINGS)
+
+
+class PtySerial(serial.Serial):
+    """
+    Serial port on the slave side of a pty fed by a source, closing it stops the feeder
+    """
+    def __init__(self, stop, *args, **kwargs):
+        self.stopFeeder = stop
+        super().__init__(*args, **kwargs)
+
+    def close(self):
+        super().close()
+        if self.stopFeeder is not None:
+            stop, self.stopFeeder = self.stopFeeder, None
+            stop()
+
+
+class SharedRingBuffer(RingBuffer):
+    """
+    RingBuffer that lives in a multiprocessing.shared_memory block, so a reader in another
+    process maps the rows zero-copy. The block starts with a small int64 header holding the
+    write cursor, the capacity and the number of columns; the read cursor stays local to
+    the reading process.
+    """
+    HEADER_FIELDS = 4
+    HEADER_BYTES = HEADER_FIELDS * 8
+
+    def __init__(self, capacity, columns, name=None, create=True):
+        size = self.HEADER_BYTES + capacity * columns * 8
+        if create:
+            self.shm = SharedMemory(name=name, create=True, size=size)
+        else:
+            # a spawned child shares the resource tracker of its parent, the owner unlinks
+            self.shm = SharedMemory(name=name)
+        self.owner = create
+        self.header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        self.buffer = np.ndarray((capacity, columns), dtype=np.float64,
+                                 buffer=self.shm.buf, offset=self.HEADER_BYTES)
+        self.capacity = capacity
+        self.columns = columns
+        self.read_cursor = 0
+        self.overruns = 0
+        if create:
+            self.header[:] = (0, capacity, columns, 0)
+            self.buffer[:] = 0
+        else:
+            self.read_cursor = self.write_cursor
+
+    @staticmethod
+    def attach(name):
+        """
+        Map an existing ring by name, its size is taken from the header.
+        """
+        shm = SharedMemory(name=name)
+        capacity, columns = (int(value) for value in np.ndarray((3,), dtype=np.int64, buffer=shm.buf)[1:3])
+        shm.close()
+        return SharedRingBuffer(capacity, columns, name=name, create=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def write_cursor(self):
+        return int(self.header[0])
+
+    @write_cursor.setter
+    def write_cursor(self, value):
+        self.header[0] = value
+
+    def close(self):
+        """
+        Drop the mapping; the owner also removes the block.
+        """
+        del self.header
+        del self.buffer
+        try:
+            self.shm.close()
+        except BufferError:
+            # views handed out to this process are still alive, the mapping goes with them
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def forwardCommands(commandPipe, commands, halt):
+    """
+    Moves command batches (lists of bytes) from the inter-process queue to the local
+    CommandQueue of the writer.
+    """
+    while not halt.is_set():
+        try:
+            payloads = commandPipe.get(True, 0.1)
+        except queue.Empty:
+            continue
+        commands.putBatch(payloads)
+
+
+def handleControl(control, recorder):
+    """
+    Apply the control messages from the GUI: ('record', prefix, metadata) or ('stop',).
+    """
+    while True:
+        try:
+            message = control.get_nowait()
+        except queue.Empty:
+            return
+        if message[0] == 'record':
+            recorder.start(message[1], message[2])
+        elif message[0] == 'stop':
+            recorder.stop()
+
+
+def runAcquisition(ringName, port, protocol, layout, commandPipe, control, halt, metricsTarget=None):
+    """
+    Body of the acquisition process: reads the port in bulk, parses and pushes the rows
+    into the shared ring and the recorder, while a writer thread sends the commands coming
+    from the GUI. The process has metrics of its own, exported to metricsTarget if given.
+    Recorded rows get the times of a SampleClock, one per row like on the thread path.
+    """
+    ring = SharedRingBuffer.attach(ringName)
+    recorder = Recorder(ring.columns)
+    serialConnection = openSerial(port, timeout=0.1)
+    parser = FrameParser(layout) if protocol == 'binary' else RowParser(columns=ring.columns)
+    clock = SampleClock()
+    metrics.source = 'acquisition'
+    metrics.enabled = metricsTarget is not None
+    metrics.gauge('rows', lambda: ring.write_cursor)
+    metrics.gauge('lines_parsed', lambda: parser.accepted)
+    metrics.gauge('lines_rejected', lambda: parser.rejected)
+    metrics.gauge('recorder_dropped_rows', lambda: recorder.dropped_rows)
+    exporter = SnapshotExporter(metrics, metricsTarget).start() if metricsTarget is not None else None
+    commands = CommandQueue()
+    threads = [Thread(target=forwardCommands, args=(commandPipe, commands, halt)),
+               Thread(target=CommandWriter(commands), args=(serialConnection, halt.is_set))]
+    for thread in threads:
+        thread.start()
+    try:
+        while not halt.is_set():
+            handleControl(control, recorder)
+            chunk = serialConnection.read(max(1, serialConnection.in_waiting))
+            stamp = time.monotonic()
+            metrics.count('bytes_read', len(chunk))
+            block = parser.feed(chunk)
+            if block.shape[0] > 0:
+                ring.push_rows(block)
+                recorder.record(block, clock.wall(clock.stamp(block.shape[0], stamp)))
+    finally:
+        halt.set()
+        for thread in threads:
+            thread.join()
+        if exporter is not None:
+            exporter.stop()
+        recorder.stop()
+        serialConnection.close()
+        ring.close()
+        logging.info('Acquisition process halted')
+
+
+class AcquisitionEngine:
+    """
+    Runs the serial reader and parser in a separate process, so a busy GUI can never stall
+    the port. Rows are written to a SharedRingBuffer that the GUI maps zero-copy; commands
+    travel the other way through a multiprocessing queue. The ring holds `capacity` rows,
+    which is how long the GUI may be frozen before rows are overwritten unread.
+    Exposes write/writeBatch like ThreadMessage, so SerialCommandProducer can use it.
+    With a metrics_target the process exports its own metric snapshots (source
+    'acquisition'), see instrumentation.SnapshotExporter.
+    """
+    def __init__(self, port=DEFAULT_PORT, capacity=1 << 16, columns=ROW_LENGTH, protocol='csv', layout=None,
+                 metrics_target=None):
+        self.port = port
+        self.metrics_target = metrics_target
+        self.capacity = capacity
+        self.columns = columns
+        self.protocol = protocol
+        self.layout = layout if layout is not None else FrameLayout()
+        self.context = multiprocessing.get_context('spawn')
+        self.ring = None
+        self.process = None
+
+    def start(self):
+        self.ring = SharedRingBuffer(self.capacity, self.columns)
+        self.commands = self.context.Queue(maxsize=64)
+        self.control = self.context.Queue()
+        self.halt = self.context.Event()
+        self.process = self.context.Process(target=runAcquisition, name='acquisition',
+                                            args=(self.ring.name, self.port, self.protocol, self.layout,
+                                                  self.commands, self.control, self.halt, self.metrics_target))
+        self.process.start()
+        return self.ring
+
+    def isAlive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def write(self, message, timeout=COMMAND_TIMEOUT):
+        """
+        Enqueue a single command, raises queue.Full when the queue stays full past timeout
+        like CommandQueue.put.
+        """
+        self.commands.put([message], True, timeout)
+
+    def writeBatch(self, messages, expectResponse=False, timeout=COMMAND_TIMEOUT):
+        """
+        Responses stay in the acquisition process, so nothing can wait for them here.
+        Raises queue.Full when the queue stays full past timeout.
+        """
+        self.commands.put(list(messages), True, timeout)
+
+    def startRecording(self, prefix, metadata=None):
+        self.control.put(('record', prefix, metadata))
+
+    def stopRecording(self):
+        self.control.put(('stop',))
+
+    def stop(self, timeout=5):
+        """
+        Ask the process to halt, wait for it and release the shared memory.
+        """
+        if self.process is None:
+            return
+        self.halt.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.warning('Acquisition process did not halt, terminating it')
+            self.process.terminate()
+            self.process.join()
+        self.commands.close()
+        self.control.close()
+        self.ring.close()
+        self.process = None
@@ -0,0 +1,66 @@
+"""
+Throughput benchmark of the per-line parsing path against the bulk RowParser.
+
+    python benchmarks/bench_parsing.py [rows] [chunk_size]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parsing import RowParser, parseLine, ROW_LENGTH
+
+
+def generateLines(rows, malformed=0.01, seed=0):
+    """
+    Returns a bytes object of CSV rows similar to the telemetry, with a fraction of broken lines.
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.integers(-2048, 4096, size=(rows, ROW_LENGTH))
+    lines = [",".join(str(value) for value in row) for row in values]
+    for index in rng.choice(rows, int(rows * malformed), replace=False):
+        lines[index] = lines[index][:len(lines[index]) // 2]
+    return ("\r\n".join(lines) + "\r\n").encode('ASCII')
+
+
+def perLine(data):
+    rows = 0
+    for line in data.splitlines(keepends=True):
+        valid, row = parseLine(line)
+        if valid:
+            rows += 1
+    return rows
+
+
+def bulk(data, chunk_size):
+    parser = RowParser()
+    rows = 0
+    for offset in range(0, len(data), chunk_size):
+        rows += parser.feed(data[offset:offset + chunk_size]).shape[0]
+    return rows
+
+
+def measure(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    data = generateLines(rows)
+
+    line_rows, line_time = measure(perLine, data)
+    bulk_rows, bulk_time = measure(bulk, data, chunk_size)
+    assert line_rows == bulk_rows, (line_rows, bulk_rows)
+
+    print("rows: {0}, chunk size: {1} bytes".format(line_rows, chunk_size))
+    print("per-line: {0:12.0f} rows/s".format(line_rows / line_time))
+    print("bulk:     {0:12.0f} rows/s ({1:.1f}x)".format(bulk_rows / bulk_time, line_time / bulk_time))
@@ -0,0 +1,56 @@
+"""
+Frames per second and ms per frame of FigureCompositor.draw, full redraw against blitting.
+Builds the regular window, so it needs a display.
+
+    python benchmarks/bench_render.py [frames]
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import register_screen
+from pipeline import Data
+from transforms import ChannelBlock
+
+
+def syntheticWindows(frames, size=(300, 18), step=30, seed=0):
+    """
+    Yields (cursor, window) pairs of a sliding window that advances `step` rows per frame.
+    """
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(1000, 3000, size=(size[0] + frames * step, size[1])).astype(np.float64)
+    # the figures show derived channels, rows carry them behind the raw columns
+    data = Data(size=raw.shape, history=1, prefix="bench.")
+    data.push_block(raw)
+    history, names = data.snapshot()[1], data.names()
+    for frame in range(frames):
+        cursor = size[0] + frame * step
+        yield cursor, ChannelBlock(history[cursor - size[0]:cursor], register_screen.channels, names)
+
+
+def measure(blit, frames):
+    results = {}
+    for key, figure in register_screen.figures.items():
+        figure.blit = blit
+        figure.lines = []
+        figure.background = None
+        figure.cursor = None
+        figure.frame_times.clear()
+        for cursor, window in syntheticWindows(frames):
+            figure.draw(window, cursor)
+            register_screen.root.update_idletasks()
+        results[key] = figure.frameStats()
+    return results
+
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    register_screen.root.update()
+    full = measure(False, frames)
+    blit = measure(True, frames)
+    print("{0:24} {1:>18} {2:>18}".format("figure", "full [ms / fps]", "blit [ms / fps]"))
+    for key in full:
+        print("{0:24} {1:8.2f} / {2:7.1f} {3:8.2f} / {4:7.1f}".format(key, *full[key], *blit[key]))
+    register_screen.root.destroy()
@@ -0,0 +1,55 @@
+"""
+Aggregate throughput of the DeviceManager with 1..N synthetic devices at a fixed rate
+each: rows/s acquired by all devices together against the offered rate, and the CPU time
+the process spent per second.
+
+    python benchmarks/devices.py [--rate 20000] [--devices 1 2 4 8 16] [--workers 1] [--duration 2]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from devices import DeviceManager
+
+
+def measure(count, rate, workers, duration):
+    """
+    Returns (rows/s, CPU seconds per second) of `count` devices acquired for `duration` seconds
+    """
+    manager = DeviceManager(workers=workers)
+    for index in range(count):
+        manager.add("device{0}".format(index), "synthetic://?rate={0}&seed={1}".format(rate, index))
+    manager.start()
+    # let the workers open their ports before counting
+    time.sleep(0.2)
+    rows = manager.rows()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - start
+    acquired = manager.rows() - rows
+    busy = time.process_time() - cpu
+    manager.stop()
+    return acquired / elapsed, busy / elapsed
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description="Multi-device acquisition throughput")
+    arguments.add_argument('--rate', type=float, default=20000, help="rows/s of every device")
+    arguments.add_argument('--devices', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    arguments.add_argument('--workers', type=int, default=1)
+    arguments.add_argument('--duration', type=float, default=2.0)
+    options = arguments.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    single = None
+    for count in options.devices:
+        throughput, cpu = measure(count, options.rate, options.workers, options.duration)
+        single = single or throughput / count
+        print("devices {0:3d}  rows/s {1:10.0f}  offered {2:10.0f}  scaling {3:5.2f}  cpu {4:4.0%}".format(
+            count, throughput, count * options.rate, throughput / single, cpu))
@@ -0,0 +1,89 @@
+"""
+Startup time of the headless and the GUI mode, every run in a fresh interpreter:
+import time, time to the first sample from a synthetic source and whether tkinter or
+matplotlib got imported. The GUI mode needs a display and is skipped without one.
+
+    python benchmarks/startup.py [--repeat 5] [--port "synthetic://?rate=150"]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEADLESS = """
+import sys, time, json
+start = time.perf_counter()
+from cli import Session
+imported = time.perf_counter()
+session = Session(port=PORT)
+waited = session.waitForRows(1)
+first = time.perf_counter()
+session.close()
+print(json.dumps({"import": imported - start, "first_sample": None if waited is None else first - start,
+                  "tkinter": "tkinter" in sys.modules, "matplotlib": "matplotlib" in sys.modules}))
+"""
+
+GUI = """
+import sys, time, json
+start = time.perf_counter()
+import register_screen
+from threading import Thread
+imported = time.perf_counter()
+register_screen.buildGui()
+built = time.perf_counter()
+consumer = register_screen.SerialCommandConsumer(bulk=True, port=PORT)
+thread = Thread(target=consumer, args=(register_screen.threadMessage,))
+thread.start()
+while register_screen.threadMessage.data.ring.write_cursor < 1 and time.perf_counter() - built < 10:
+    register_screen.root.update()
+first = time.perf_counter()
+register_screen.threadMessage.halt_thread = True
+thread.join()
+register_screen.root.destroy()
+print(json.dumps({"import": imported - start, "build": built - imported, "first_sample": first - start,
+                  "tkinter": True, "matplotlib": True}))
+"""
+
+
+def measure(code, port):
+    """
+    Run `code` in a fresh interpreter, returns its JSON result plus the total wall time
+    including the interpreter start, or None when it failed.
+    """
+    import time
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", code.replace("PORT", repr(port))],
+                               cwd=ROOT, capture_output=True, text=True)
+    total = time.perf_counter() - start
+    if completed.returncode != 0:
+        return None, completed.stderr.strip().splitlines()[-1:]
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process"] = total
+    return result, None
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description="Startup time of headless and GUI mode")
+    arguments.add_argument('--repeat', type=int, default=5)
+    arguments.add_argument('--port', default="synthetic://?rate=150")
+    options = arguments.parse_args()
+
+    for mode, code in (("headless", HEADLESS), ("gui", GUI)):
+        results = []
+        for _ in range(options.repeat):
+            result, error = measure(code, options.port)
+            if result is None:
+                print("{0:9} skipped: {1}".format(mode, " ".join(error)))
+                break
+            results.append(result)
+        if not results:
+            continue
+        best = {key: min(result[key] for result in results if result[key] is not None)
+                for key in results[0] if not isinstance(results[0][key], bool)
+                and any(result[key] is not None for result in results)}
+        print("{0:9} ".format(mode) + "  ".join("{0} {1:7.1f} ms".format(key, 1000 * value)
+                                                for key, value in best.items())
+              + "  tkinter {0}  matplotlib {1}".format(results[0]["tkinter"], results[0]["matplotlib"]))
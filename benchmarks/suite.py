@@ -0,0 +1,339 @@
+"""
+Headless benchmark suite of the acquisition and display pipeline.
+
+    python benchmarks/suite.py [--quick] [--output results.json]
+                               [--baseline benchmarks/baseline.json] [--update-baseline]
+                               [--tolerance 0.25] [--repeat 3]
+
+Every result is a record {"name", "params", "value", "unit", "better", "spread"}; the
+suite runs --repeat times, value is the median of the runs and spread their range
+relative to it. The full run is written as JSON. With a baseline, results that are worse
+than the baseline by more than the tolerance are reported as regressions and the exit code
+is 1; a benchmark that scatters more than that between runs (here or in the baseline) is
+allowed NOISE times its spread instead. The stored baseline is machine specific,
+regenerate it on the reference machine with --update-baseline.
+
+FigureCompositor and DisplayCompositor are measured off-screen (Agg canvas, no Tk window),
+so the whole suite runs without a display.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from threading import Thread
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from filtering import Filter, FilterBank
+from ringbuffer import RingBuffer
+from sources import SyntheticSource, SourcePort
+from parsing import RowParser, parseLine
+from pipeline import Data, SerialCommandConsumer, ThreadMessage
+from transforms import ChannelBlock
+
+# allowed regression in multiples of the spread of a noisy benchmark
+NOISE = 1.5
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def result(name, params, value, unit, better):
+    return {"name": name, "params": params, "value": float(value), "unit": unit, "better": better}
+
+
+def best(fn, repeat=3):
+    """
+    Smallest wall time of `repeat` calls of fn.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchParsing(quick):
+    rows = 5000 if quick else 50000
+    results = []
+    for columns in (6, 18, 36):
+        rng = np.random.default_rng(columns)
+        values = rng.integers(-2048, 4096, size=(rows, columns))
+        data = ("\r\n".join(",".join(str(value) for value in row) for row in values) + "\r\n").encode()
+        elapsed = best(lambda: [parseLine(line, columns) for line in data.splitlines(keepends=True)])
+        results.append(result("parse_per_line", {"columns": columns}, rows / elapsed, "rows/s", "higher"))
+        for chunk_size in (1024, 16384):
+            def run():
+                parser = RowParser(columns)
+                for offset in range(0, len(data), chunk_size):
+                    parser.feed(data[offset:offset + chunk_size])
+            elapsed = best(run)
+            results.append(result("parse_bulk", {"columns": columns, "chunk": chunk_size},
+                                  rows / elapsed, "rows/s", "higher"))
+    return results
+
+
+def benchPush(quick):
+    rows = 20000 if quick else 200000
+    results = []
+    for columns in (6, 18, 36):
+        block = np.random.default_rng(0).random((rows, columns))
+        ring = RingBuffer(4096, columns)
+        elapsed = best(lambda: [ring.push_row(row) for row in block[:rows // 10]])
+        results.append(result("push_row", {"columns": columns}, 1e6 * elapsed / (rows // 10), "us/row", "lower"))
+        for size in (10, 100, 1000):
+            elapsed = best(lambda: [ring.push_rows(block[offset:offset + size])
+                                    for offset in range(0, rows, size)])
+            results.append(result("push_rows", {"columns": columns, "block": size},
+                                  1e6 * elapsed / rows, "us/row", "lower"))
+    threadMessage = ThreadMessage()
+    block = np.random.default_rng(0).random((rows // 10, 18))
+    elapsed = best(lambda: [threadMessage.writeBuffer(row) for row in block])
+    results.append(result("thread_message_write_buffer", {}, 1e6 * elapsed / block.shape[0], "us/row", "lower"))
+    elapsed = best(lambda: [threadMessage.writeBlock(block[offset:offset + 100])
+                            for offset in range(0, block.shape[0], 100)])
+    results.append(result("thread_message_write_block", {"block": 100}, 1e6 * elapsed / block.shape[0],
+                          "us/row", "lower"))
+    results += benchReadline(quick)
+    return results
+
+
+def benchReadline(quick):
+    """
+    The line by line acquisition path: CSV lines read with readline, parsed and pushed by
+    SerialCommandConsumer.readLines, with and without batching of the rows.
+    """
+    rows = 2000 if quick else 20000
+    values = np.random.default_rng(1).integers(0, 4096, size=(rows, 18))
+    data = ("\r\n".join(",".join(str(value) for value in row) for row in values) + "\r\n").encode()
+    results = []
+    for batch in (1, SerialCommandConsumer.LINE_BATCH):
+        def run():
+            threadMessage = ThreadMessage()
+            consumer = SerialCommandConsumer()
+            consumer.LINE_BATCH = batch
+            port = io.BytesIO(data)
+            while port.tell() < len(data):
+                consumer.readLines(port, threadMessage)
+        elapsed = best(run)
+        results.append(result("serial_readline", {"batch": batch}, 1e6 * elapsed / rows, "us/row", "lower"))
+    return results
+
+
+def benchFilter(quick):
+    results = []
+    rng = np.random.default_rng(0)
+    for window in (300, 3000, 30000):
+        data = rng.normal(size=window).cumsum()
+        lowpass = Filter(3, 150)
+        elapsed = best(lambda: lowpass.butter_lowpass_filter(data), repeat=5)
+        results.append(result("filter_window", {"window": window}, 1000 * elapsed, "ms/window", "lower"))
+        streaming = Filter(3, 150)
+        streaming.streamWindow(data, window)
+        fresh = max(1, window // 10)
+        shifted = np.roll(data, -fresh)
+        elapsed = best(lambda: streaming.streamWindow(shifted, fresh), repeat=5)
+        results.append(result("filter_stream_window", {"window": window, "fresh": fresh},
+                              1000 * elapsed, "ms/window", "lower"))
+    # the same lowpass of several channels, one Filter per channel against one FilterBank pass
+    for channels in (2, 8):
+        for size in (1, 100):
+            block = rng.normal(size=(size, channels))
+            filters = [Filter(3, 150) for _ in range(channels)]
+            elapsed = best(lambda: [item.stream(block[:, index]) for index, item in enumerate(filters)], repeat=5)
+            results.append(result("filter_channels", {"channels": channels, "block": size},
+                                  1e6 * elapsed, "us/block", "lower"))
+            bank = FilterBank(150)
+            for index in range(channels):
+                bank.add(index, 'lowpass', 3)
+            elapsed = best(lambda: bank.filter(block), repeat=5)
+            results.append(result("filter_bank", {"channels": channels, "block": size},
+                                  1e6 * elapsed, "us/block", "lower"))
+    return results
+
+
+def benchCompositors(quick):
+    import register_screen
+    # register_screen logs at DEBUG, which makes matplotlib very chatty
+    logging.getLogger('matplotlib').setLevel(logging.WARNING)
+    frames = 20 if quick else 100
+    results = []
+    rng = np.random.default_rng(0)
+    displays = register_screen.createDisplays()
+    for window in (300, 3000):
+        raw = rng.integers(1000, 3000, size=(window + frames * 30, 18)).astype(np.float64)
+        # the figures show derived channels, rows carry them behind the raw columns
+        data = Data(size=raw.shape, history=1, prefix="bench.")
+        data.push_block(raw)
+        history, names = data.snapshot()[1], data.names()
+        for blit in (False, True):
+            compositors = list(register_screen.createFigures().items()) + list(register_screen.createSpectra().items())
+            for key, figure in compositors:
+                figure.blit = blit
+                for frame in range(frames):
+                    cursor = window + frame * 30
+                    figure.draw(ChannelBlock(history[cursor - window:cursor], register_screen.channels, names), cursor)
+                results.append(result("figure_draw", {"figure": key, "window": window, "blit": blit},
+                                      figure.frameStats()[0], "ms/frame", "lower"))
+        for key, display in displays.items():
+            block = ChannelBlock(history[-window:], register_screen.channels, names)
+            elapsed = best(lambda: display.draw(block), repeat=5)
+            results.append(result("display_draw", {"display": key.strip(), "window": window},
+                                  1000 * elapsed, "ms/frame", "lower"))
+    return results
+
+
+def benchEndToEnd(quick):
+    """
+    Serial-to-pixel latency through the objects the GUI runs: a reader thread parses the
+    rows of a rate limited synthetic port with SerialCommandConsumer and pushes them with
+    ThreadMessage.writeBlock (schema fit, derived channels, filter bank, statistics), a
+    RenderScheduler draws the figures and displays into Agg canvases on a 30 fps grid. The
+    latency of a frame is the time from the moment its newest row was due at the port
+    until the frame is rendered. The measurement starts from a full window and figures
+    that were set up once, like a GUI that is running for a while.
+    """
+    import register_screen
+    from register_screen import RenderScheduler
+    logging.getLogger('matplotlib').setLevel(logging.WARNING)
+
+    duration = 1.0 if quick else 3.0
+    results = []
+    for rate in (150, 1500, 15000):
+        for window in (300, 3000):
+            threadMessage = ThreadMessage(prefix="bench.", fs=rate)
+            threadMessage.data = Data(size=(window, 18), prefix="bench.", fs=rate)
+            consumer = SerialCommandConsumer(bulk=True, prefix="bench.")
+            consumer.prepare(threadMessage)
+            threadMessage.writeBlock(SyntheticSource(rate=rate, seed=1).rows(window).astype(np.float64))
+
+            def read():
+                while not threadMessage.halt_thread:
+                    consumer.readBlock(port, threadMessage)
+            reader = Thread(target=read, name='benchReader')
+            scheduler = RenderScheduler(threadMessage, register_screen.createFigures(),
+                                        register_screen.createDisplays())
+            scheduler.frame()
+            latencies = []
+            port = SourcePort(SyntheticSource(rate=rate), timeout=0.01)
+            reader.start()
+            start = deadline = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                if scheduler.frame():
+                    cursor = max(figure.drawn_cursor for figure in scheduler.figures.values())
+                    latencies.append(time.perf_counter() - (port.start + (cursor - window) / rate))
+                deadline += scheduler.period
+                time.sleep(max(0.0, deadline - time.perf_counter()))
+            threadMessage.halt_thread = True
+            reader.join()
+            elapsed = time.perf_counter() - start
+            params = {"rate": rate, "window": window}
+            if latencies:
+                results.append(result("latency_median", params, 1000 * np.median(latencies), "ms", "lower"))
+                results.append(result("latency_p95", params, 1000 * np.percentile(latencies, 95), "ms", "lower"))
+            results.append(result("rows_processed", params, (threadMessage.data.ring.write_cursor - window) / elapsed,
+                                  "rows/s", "higher"))
+    return results
+
+
+def key(record):
+    return record["name"] + json.dumps(record["params"], sort_keys=True)
+
+
+def combine(runs):
+    """
+    One record per benchmark of several runs: the median value and the spread of the
+    values, (max - min) / median
+    """
+    records = {}
+    values = {}
+    for results in runs:
+        for record in results:
+            records.setdefault(key(record), record)
+            values.setdefault(key(record), []).append(record["value"])
+    combined = []
+    for name, record in records.items():
+        median = float(np.median(values[name]))
+        spread = (max(values[name]) - min(values[name])) / abs(median) if median else 0.0
+        combined.append(dict(record, value=median, spread=spread))
+    return combined
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the list of (result, baseline value, relative change) that got worse than the
+    tolerance, or NOISE times the larger spread of the result and its baseline, allows.
+    """
+    reference = {key(record): record for record in baseline["results"]}
+    regressions = []
+    for record in results:
+        previous = reference.get(key(record))
+        if previous is None or previous["value"] == 0:
+            continue
+        change = (record["value"] - previous["value"]) / previous["value"]
+        worse = -change if record["better"] == "higher" else change
+        if worse > max(tolerance, NOISE * max(record.get("spread", 0.0), previous.get("spread", 0.0))):
+            regressions.append((record, previous["value"], change))
+    return regressions
+
+
+def measure(quick=False):
+    results = []
+    results += benchParsing(quick)
+    results += benchFilter(quick)
+    results += benchPush(quick)
+    results += benchCompositors(quick)
+    results += benchEndToEnd(quick)
+    return results
+
+
+def run(quick=False, repeat=3):
+    results = combine([measure(quick) for _ in range(repeat)])
+    return {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "numpy": np.__version__},
+        "quick": quick,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description="Pipeline benchmark suite")
+    arguments.add_argument('--quick', action='store_true', help="fewer rows and frames")
+    arguments.add_argument('--output', default=None, help="write the results to this JSON file")
+    arguments.add_argument('--baseline', default=BASELINE, help="baseline to compare with")
+    arguments.add_argument('--update-baseline', action='store_true', help="store the results as the baseline")
+    arguments.add_argument('--tolerance', type=float, default=0.25, help="allowed relative regression")
+    arguments.add_argument('--repeat', type=int, default=3, help="runs of the suite, their medians are compared")
+    options = arguments.parse_args()
+
+    report = run(options.quick, options.repeat)
+    for record in report["results"]:
+        print("{0:30} {1:55} {2:14.3f} {3:9} +-{4:.0%}".format(record["name"], json.dumps(record["params"]),
+                                                              record["value"], record["unit"], record["spread"]))
+    if options.output:
+        with open(options.output, "w") as handle:
+            json.dump(report, handle, indent=1)
+    if options.update_baseline:
+        with open(options.baseline, "w") as handle:
+            json.dump(report, handle, indent=1)
+        sys.exit(0)
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as handle:
+            baseline = json.load(handle)
+        if baseline["quick"] != report["quick"]:
+            print("warning: the baseline was taken {0} --quick".format("with" if baseline["quick"] else "without"))
+        regressions = compare(report["results"], baseline, options.tolerance)
+        for record, previous, change in regressions:
+            print("REGRESSION {0} {1}: {2:.3f} {3} (baseline {4:.3f}, {5:+.0%})".format(
+                record["name"], json.dumps(record["params"]), record["value"], record["unit"], previous, change))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,181 @@
+import numpy as np
+
+STATISTICS = ('last', 'mean', 'rms', 'min', 'max', 'peak', 'ema', 'latched')
+
+
+class ChannelStatistics:
+    """
+    Running statistics of all columns at once, in the units of `table` (a ChannelTable,
+    raw values without one). update() folds a whole block in a few array operations:
+
+        mean, rms, min, max   over the newest `window` rows, kept in `buckets` partial
+                              aggregates, so the window moves in steps of window / buckets
+        ema                   exponential moving average with weight `alpha` per row
+        peak                  peak-hold, the maximum since the hold started; the hold is
+                              released every `hold` rows, never with hold=None
+        latched               bitwise OR of the raw `errors` columns since the last release,
+                              so an error flag stays visible however short it was
+
+    A single producer updates, the GUI reads; release() only raises a flag that the next
+    update() acts on, so the producer stays the only writer.
+    """
+    def __init__(self, columns, table=None, window=150, buckets=10, alpha=0.05, hold=None, errors=()):
+        self.columns = columns
+        self.table = table
+        self.size = max(1, window // buckets)
+        self.slots = buckets + 1
+        self.alpha = alpha
+        self.hold = hold
+        self.errors = np.array([column for column in errors if column < columns], dtype=np.intp)
+        self.counts = np.zeros(self.slots, dtype=np.int64)
+        self.sums = np.zeros((self.slots, columns))
+        self.squares = np.zeros((self.slots, columns))
+        self.mins = np.full((self.slots, columns), np.inf)
+        self.maxs = np.full((self.slots, columns), -np.inf)
+        self.current = 0
+        self.last = np.full(columns, np.nan)
+        self.ema = None
+        self.peak = np.full(columns, -np.inf)
+        self.held = 0
+        self.latched = np.zeros(self.errors.size, dtype=np.int64)
+        self.release_pending = False
+        self.rows = 0
+
+    def release(self):
+        """
+        Clear the peak-hold and the latched error bits with the next update
+        """
+        self.release_pending = True
+
+    def update(self, block, units=None):
+        """
+        Fold a raw (rows, columns) block into all statistics; units is the block already
+        converted, e.g. raw columns in the units of the table followed by derived channels
+        """
+        block = np.asarray(block, dtype=np.float64)
+        count = block.shape[0]
+        if count == 0:
+            return
+        if units is None:
+            units = self.table.apply(block) if self.table is not None else block
+        self.rows += count
+        self.last = units[-1]
+
+        if self.release_pending or (self.hold is not None and self.held >= self.hold):
+            self.release_pending = False
+            self.peak = np.full(self.columns, -np.inf)
+            self.latched = np.zeros(self.errors.size, dtype=np.int64)
+            self.held = 0
+        self.held += count
+        if count == 1:
+            self.single(units[0], block[0])
+            return
+        np.maximum(self.peak, units.max(axis=0), out=self.peak)
+        if self.errors.size:
+            self.latched |= np.bitwise_or.reduce(block[:, self.errors].astype(np.int64), axis=0)
+
+        # y_n = (1 - a)^n y_0 + sum_i a (1 - a)^(n - 1 - i) x_i
+        decay = 1.0 - self.alpha
+        weights = self.alpha * decay ** np.arange(count - 1, -1, -1)
+        if self.ema is None:
+            self.ema = units[0].copy()
+        self.ema = decay ** count * self.ema + weights @ units
+
+        self.window(units)
+
+    def single(self, units, raw):
+        """
+        update() of a single row, the per-line read path
+        """
+        np.maximum(self.peak, units, out=self.peak)
+        if self.errors.size:
+            self.latched |= raw[self.errors].astype(np.int64)
+        if self.ema is None:
+            self.ema = units.copy()
+        else:
+            self.ema += self.alpha * (units - self.ema)
+        slot = self.current
+        self.counts[slot] += 1
+        self.sums[slot] += units
+        self.squares[slot] += units * units
+        np.minimum(self.mins[slot], units, out=self.mins[slot])
+        np.maximum(self.maxs[slot], units, out=self.maxs[slot])
+        if self.counts[slot] == self.size:
+            self.advance()
+
+    def window(self, units):
+        """
+        Spread the rows over the buckets: fill the current one, whole buckets at once, the
+        rest starts the next current bucket
+        """
+        count = units.shape[0]
+        head = min(self.size - self.counts[self.current], count)
+        self.accumulate(self.current, units[:head])
+        if self.counts[self.current] == self.size:
+            self.advance()
+        full = (count - head) // self.size
+        end = head + full * self.size
+        if full:
+            # only the newest buckets fit the window
+            keep = min(full, self.slots - 1)
+            groups = units[end - keep * self.size:end].reshape(keep, self.size, -1)
+            slots = (self.current + np.arange(keep)) % self.slots
+            self.counts[slots] = self.size
+            self.sums[slots] = groups.sum(axis=1)
+            self.squares[slots] = (groups * groups).sum(axis=1)
+            self.mins[slots] = groups.min(axis=1)
+            self.maxs[slots] = groups.max(axis=1)
+            self.current = (self.current + keep - 1) % self.slots
+            self.advance()
+        if end < count:
+            self.accumulate(self.current, units[end:])
+
+    def accumulate(self, slot, units):
+        if units.shape[0] == 0:
+            return
+        self.counts[slot] += units.shape[0]
+        self.sums[slot] += units.sum(axis=0)
+        self.squares[slot] += (units * units).sum(axis=0)
+        np.minimum(self.mins[slot], units.min(axis=0), out=self.mins[slot])
+        np.maximum(self.maxs[slot], units.max(axis=0), out=self.maxs[slot])
+
+    def advance(self):
+        self.current = (self.current + 1) % self.slots
+        self.counts[self.current] = 0
+        self.sums[self.current] = 0
+        self.squares[self.current] = 0
+        self.mins[self.current] = np.inf
+        self.maxs[self.current] = -np.inf
+
+    def values(self, name):
+        """
+        One of STATISTICS for all columns; latched holds the `errors` columns only
+        """
+        if name == 'last':
+            return self.last
+        if name == 'ema':
+            return self.ema if self.ema is not None else np.full(self.columns, np.nan)
+        if name == 'peak':
+            return self.peak
+        if name == 'latched':
+            return self.latched
+        if name == 'min':
+            return self.mins.min(axis=0)
+        if name == 'max':
+            return self.maxs.max(axis=0)
+        count = self.counts.sum()
+        if count == 0:
+            return np.full(self.columns, np.nan)
+        if name == 'mean':
+            return self.sums.sum(axis=0) / count
+        if name == 'rms':
+            return np.sqrt(self.squares.sum(axis=0) / count)
+        raise ValueError("Unknown statistic {0}, one of {1}".format(name, ", ".join(STATISTICS)))
+
+    def value(self, name, column):
+        """
+        One statistic of one column; latched error bits are returned as an int
+        """
+        if name == 'latched':
+            return int(self.latched[list(self.errors).index(column)])
+        return self.values(name)[column]
@@ -0,0 +1,374 @@
+"""
+Headless entry point, runs without a display and without importing tkinter or matplotlib.
+
+    python cli.py acquire --port "synthetic://?rate=1000" --duration 10
+    python cli.py record --port /dev/rfcomm3 --prefix captures/capture --duration 3600
+    python cli.py command --port /dev/rfcomm3 --set Sd=1.5 --set Lp=3 --raw Z
+    python cli.py command --port /dev/rfcomm3 --profile gains.json --readback --save-profile device.json
+    python cli.py acquire --device rig1=/dev/ttyUSB0 --device rig2=/dev/ttyUSB1 --workers 2
+    python cli.py capture --port /dev/rfcomm3 --trigger 14:mask:0xffff --mode single --prefix captures/errors
+    python cli.py record --port /dev/rfcomm3 --derive "thrust_per_rpm=ratio(thrust, rpm)"
+    python cli.py serve --port /dev/rfcomm3 --listen unix:///tmp/serial_control.sock --token-file token
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from threading import Thread
+
+from acquisition import AcquisitionEngine, DEFAULT_PORT
+from derived import DerivedChannels, parseDerived, parseFilters
+from devices import DeviceManager, parseDevices
+from instrumentation import metrics, scoped, SnapshotExporter
+from pipeline import (Data, ThreadMessage, SerialCommandConsumer, SerialCommandProducer, captureMetadata,
+                      channels, column_layout, derived_channels, filtered_channels, layoutMetadata, schema,
+                      SAMPLE_RATE)
+from publish import DEFAULT_ADDRESS, POLICIES, Publisher, readToken
+from registers import RegisterCache, RegisterPoller, readbackAcknowledge, saveProfile, loadProfile
+from trigger import Trigger, TriggeredCapture, MODES
+
+# seconds between two catch-ups with an acquisition process
+CATCH_UP = 0.05
+
+
+class Session:
+    """
+    Acquisition without GUI: a SerialCommandConsumer thread (or an AcquisitionEngine with
+    process=True) filling a ThreadMessage, with a producer to send commands.
+    With devices, a list of (name, port), a DeviceManager acquires all of them; threadMessage,
+    producer and the register shadow are those of the first device.
+    derived are (name, expression) channels and filters (name, channel, kind, cut-off, order)
+    filtered channels added to every Data before the acquisition starts, fs the nominal
+    sample rate of the devices.
+    """
+    def __init__(self, port=DEFAULT_PORT, protocol='csv', process=False, metricsTarget=None, acknowledge=None,
+                 devices=None, workers=1, derived=(), filters=(), fs=SAMPLE_RATE):
+        self.threadMessage = ThreadMessage(acknowledge, fs=fs)
+        self.engine = None
+        self.thread = None
+        self.manager = None
+        self.registers = RegisterCache()
+        if devices:
+            self.manager = DeviceManager(workers)
+            for name, devicePort in devices:
+                device = self.manager.add(name, devicePort, protocol, acknowledge=acknowledge, fs=fs)
+                Session.configureChannels(device.threadMessage.data, derived, filters)
+            primary = self.manager[devices[0][0]]
+            self.threadMessage = primary.threadMessage
+            self.producer = primary.producer
+            self.registers = primary.registers
+            self.manager.start()
+        elif process:
+            self.engine = AcquisitionEngine(port=port, protocol=protocol, metrics_target=metricsTarget)
+            self.threadMessage.data = Data(ring=self.engine.start(), fs=fs)
+            Session.configureChannels(self.threadMessage.data, derived, filters)
+            self.producer = SerialCommandProducer(self.engine)
+        else:
+            Session.configureChannels(self.threadMessage.data, derived, filters)
+            self.thread = Thread(target=SerialCommandConsumer(bulk=True, protocol=protocol, port=port),
+                                 name='serialCommander', args=(self.threadMessage,))
+            self.thread.start()
+            self.producer = SerialCommandProducer(self.threadMessage)
+
+    @staticmethod
+    def configureChannels(data, derived, filters):
+        for definition in filters:
+            data.filter(*definition)
+        for name, expression in derived:
+            data.derive(name, expression)
+
+    def prefixes(self):
+        """
+        Prefixes of the metrics of every acquired device, see devices.Device
+        """
+        if self.manager is not None:
+            return [device.name + "." for device in self.manager]
+        return [""]
+
+    def rows(self):
+        if self.manager is not None:
+            return self.manager.rows()
+        return self.threadMessage.data.ring.write_cursor
+
+    def catchUp(self):
+        """
+        With process=True, feed the clock, statistics and history with the rows the
+        acquisition process pushed onto the shared ring since the previous call
+        """
+        if self.engine is not None:
+            self.threadMessage.data.catchUp()
+
+    def waitForRows(self, count=1, timeout=10):
+        """
+        Wait until `count` rows arrived, returns the seconds waited or None on timeout.
+        """
+        start = time.perf_counter()
+        while self.rows() < count:
+            if time.perf_counter() - start > timeout:
+                return None
+            time.sleep(0.0005)
+        return time.perf_counter() - start
+
+    def close(self):
+        self.producer.stopRecording()
+        if self.manager is not None:
+            # every device stops its own recording when its port is closed
+            self.manager.stop()
+        elif self.engine is not None:
+            self.engine.stop()
+        else:
+            self.threadMessage.halt_thread = True
+            self.thread.join()
+            self.threadMessage.stopRecording()
+
+
+def report(session, interval, duration):
+    """
+    Log rows and throughput every `interval` seconds for `duration` seconds (None: forever),
+    one line per device with its own sample clock, and the total of several devices.
+    Meanwhile the session catches up with the acquisition process every CATCH_UP seconds.
+    """
+    start = time.perf_counter()
+    while duration is None or time.perf_counter() - start < duration:
+        wake = time.perf_counter() + (interval if duration is None else min(interval, max(0.0, duration - (time.perf_counter() - start))))
+        while True:
+            session.catchUp()
+            left = wake - time.perf_counter()
+            if left <= 0:
+                break
+            time.sleep(min(left, CATCH_UP))
+        snapshot = metrics.snapshot(reader="cli")
+        prefixes = session.prefixes()
+        for prefix in prefixes:
+            values, rates = scoped(snapshot, prefix)
+            logging.info("{0}rows {1}  rows/s {2:.0f}  rejected {3}  overruns {4}  fs {5:.1f} Hz  jitter {6:.2f} ms  gaps {7}".format(
+                prefix[:-1] + ": " if prefix else "", values.get('rows', 0), rates.get('rows', 0.0),
+                values.get('lines_rejected', 0), values.get('ring_overruns', 0), values.get('sample_rate', 0.0),
+                values.get('sample_jitter_ms', 0.0), values.get('gaps', 0)))
+        if len(prefixes) > 1:
+            logging.info("total: rows {0}  rows/s {1:.0f}".format(session.rows(), snapshot["rates"].get('rows', 0.0)))
+
+
+def parseAssignments(assignments):
+    """
+    {"Sd": "1.5"} profile of the --set options, a numeric key is a reg_id
+    """
+    profile = {}
+    for assignment in assignments:
+        key, _, value = assignment.partition("=")
+        profile[int(key, 0) if key[:1].isdigit() else key] = value
+    return profile
+
+
+def acquire(options, session):
+    report(session, options.interval, options.duration)
+
+
+def record(options, session):
+    if session.manager is not None and len(session.manager.devices) > 1:
+        for device in session.manager:
+            device.producer.startRecording(options.prefix + "_" + device.name, captureMetadata(device.registers))
+    else:
+        session.producer.startRecording(options.prefix, captureMetadata(session.registers))
+    report(session, options.interval, options.duration)
+
+
+def capture(options, session):
+    """
+    Write triggered captures until --count captures were taken (one in single mode) or
+    --duration is over
+    """
+    data = session.threadMessage.data
+    triggered = TriggeredCapture(Trigger.parse(options.trigger, channels, data.names()), options.pre, options.post,
+                                 options.mode, options.auto, options.prefix, lambda: captureMetadata(session.registers, data.derived))
+    data.trigger = triggered
+    start = time.perf_counter()
+    try:
+        while (options.count is None or triggered.captures < options.count) and triggered.armed:
+            if options.duration is not None and time.perf_counter() - start >= options.duration:
+                break
+            session.catchUp()
+            time.sleep(CATCH_UP)
+    finally:
+        data.trigger = None
+        triggered.close()
+        logging.info("{0} capture(s), {1} dropped".format(triggered.captures, triggered.dropped_captures))
+
+
+def serve(options, session):
+    """
+    Publish the rows to local clients and execute the commands of the authorized ones for
+    --duration seconds
+    """
+    token = readToken(options.token_file) if options.token_file else None
+    publisher = Publisher(options.listen, schema, layoutMetadata(), options.batch, queue_size=options.queue_size,
+                          policy=options.policy, token=token).start()
+    session.threadMessage.publisher = publisher
+    send = lambda commands: session.producer.writeBatch([line.encode() for line in commands])
+    start = reported = time.perf_counter()
+    try:
+        while options.duration is None or time.perf_counter() - start < options.duration:
+            publisher.dispatch(session.registers, send)
+            time.sleep(0.05)
+            if time.perf_counter() - reported >= options.interval:
+                reported = time.perf_counter()
+                logging.info("rows {0}  clients {1}  messages {2}  skipped {3}  disconnected {4}".format(
+                    session.rows(), len(publisher.clients), publisher.sequence, publisher.dropped_messages,
+                    publisher.disconnected))
+    finally:
+        session.threadMessage.publisher = None
+        publisher.close()
+
+
+def send(session, commands, timeout):
+    """
+    Write command strings as one batch and wait until they are on the wire
+    """
+    for line in commands:
+        logging.info("[COMMAND SEND]: " + line.strip())
+    sent = session.producer.writeBatch([line.encode() for line in commands])
+    if sent and hasattr(sent[0], 'wait'):
+        deadline = time.perf_counter() + timeout
+        while sent[-1].sent is None and time.perf_counter() < deadline:
+            time.sleep(0.001)
+    else:
+        # commands to an acquisition process are sent from the other side of a queue
+        time.sleep(timeout)
+
+
+def command(options, session):
+    """
+    Registers from --profile and --set are validated together before anything is written,
+    then written as one batch followed by the raw commands; with --device to the first one
+    """
+    cache = session.registers
+    if options.profile:
+        values, units = loadProfile(options.profile)
+        cache.stage(values, units)
+    cache.stage(parseAssignments(options.set))
+    commands = []
+    cache.flush(commands.extend)
+    commands += [raw + "\n" for raw in options.raw]
+    if commands:
+        send(session, commands, options.timeout)
+    if options.readback:
+        poller = RegisterPoller(cache, session.threadMessage.writeBatch, batch=len(cache.registers),
+                                timeout=options.timeout)
+        logging.info("read back {0} register(s)".format(poller.poll()))
+    if options.save_profile:
+        saveProfile(options.save_profile, cache)
+    if options.duration:
+        report(session, options.interval, options.duration)
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--port', default=DEFAULT_PORT,
+                        help="serial device, pySerial URL or source URL (synthetic://?rate=1000, replay:///path.cap, pty+synthetic://?rate=1000)")
+    common.add_argument('--protocol', default='csv', choices=['csv', 'binary', 'auto'])
+    common.add_argument('--process', action='store_true', help="run the acquisition in a separate process")
+    common.add_argument('--device', action='append', default=[], metavar="NAME=PORT",
+                        help="acquire several devices instead of --port, repeat for every device")
+    common.add_argument('--workers', type=int, default=1, help="threads reading the --device ports")
+    common.add_argument('--derive', action='append', default=[], metavar="NAME=EXPRESSION",
+                        help="add a derived channel, e.g. \"thrust_per_rpm=ratio(thrust, rpm)\"")
+    common.add_argument('--filter', action='append', default=[], metavar="NAME=CHANNEL:KIND:CUTOFF[:ORDER]",
+                        help="add a filtered channel, e.g. rpm_notch=rpm:notch:50")
+    common.add_argument('--fs', type=float, default=SAMPLE_RATE,
+                        help="nominal sample rate in Hz of the filters, a measured rate that deviates is logged")
+    common.add_argument('--interval', type=float, default=1.0, help="seconds between status lines")
+    common.add_argument('--metrics-export', default=None,
+                        help="append metric snapshots to this file or send them to udp://host:port")
+    common.add_argument('--quiet', action='store_true')
+    arguments = argparse.ArgumentParser(description="Headless acquisition, recording and register programming")
+    modes = arguments.add_subparsers(dest='mode', required=True)
+
+    acquiring = modes.add_parser('acquire', parents=[common], help="acquire and report throughput")
+    acquiring.add_argument('--duration', type=float, default=None, help="seconds, default until interrupted")
+    acquiring.set_defaults(run=acquire)
+
+    recording = modes.add_parser('record', parents=[common], help="acquire into capture files")
+    recording.add_argument('--prefix', default="captures/capture")
+    recording.add_argument('--duration', type=float, default=None, help="seconds, default until interrupted")
+    recording.set_defaults(run=record)
+
+    capturing = modes.add_parser('capture', parents=[common], help="write triggered captures")
+    capturing.add_argument('--trigger', required=True, metavar="COLUMN:KIND:VALUE",
+                           help="e.g. 14:mask:0xffff (any error bit), 1:rising:5.5 (current in A)")
+    capturing.add_argument('--mode', default='single', choices=MODES)
+    capturing.add_argument('--pre', type=int, default=1000, help="rows before the trigger")
+    capturing.add_argument('--post', type=int, default=1000, help="rows from the trigger on")
+    capturing.add_argument('--auto', type=int, default=None, help="rows without trigger before auto forces one")
+    capturing.add_argument('--prefix', default="captures/trigger")
+    capturing.add_argument('--count', type=int, default=1, help="stop after this many captures")
+    capturing.add_argument('--duration', type=float, default=None, help="seconds, default until --count")
+    capturing.set_defaults(run=capture)
+
+    serving = modes.add_parser('serve', parents=[common], help="publish the rows to local clients")
+    serving.add_argument('--listen', default=DEFAULT_ADDRESS, help="tcp://HOST:PORT or unix:///PATH")
+    serving.add_argument('--token-file', default=None,
+                         help="file with the secret that lets clients send commands, none without it")
+    serving.add_argument('--batch', type=int, default=64, help="rows per message")
+    serving.add_argument('--queue-size', type=int, default=256, help="messages queued per client")
+    serving.add_argument('--policy', default='skip', choices=POLICIES,
+                         help="skip messages for a slow client or disconnect it")
+    serving.add_argument('--duration', type=float, default=None, help="seconds, default until interrupted")
+    serving.set_defaults(run=serve)
+
+    commanding = modes.add_parser('command', parents=[common], help="write registers or raw commands")
+    commanding.add_argument('--set', action='append', default=[], metavar="REGISTER=VALUE",
+                            help="user value of a register by identification, name or id, e.g. Sd=1.5")
+    commanding.add_argument('--raw', action='append', default=[], help="raw command, e.g. Z to arm")
+    commanding.add_argument('--profile', default=None, help="register profile (JSON) to apply")
+    commanding.add_argument('--save-profile', default=None, help="save the known register values to this file")
+    commanding.add_argument('--readback', action='store_true', help="read all readable registers back")
+    commanding.add_argument('--timeout', type=float, default=1.0, help="seconds to wait for the write")
+    commanding.add_argument('--duration', type=float, default=0, help="keep acquiring this long afterwards")
+    commanding.set_defaults(run=command)
+
+    options = arguments.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if options.quiet else logging.INFO, format='%(message)s')
+    exporter = None
+    if options.metrics_export:
+        exporter = SnapshotExporter(metrics, options.metrics_export).start()
+    readback = getattr(options, 'readback', False)
+    if readback and options.process:
+        arguments.error("--readback needs the acquisition in this process")
+    try:
+        devices = parseDevices(options.device)
+    except ValueError as error:
+        arguments.error(str(error))
+    if devices and options.process:
+        arguments.error("--device and --process do not go together")
+    if options.mode == 'serve' and options.process:
+        arguments.error("serve needs the acquisition in this process")
+    try:
+        filters = parseFilters(options.filter)
+        derived = parseDerived(options.derive)
+        # check the definitions before anything is opened
+        DerivedChannels(channels, column_layout, definitions=derived_channels + derived,
+                        fs=options.fs, filters=filtered_channels + filters)
+    except ValueError as error:
+        arguments.error(str(error))
+    session = Session(options.port, options.protocol, options.process, options.metrics_export,
+                      readbackAcknowledge if readback else None, devices, options.workers, derived, filters,
+                      options.fs)
+    try:
+        options.run(options, session)
+    except KeyboardInterrupt:
+        pass
+    except ValueError as error:
+        logging.error(error)
+        return 1
+    finally:
+        rows = session.rows()
+        session.close()
+        if exporter is not None:
+            exporter.stop()
+        logging.info(json.dumps({"rows": rows}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
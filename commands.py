@@ -0,0 +1,187 @@
+import logging
+import queue
+import time
+from collections import deque
+from threading import Event, Lock
+
+from instrumentation import metrics
+
+
+class Command:
+    """
+    A single command on its way to the target. Keeps the time it was enqueued and sent and,
+    when the target acknowledges commands, the response.
+    """
+    def __init__(self, payload, expectResponse=False):
+        self.payload = payload
+        self.expect_response = expectResponse
+        self.enqueued = time.perf_counter()
+        self.sent = None
+        self.response = None
+        self.responded = None
+        self.acknowledged = Event()
+
+    def latency(self):
+        """
+        Enqueue-to-wire latency in seconds, None while not sent.
+        """
+        return None if self.sent is None else self.sent - self.enqueued
+
+    def wait(self, timeout=None):
+        """
+        Wait for the response of the target, returns it or None on timeout.
+        """
+        self.acknowledged.wait(timeout)
+        return self.response
+
+
+def echoAcknowledge(line, command):
+    """
+    Acknowledge predicate for targets that echo every command.
+    """
+    return line.strip() == command.payload.strip()
+
+
+class CommandQueue:
+    """
+    Bounded FIFO of commands from the GUI (or a script) to the CommandWriter.
+
+    A batch is enqueued as one item, so it always goes out back-to-back in a single write.
+    With an `acknowledge(line, command)` predicate, lines received from the target are
+    matched to the oldest command that still waits for a response.
+    listener, when set, is called after every put, e.g. to wake a writer that multiplexes
+    several ports instead of blocking in drain().
+    The latency histogram is named with `prefix`, see pipeline.Data.
+    """
+    def __init__(self, maxsize=64, acknowledge=None, history=1000, prefix=""):
+        self.queue = queue.Queue(maxsize)
+        self.latency_metric = prefix + 'command_latency'
+        self.acknowledge = acknowledge
+        self.latencies = deque(maxlen=history)
+        self.pending = deque()
+        self.pending_lock = Lock()
+        self.listener = None
+
+    def put(self, payload, block=True, timeout=None, expectResponse=False):
+        """
+        Enqueue a single command, raises queue.Full when the queue stays full past timeout.
+        """
+        command = Command(payload, expectResponse and self.acknowledge is not None)
+        self.queue.put([command], block, timeout)
+        if self.listener is not None:
+            self.listener()
+        return command
+
+    def putBatch(self, payloads, block=True, timeout=None, expectResponse=False):
+        """
+        Enqueue several commands that are written back-to-back.
+        """
+        commands = [Command(payload, expectResponse and self.acknowledge is not None) for payload in payloads]
+        if commands:
+            self.queue.put(commands, block, timeout)
+            if self.listener is not None:
+                self.listener()
+        return commands
+
+    def drain(self, timeout=None):
+        """
+        Wait up to timeout for the first batch, then take everything else that is queued.
+        """
+        try:
+            commands = list(self.queue.get(True, timeout))
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                commands.extend(self.queue.get_nowait())
+            except queue.Empty:
+                return commands
+
+    def sending(self, commands):
+        """
+        Register the commands of a batch that wait for a response, before the batch is
+        written: the target may answer before the write returns.
+        """
+        with self.pending_lock:
+            self.pending.extend(command for command in commands if command.expect_response)
+
+    def unsent(self, commands):
+        """
+        Withdraw the commands of a batch whose write failed.
+        """
+        with self.pending_lock:
+            for command in commands:
+                if command in self.pending:
+                    self.pending.remove(command)
+
+    def sent(self, commands):
+        """
+        Record the wire time of a written batch.
+        """
+        now = time.perf_counter()
+        for command in commands:
+            command.sent = now
+            self.latencies.append(command.latency())
+            metrics.observe(self.latency_metric, command.latency())
+
+    def handleResponse(self, line):
+        """
+        Match a line from the target to the oldest command it acknowledges.
+        Returns the command or None when the line is not a response.
+        """
+        if self.acknowledge is None:
+            return None
+        with self.pending_lock:
+            for command in self.pending:
+                if self.acknowledge(line, command):
+                    self.pending.remove(command)
+                    break
+            else:
+                return None
+        command.response = line
+        command.responded = time.perf_counter()
+        command.acknowledged.set()
+        return command
+
+    def latencyStats(self):
+        """
+        Returns (count, mean, max) of the recorded enqueue-to-wire latencies in ms.
+        """
+        latencies = list(self.latencies)
+        if not latencies:
+            return (0, 0.0, 0.0)
+        return (len(latencies), 1000 * sum(latencies) / len(latencies), 1000 * max(latencies))
+
+
+class CommandWriter:
+    """
+    Writer side of the full-duplex command path. Runs in its own thread and writes queued
+    commands as soon as they arrive, independent of the thread reading telemetry.
+    """
+    def __init__(self, commandQueue, poll=0.1):
+        self.commandQueue = commandQueue
+        self.poll = poll
+
+    def __call__(self, serialConnection, halt):
+        """
+        Write batches until halt() returns True; halt is checked every `poll` seconds.
+        """
+        while not halt():
+            self.send(serialConnection, self.commandQueue.drain(self.poll))
+
+    def send(self, serialConnection, commands):
+        """
+        Write drained commands back-to-back in a single write
+        """
+        if not commands:
+            return
+        self.commandQueue.sending(commands)
+        try:
+            serialConnection.write(b"".join(command.payload for command in commands))
+            serialConnection.flush()
+        except Exception:
+            self.commandQueue.unsent(commands)
+            raise
+        self.commandQueue.sent(commands)
+        logging.debug("sent {0} command(s), latency {1:.2f} ms".format(
+            len(commands), 1000 * commands[0].latency()))
@@ -0,0 +1,246 @@
+import numpy as np
+
+from filtering import Filter, FilterBank, KINDS
+from history import HistoryStore
+from ringbuffer import RingBuffer
+
+FUNCTIONS = ('abs', 'sqrt', 'exp', 'log', 'minimum', 'maximum', 'clip', 'where', 'ratio', 'integral', 'lowpass')
+
+
+def ratio(numerator, denominator):
+    """
+    numerator / denominator, NaN where the denominator is zero
+    """
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype=np.float64),
+                                                 np.asarray(denominator, dtype=np.float64))
+    result = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+
+class Operators:
+    """
+    The functions an expression may call. integral and lowpass keep their state between
+    blocks, one state per call in the expression, counted in the order they are evaluated.
+    """
+    def __init__(self, fs):
+        self.fs = fs
+        self.states = []
+        self.calls = 0
+        self.functions = {'__builtins__': {}, 'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log,
+                          'minimum': np.minimum, 'maximum': np.maximum, 'clip': np.clip, 'where': np.where,
+                          'ratio': ratio, 'integral': self.integral, 'lowpass': self.lowpass}
+
+    def scope(self):
+        self.calls = 0
+        return self.functions
+
+    def state(self, create):
+        index = self.calls
+        self.calls += 1
+        if index == len(self.states):
+            self.states.append(create())
+        return index
+
+    def integral(self, values):
+        """
+        Running integral over time since the first row, values times seconds
+        """
+        index = self.state(lambda: 0.0)
+        result = self.states[index] + np.cumsum(values) / self.fs
+        if result.size:
+            self.states[index] = result[-1]
+        return result
+
+    def lowpass(self, values, cutOff, order=3):
+        """
+        Butterworth lowpass in streaming mode, see filtering.Filter.stream; base channels are
+        better filtered by the FilterBank of DerivedChannels.filter
+        """
+        index = self.state(lambda: Filter(cutOff, self.fs, order))
+        return self.states[index].stream(values)
+
+
+class DerivedChannel:
+    """
+    A channel computed from other channels by a Python expression, e.g. "voltage * current"
+    """
+    def __init__(self, name, expression, fs):
+        self.name = name
+        self.expression = expression
+        try:
+            self.code = compile(expression, "<channel {0}>".format(name), 'eval')
+        except SyntaxError as error:
+            raise ValueError("Channel {0}: {1!r} is no expression ({2})".format(name, expression, error.msg))
+        self.operators = Operators(fs)
+
+
+class DerivedChannels:
+    """
+    Channels derived from the base channels of a row, declared as expressions over their
+    names (`names` maps the raw columns to names, see pipeline.column_layout) and over the
+    derived channels declared before them:
+
+        power       voltage * current
+        energy      integral(power) / 3600
+        efficiency  ratio(thrust, power)
+
+    Filtered base channels are declared with filter() and computed first, by a FilterBank
+    in one batched pass over all of them; expressions can use them by name.
+    Base channels are in the units of `table`. Expressions are compiled once and evaluated
+    with numpy over whole blocks; integral() and lowpass() carry their state from block to
+    block, so every row must be evaluated exactly once. The producer does that with
+    update() when it pushes the raw rows and keeps the results in a ring of the same
+    capacity, a row of the derived ring has the same cursor as its raw row. A HistoryStore
+    over that ring serves long spans like the one of the raw rows.
+    The filtered channels come first in the ring, the expressions follow.
+    """
+    def __init__(self, table, names, fs=150.0, capacity=2400, definitions=(), filters=()):
+        self.table = table
+        self.base = {name: column for column, name in names.items()}
+        self.fs = fs
+        self.capacity = capacity
+        self.bank = FilterBank(fs)
+        self.filtered = {}
+        self.specs = {}
+        self.channels = []
+        self.index = {}
+        self.ring = None
+        self.store = None
+        for definition in filters:
+            self.filter(*definition)
+        for name, expression in definitions:
+            self.define(name, expression)
+
+    @property
+    def width(self):
+        return self.bank.width + len(self.channels)
+
+    def check(self, name):
+        if name in self.base or name in self.index or name in self.filtered:
+            raise ValueError("Double definition of channel {0}".format(name))
+
+    def filter(self, name, source, kind='lowpass', cutOff=3.0, order=3, cursor=0):
+        """
+        Add `source` (a base channel) filtered by a filtering.design filter as channel `name`;
+        a filter declared twice is computed once. cursor as for define().
+        """
+        self.check(name)
+        if source not in self.base:
+            raise ValueError("Channel {0}: {1!r} is no base channel, one of {2}".format(name, source, ", ".join(self.base)))
+        self.filtered[name] = self.bank.add(self.base[source], kind, cutOff, order)
+        self.specs[name] = "{0}:{1}:{2}:{3}".format(source, kind, ",".join(str(item) for item in np.atleast_1d(cutOff)), order)
+        self.build(cursor)
+
+    def define(self, name, expression, cursor=0):
+        """
+        Add a channel; `cursor` is the write cursor of the raw ring if rows were pushed
+        already, the rows before it have no derived values (NaN)
+        """
+        self.check(name)
+        channel = DerivedChannel(name, expression, self.fs)
+        unknown = [item for item in channel.code.co_names
+                   if item not in self.base and item not in self.index and item not in self.filtered
+                   and item not in FUNCTIONS]
+        if unknown:
+            raise ValueError("Channel {0}: unknown name(s) {1} in {2!r}".format(name, ", ".join(unknown), expression))
+        self.index[name] = len(self.channels)
+        self.channels.append(channel)
+        self.build(cursor)
+        return channel
+
+    def build(self, cursor):
+        self.ring = RingBuffer(self.capacity, self.width)
+        self.ring.buffer[:] = np.nan
+        self.ring.write_cursor = self.ring.read_cursor = cursor
+        self.store = HistoryStore(self.ring)
+
+    def names(self, offset):
+        """
+        Column of every derived channel in rows of `offset` raw columns followed by the
+        derived ones
+        """
+        names = {name: offset + output for name, output in self.filtered.items()}
+        names.update({name: offset + self.bank.width + index for name, index in self.index.items()})
+        return names
+
+    def definitions(self):
+        """
+        (name, definition) of every channel, filters as "SOURCE:KIND:CUTOFF:ORDER"
+        """
+        return list(self.specs.items()) + [(channel.name, channel.expression) for channel in self.channels]
+
+    def evaluate(self, block, units=None):
+        """
+        Values of all channels for a raw block, (rows, width); units is the block in the
+        units of the table if it is at hand already
+        """
+        if units is None:
+            units = self.table.apply(block) if self.table is not None else np.asarray(block, dtype=np.float64)
+        scope = {name: units[:, column] for name, column in self.base.items()}
+        values = np.empty((units.shape[0], self.width))
+        offset = self.bank.width
+        if offset:
+            values[:, :offset] = self.bank.filter(units)
+            scope.update({name: values[:, output] for name, output in self.filtered.items()})
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for index, channel in enumerate(self.channels):
+                values[:, offset + index] = eval(channel.code, channel.operators.scope(), scope)
+                scope[channel.name] = values[:, offset + index]
+        return values
+
+    def update(self, block, units=None, cursor=None):
+        """
+        Evaluate a raw block and push the values, returns them (None without channels).
+        cursor is the raw ring cursor of the first row; rows skipped before it, e.g. when
+        another process lapped the reader of a shared ring, are filled with NaN so the
+        rings stay aligned.
+        """
+        if not self.width:
+            return None
+        if cursor is not None and cursor > self.ring.write_cursor:
+            gap = min(cursor - self.ring.write_cursor, self.ring.capacity)
+            self.ring.write_cursor = cursor - gap
+            missing = np.full((gap, self.width), np.nan)
+            self.ring.push_rows(missing)
+            self.store.push_rows(missing)
+        values = self.evaluate(block, units)
+        self.ring.push_rows(values)
+        self.store.push_rows(values)
+        return values
+
+
+def parseDerived(definitions):
+    """
+    [("power", "voltage * current"), ...] from "NAME=EXPRESSION" strings of the --derive options
+    """
+    derived = []
+    for definition in definitions:
+        name, separator, expression = definition.partition("=")
+        name = name.strip()
+        if not separator or not name.isidentifier() or not expression.strip():
+            raise ValueError("Derived channel {0!r} is not NAME=EXPRESSION".format(definition))
+        derived.append((name, expression.strip()))
+    return derived
+
+
+def parseFilters(definitions):
+    """
+    [("current_lp", "current", "lowpass", 3.0, 3), ...] from "NAME=CHANNEL:KIND:CUTOFF[:ORDER]"
+    strings of the --filter options; a bandpass takes "LOW,HIGH", a notch its quality as ORDER
+    """
+    filters = []
+    for definition in definitions:
+        name, separator, spec = definition.partition("=")
+        parts = spec.split(":")
+        try:
+            if not separator or not name.strip().isidentifier() or len(parts) not in (3, 4) or parts[1] not in KINDS:
+                raise ValueError("not NAME=CHANNEL:KIND:CUTOFF[:ORDER], KIND one of " + ", ".join(KINDS))
+            cutOff = [float(item) for item in parts[2].split(",")]
+            order = float(parts[3]) if len(parts) == 4 else (30.0 if parts[1] == 'notch' else 3)
+            if parts[1] != 'notch':
+                order = int(order)
+        except ValueError as error:
+            raise ValueError("Filter {0!r}: {1}".format(definition, error))
+        filters.append((name.strip(), parts[0], parts[1], cutOff if len(cutOff) > 1 else cutOff[0], order))
+    return filters
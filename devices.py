@@ -0,0 +1,222 @@
+import logging
+import selectors
+import socket
+from threading import Thread
+
+from acquisition import openSerial
+from commands import CommandWriter
+from instrumentation import metrics
+from pipeline import ThreadMessage, SerialCommandConsumer, SerialCommandProducer, SAMPLE_RATE
+from registers import RegisterCache
+
+
+class Device:
+    """
+    One controller of a rig with a pipeline of its own: the parser (SerialCommandConsumer),
+    ring, history, recorder and command queue (ThreadMessage) and a register shadow
+    (RegisterCache). threadMessage goes wherever the single port code takes one, e.g.
+    SerialCommandProducer, RegisterPoller or a RenderScheduler.
+    Its metrics are named "<name>.rows", "<name>.bytes_read", ...
+    A device whose port cannot be opened, read or written is closed and left out of the
+    acquisition, `failed` is the error then.
+    """
+    def __init__(self, name, port, protocol='csv', layout=None, acknowledge=None, fs=SAMPLE_RATE):
+        self.name = name
+        self.port = port
+        self.threadMessage = ThreadMessage(acknowledge, prefix=name + ".", fs=fs)
+        self.consumer = SerialCommandConsumer(bulk=True, protocol=protocol, layout=layout, port=port,
+                                              prefix=name + ".")
+        self.writer = CommandWriter(self.threadMessage.commands)
+        self.producer = SerialCommandProducer(self.threadMessage)
+        self.registers = RegisterCache()
+        self.connection = None
+        self.failed = None
+
+    def open(self):
+        """
+        Open the port without read timeout, read() returns whatever is waiting
+        """
+        self.connection = openSerial(self.port, timeout=0)
+        self.consumer.prepare(self.threadMessage)
+        return self.connection
+
+    def fileno(self):
+        """
+        File descriptor of the port, None for ports a selector cannot watch
+        (pySerial URLs like loop://, synthetic and replay sources)
+        """
+        try:
+            return self.connection.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def read(self):
+        """
+        Parse and push everything waiting at the port, returns the number of bytes read
+        """
+        waiting = self.connection.in_waiting
+        if not waiting:
+            return 0
+        chunk = self.connection.read(waiting)
+        self.consumer.consume(chunk, self.threadMessage)
+        return len(chunk)
+
+    def write(self):
+        """
+        Write the queued commands, if any
+        """
+        self.writer.send(self.connection, self.threadMessage.commands.drain(0))
+
+    def rows(self):
+        return self.threadMessage.data.ring.write_cursor
+
+    def fail(self, error):
+        self.failed = error
+        logging.error("Device {0} on {1} failed: {2}".format(self.name, self.port, error))
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.threadMessage.stopRecording()
+
+
+class DeviceManager:
+    """
+    Acquires several devices with a small pool of `workers` threads instead of one
+    blocking reader and one writer thread per port. Devices are spread round robin over
+    the workers, every worker multiplexes its own with a selector: ports with a file
+    descriptor (serial devices, ptys) are read as soon as they are readable, the others are
+    polled every `poll` seconds. Queued commands wake the worker through a socket pair and
+    are written from the same loop. A failing device is dropped, the others carry on.
+    """
+    def __init__(self, workers=1, poll=0.005):
+        self.devices = {}
+        self.workers = workers
+        self.poll = poll
+        self.halt = False
+        self.threads = []
+        metrics.gauge('rows', self.rows)
+
+    def add(self, name, port, protocol='csv', layout=None, acknowledge=None, fs=SAMPLE_RATE):
+        if name in self.devices:
+            raise ValueError("Double definition of device {0}".format(name))
+        device = self.devices[name] = Device(name, port, protocol, layout, acknowledge, fs)
+        return device
+
+    def __getitem__(self, name):
+        return self.devices[name]
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def rows(self):
+        """
+        Rows acquired by all devices together
+        """
+        return sum(device.rows() for device in self.devices.values())
+
+    def start(self):
+        devices = list(self.devices.values())
+        for index in range(min(self.workers, len(devices))):
+            thread = Thread(target=self.run, args=(devices[index::self.workers],),
+                            name='deviceWorker{0}'.format(index))
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def run(self, devices):
+        """
+        Body of a worker: read, parse and push the rows of `devices` and write their
+        commands until stop() is called.
+        """
+        selector = selectors.DefaultSelector()
+        wakeup, waker = socket.socketpair()
+        wakeup.setblocking(False)
+        waker.setblocking(False)
+        selector.register(wakeup, selectors.EVENT_READ)
+        polled = []
+        try:
+            for device in devices:
+                try:
+                    device.open()
+                except Exception as error:
+                    device.fail(error)
+                    continue
+                device.threadMessage.commands.listener = lambda: self.wake(waker)
+                descriptor = device.fileno()
+                if descriptor is None:
+                    polled.append(device)
+                else:
+                    selector.register(descriptor, selectors.EVENT_READ, device)
+            timeout = self.poll if polled else 0.1
+            while not self.halt:
+                for key, events in selector.select(timeout):
+                    if key.data is None:
+                        self.drainWakeup(wakeup)
+                    else:
+                        self.service(key.data, key.data.read, selector, polled)
+                for device in list(polled):
+                    self.service(device, device.read, selector, polled)
+                for device in devices:
+                    if device.failed is None:
+                        self.service(device, device.write, selector, polled)
+        finally:
+            for device in devices:
+                device.threadMessage.commands.listener = None
+                device.close()
+            selector.close()
+            wakeup.close()
+            waker.close()
+            logging.info('Device worker halted')
+
+    @staticmethod
+    def service(device, action, selector, polled):
+        """
+        Read or write a device; when that fails the device is taken out of the worker
+        """
+        try:
+            action()
+        except Exception as error:
+            if device in polled:
+                polled.remove(device)
+            for key in list(selector.get_map().values()):
+                if key.data is device:
+                    selector.unregister(key.fileobj)
+            device.fail(error)
+
+    @staticmethod
+    def wake(waker):
+        try:
+            waker.send(b"\0")
+        except (BlockingIOError, OSError):
+            # a wakeup is pending already, or the worker is gone
+            pass
+
+    @staticmethod
+    def drainWakeup(wakeup):
+        try:
+            while wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def stop(self):
+        self.halt = True
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def parseDevices(definitions):
+    """
+    [("rig1", "/dev/ttyUSB0"), ...] from "NAME=PORT" strings of the --device options
+    """
+    devices = []
+    for definition in definitions:
+        name, separator, port = definition.partition("=")
+        if not separator or not name or not port:
+            raise ValueError("Device {0!r} is not NAME=PORT".format(definition))
+        devices.append((name, port))
+    return devices
@@ -1,10 +1,71 @@
-from scipy.signal import butter, lfilter, lfilter_zi
+import numpy as np
+from scipy.signal import butter, iirnotch, lfilter, lfilter_zi, sosfilt, sosfilt_zi, tf2sos
+
+_designs = {}
+
+# filter kinds and their scipy.signal.butter btype; a notch is an iirnotch of quality `order`
+KINDS = {'lowpass': 'low', 'highpass': 'high', 'bandpass': 'band', 'notch': None}
+
+def design(cutOff, fs, order=3, output='ba', kind='lowpass'):
+    """
+    Returns the (cached) design for (cutOff, fs, order, kind): a Butterworth filter of
+    `order`, cutOff is a (low, high) pair for a bandpass; for a notch cutOff is the
+    frequency taken out and order the quality factor.
+    Designs are shared between filters, the returned arrays must not be modified.
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown filter {0}, one of {1}".format(kind, ", ".join(KINDS)))
+    cutOff = tuple(float(item) for item in np.atleast_1d(cutOff))
+    key = (cutOff, float(fs), order, output, kind)
+    if key not in _designs:
+        nyq = 0.5 *fs
+        if kind == 'notch':
+            b, a = iirnotch(cutOff[0], order, fs)
+            _designs[key] = (b, a) if output == 'ba' else tf2sos(b, a)
+        else:
+            normal_cutOff = [item/nyq for item in cutOff] if kind == 'bandpass' else cutOff[0]/nyq
+            _designs[key] = butter(int(order), normal_cutOff, btype=KINDS[kind], analog=False, output=output)
+    return _designs[key]
+
+# blocks up to this many samples are filtered sample by sample with sosDirect, sosfilt
+# costs about 0.1 ms per call whatever the length
+DIRECT_LIMIT = 16
+
+def sosDirect(sections, state, values):
+    """
+    sosfilt of a few samples of one channel in plain Python, in place on lists: the
+    sections (tuples b0, b1, b2, a0, a1, a2) in transposed direct form II like sosfilt,
+    state the [z0, z1] of every section and values the samples. Returns values.
+    """
+    for (b0, b1, b2, _, a1, a2), zi in zip(sections, state):
+        z0, z1 = zi
+        for position, x in enumerate(values):
+            y = b0 * x + z0
+            z0 = b1 * x - a1 * y + z1
+            z1 = b2 * x - a2 * y
+            values[position] = y
+        zi[0], zi[1] = z0, z1
+    return values
 
 class Filter:
-    def __init__(self, cutOff, fs, order=3):
-        b, a = Filter.butter_lowpass(cutOff, fs, order= order)
+    """
+    Butterworth lowpass filter, or with kind= a highpass, bandpass or notch, see design().
+    Next to filtering a complete window, the filter can run in
+    streaming mode in which its state is kept between calls and only new samples are
+    processed. Streaming uses second-order sections for numerical stability.
+    """
+    def __init__(self, cutOff, fs, order=3, kind='lowpass'):
+        b, a = design(cutOff, fs, order, kind=kind)
         self.a = a
         self.b = b
+        self.sos = design(cutOff, fs, order, output='sos', kind=kind)
+        self.sections = [tuple(section) for section in self.sos.tolist()]
+        self.cutOff = cutOff
+        self.fs = fs
+        self.order = order
+        self.kind = kind
+        self.zi = None
+        self.output = None
 
     @staticmethod
     def butter_lowpass(cutOff, fs, order=3):
@@ -16,15 +77,132 @@ class Filter:
 
         Filter type is discrete lowpass
         """
-        nyq = 0.5 *fs
-        normal_cutOff = cutOff/nyq
-        b, a = butter(order, normal_cutOff, btype='low', analog=False)
-        return b, a
+        return design(cutOff, fs, order)
 
     def butter_lowpass_filter(self, data):
         """
         Implements digital butterworth lowpass filter.
         Assumes 1-D array_like type.
         """
-        y = lfilter(self.b, self.a, data, zi=lfilter_zi(b, a)*data[0])[0]
+        y = lfilter(self.b, self.a, data, zi=lfilter_zi(self.b, self.a)*data[0])[0]
         return y
+
+    def stream(self, samples):
+        """
+        Filters only the given new samples, continuing from the state of the previous call.
+        The state is seeded from the first sample ever seen to avoid a start-up transient.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.shape[0] == 0:
+            return samples
+        if self.zi is None:
+            self.zi = sosfilt_zi(self.sos) * samples[0]
+        if samples.ndim == 1 and samples.shape[0] <= DIRECT_LIMIT:
+            state = self.zi.tolist()
+            output = sosDirect(self.sections, state, samples.tolist())
+            self.zi = np.array(state)
+            return np.array(output)
+        y, self.zi = sosfilt(self.sos, samples, zi=self.zi)
+        return y
+
+    def streamWindow(self, window, fresh):
+        """
+        Keeps the filtered version of a sliding window of which only the last `fresh`
+        samples are new since the previous call.
+        """
+        window = np.asarray(window, dtype=np.float64)
+        if self.output is None or self.output.shape != window.shape or fresh >= window.shape[0]:
+            self.reset()
+            self.output = self.stream(window)
+        elif fresh > 0:
+            self.output = np.concatenate((self.output[fresh:], self.stream(window[-fresh:])))
+        return self.output
+
+    def reset(self):
+        self.zi = None
+        self.output = None
+
+
+class FilterBank:
+    """
+    Filters several channels of every block in one pass, keeping the state between blocks.
+    add() declares a (column, kind, cutOff, order) filter and returns its output column;
+    the same filter of the same column is computed once however often it is added.
+    Columns filtered with the same design are one group, a group is filtered by a single
+    sosfilt call over its 2-D block; blocks of a few rows run through the sections in
+    Python instead (see DIRECT_LIMIT).
+    """
+    def __init__(self, fs=150.0):
+        self.fs = fs
+        self.outputs = {}
+        self.groups = {}
+
+    @property
+    def width(self):
+        return len(self.outputs)
+
+    def add(self, column, kind='lowpass', cutOff=3.0, order=3):
+        """
+        Output column of the filter of `column`
+        """
+        sos = design(cutOff, self.fs, order, output='sos', kind=kind)
+        key = (column, kind, tuple(np.atleast_1d(cutOff).astype(float)), order)
+        if key in self.outputs:
+            return self.outputs[key]
+        output = self.outputs[key] = len(self.outputs)
+        group = self.groups.setdefault(key[1:], FilterGroup(sos))
+        group.add(column, output)
+        return output
+
+    def filter(self, block):
+        """
+        The filtered outputs of a (rows, columns) block, (rows, width)
+        """
+        filtered = np.empty((block.shape[0], self.width))
+        if block.shape[0] == 0:
+            return filtered
+        for group in self.groups.values():
+            filtered[:, group.outputs] = group.stream(block[:, group.columns])
+        return filtered
+
+
+class FilterGroup:
+    """
+    Columns sharing one second-order sections design, with the state of all of them: zi
+    for sosfilt or, while short blocks come in, `state` as the lists sosDirect works on
+    (channels, sections, 2), so the state is not converted back and forth on every row.
+    """
+    def __init__(self, sos):
+        self.sos = sos
+        self.sections = [tuple(section) for section in sos.tolist()]
+        self.columns = []
+        self.outputs = []
+        self.zi = None
+        self.state = None
+
+    def add(self, column, output):
+        self.columns.append(column)
+        self.outputs.append(output)
+        self.zi = None
+        self.state = None
+
+    def stream(self, samples):
+        """
+        Filter (rows, channels) samples, continuing from the previous call; the state is
+        seeded from the first row like Filter.stream
+        """
+        if self.zi is None and self.state is None:
+            self.zi = sosfilt_zi(self.sos)[:, :, np.newaxis] * samples[0]
+        if samples.shape[0] > DIRECT_LIMIT:
+            if self.state is not None:
+                self.zi = np.array(self.state).transpose(1, 2, 0)
+                self.state = None
+            y, self.zi = sosfilt(self.sos, samples, axis=0, zi=self.zi)
+            return y
+        if self.state is None:
+            self.state = self.zi.transpose(2, 0, 1).tolist()
+            self.zi = None
+        output = samples.T.tolist()
+        for channel, values in enumerate(output):
+            sosDirect(self.sections, self.state[channel], values)
+        return np.array(output).T
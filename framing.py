@@ -0,0 +1,159 @@
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+from schema import ROW_SCHEMA
+
+SYNC_WORD = 0xA55A
+
+def _crcTable(poly=0x1021):
+    table = np.zeros(256, dtype=np.uint16)
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & 0x8000 else (crc << 1)
+        table[byte] = crc & 0xFFFF
+    return table
+
+CRC_TABLE = _crcTable()
+
+def crc16(frames):
+    """
+    CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) of every row of a (frames, bytes) uint8
+    array. The loop runs over the byte positions, each step handles all frames at once.
+    """
+    frames = np.atleast_2d(frames)
+    crc = np.full(frames.shape[0], 0xFFFF, dtype=np.uint16)
+    for position in range(frames.shape[1]):
+        index = ((crc >> 8) ^ frames[:, position]).astype(np.uint8)
+        crc = (crc << 8) ^ CRC_TABLE[index]
+    return crc
+
+
+class FrameLayout:
+    """
+    Layout of a binary telemetry frame:
+
+        sync word (uint16) | sequence number (uint16) | fields | CRC-16 (uint16)
+
+    All values are little endian. `fields` is a list with one NumPy type code per column,
+    by default those of the row schema (schema.ROW_SCHEMA.fields(), unsigned columns as
+    uint16). The CRC covers the sequence number and the fields.
+    """
+    def __init__(self, fields=None, sync=SYNC_WORD):
+        self.fields = list(fields) if fields is not None else ROW_SCHEMA.fields()
+        self.columns = len(self.fields)
+        self.sync = sync
+        self.names = ['c{0}'.format(column) for column in range(self.columns)]
+        self.dtype = np.dtype([('sync', '<u2'), ('sequence', '<u2')]
+                              + list(zip(self.names, self.fields))
+                              + [('crc', '<u2')])
+        self.size = self.dtype.itemsize
+        self.sync_bytes = np.array([sync & 0xFF, sync >> 8], dtype=np.uint8)
+
+    def encode(self, rows, sequence=0):
+        """
+        Returns the frames for a (rows, columns) block as bytes, numbered from `sequence`.
+        """
+        rows = np.atleast_2d(rows)
+        frames = np.zeros(rows.shape[0], dtype=self.dtype)
+        frames['sync'] = self.sync
+        frames['sequence'] = (sequence + np.arange(rows.shape[0])) & 0xFFFF
+        for column, name in enumerate(self.names):
+            frames[name] = rows[:, column]
+        raw = frames.view(np.uint8).reshape(-1, self.size)
+        frames['crc'] = crc16(raw[:, 2:-2])
+        return frames.tobytes()
+
+
+class FrameParser:
+    """
+    Bulk decoder of binary frames with the same feed() interface as parsing.RowParser.
+
+    Every occurrence of the sync word is a frame candidate; all candidates of a chunk are
+    checked with one vectorized CRC pass, so after corruption the stream resynchronizes on
+    the next sync word with a valid CRC. Counters:
+        accepted: decoded frames
+        rejected: CRC failures (candidates that are not part of an accepted frame)
+        sequence_gaps: number of discontinuities in the sequence numbers
+        lost_frames: frames missing according to the sequence numbers
+    """
+    def __init__(self, layout=None):
+        self.layout = layout if layout is not None else FrameLayout()
+        self.columns = self.layout.columns
+        self.remainder = b""
+        self.sequence = None
+        self.accepted = 0
+        self.rejected = 0
+        self.sequence_gaps = 0
+        self.lost_frames = 0
+
+    def reset(self):
+        self.remainder = b""
+        self.sequence = None
+
+    def feed(self, chunk):
+        """
+        Add raw bytes, returns a (frames, columns) int64 block of the frames completed by it.
+        """
+        data = self.remainder + chunk
+        size = self.layout.size
+        buf = np.frombuffer(data, dtype=np.uint8)
+        sync = self.layout.sync_bytes
+        candidates = np.flatnonzero((buf[:-1] == sync[0]) & (buf[1:] == sync[1]))
+        complete = candidates[candidates + size <= buf.size]
+
+        starts = np.empty(0, dtype=np.intp)
+        if complete.size:
+            frames = buf[complete[:, None] + np.arange(size)]
+            expected = frames[:, -2].astype(np.uint16) | (frames[:, -1].astype(np.uint16) << 8)
+            good = crc16(frames[:, 2:-2]) == expected
+            starts = complete[good]
+            # a sync word inside a frame that happens to pass the CRC must not overlap a frame
+            if starts.size > 1:
+                starts = starts[np.concatenate(([True], np.diff(starts) >= size))]
+            failed = complete[~good]
+            if failed.size and starts.size:
+                owner = np.searchsorted(starts, failed, side='right') - 1
+                inside = (owner >= 0) & (failed < starts[np.maximum(owner, 0)] + size)
+                self.rejected += int(np.count_nonzero(~inside))
+            elif failed.size:
+                self.rejected += failed.size
+            frames = frames[np.searchsorted(complete, starts)]
+
+        end = int(starts[-1]) + size if starts.size else 0
+        self.remainder = data[max(end, buf.size - size + 1, 0):]
+        if not starts.size:
+            return np.empty((0, self.columns), dtype=np.int64)
+
+        decoded = frames.reshape(-1).view(self.layout.dtype)
+        self.countSequence(decoded['sequence'])
+        self.accepted += decoded.size
+        return structured_to_unstructured(decoded[self.layout.names], dtype=np.int64)
+
+    def countSequence(self, sequence):
+        sequence = sequence.astype(np.int64)
+        if self.sequence is not None:
+            sequence = np.concatenate(([self.sequence], sequence))
+        missing = (np.diff(sequence) - 1) % 0x10000
+        self.sequence_gaps += int(np.count_nonzero(missing))
+        self.lost_frames += int(missing.sum())
+        self.sequence = int(sequence[-1])
+
+
+def detectProtocol(sample, layout=None):
+    """
+    Guess the protocol of a stream from a sample of raw bytes: 'binary' when at least three
+    sync words follow each other at the frame size, 'csv' when the sample holds at least
+    two lines of printable text and None when undecided.
+    """
+    layout = layout if layout is not None else FrameLayout()
+    buf = np.frombuffer(sample, dtype=np.uint8)
+    if buf.size > 1:
+        sync = layout.sync_bytes
+        candidates = np.flatnonzero((buf[:-1] == sync[0]) & (buf[1:] == sync[1]))
+        if np.count_nonzero(np.diff(candidates) == layout.size) >= 2:
+            return 'binary'
+    printable = (buf >= 0x20) & (buf < 0x7F) | (buf == ord("\n")) | (buf == ord("\r"))
+    if np.count_nonzero(buf == ord("\n")) >= 2 and printable.all():
+        return 'csv'
+    return None
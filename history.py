@@ -0,0 +1,157 @@
+import numpy as np
+
+from ringbuffer import RingBuffer
+
+
+class Level:
+    """
+    One decimated level of a HistoryStore: a ring of (min, max) buckets of `size` raw rows
+    each, stored side by side as 2 * columns values, plus the running aggregate of the
+    bucket that is still filling up.
+    """
+    def __init__(self, size, capacity, columns):
+        self.size = size
+        self.columns = columns
+        self.ring = RingBuffer(capacity, 2 * columns)
+        self.partial_min = np.full(columns, np.inf)
+        self.partial_max = np.full(columns, -np.inf)
+        self.partial_count = 0
+
+    def coverage(self):
+        return self.ring.capacity * self.size
+
+
+class HistoryStore:
+    """
+    Multi-resolution history on top of the full resolution ring: level k keeps the min and
+    max of buckets of factor**k rows, so with the defaults (factor 16, 4 levels of 16384
+    buckets) the levels reach from minutes to days of rows at ~150 Hz.
+
+    push_rows() updates all levels incrementally in a few vectorized operations, window()
+    returns a series of about `pixels` points for any span, with the peaks preserved, so
+    the cost of drawing stays the same however long the span is.
+    A single producer pushes, a single consumer reads; the consumer may see the newest,
+    still filling bucket of a level halfway through an update.
+    """
+    def __init__(self, ring, factor=16, levels=4, capacity=1 << 14):
+        self.ring = ring
+        self.factor = factor
+        self.columns = ring.columns
+        self.levels = [Level(factor ** (index + 1), capacity, ring.columns) for index in range(levels)]
+        self.rows = 0
+
+    def push_rows(self, block):
+        """
+        Aggregate a (rows, columns) block that was also pushed onto the raw ring.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[0] == 0:
+            return
+        self.rows += block.shape[0]
+        mins, maxs = block, block
+        for level in self.levels:
+            mins, maxs = self.absorb(level, mins, maxs)
+            if mins.shape[0] == 0:
+                break
+
+    def absorb(self, level, mins, maxs):
+        """
+        Fold entries of the level below into `level`, returns the buckets it completed.
+        """
+        group = self.factor
+        count = mins.shape[0]
+        if count == 1 and level.partial_count < group - 1:
+            # a single row that does not complete a bucket, the per-row read path
+            np.minimum(level.partial_min, mins[0], out=level.partial_min)
+            np.maximum(level.partial_max, maxs[0], out=level.partial_max)
+            level.partial_count += 1
+            return mins[:0], maxs[:0]
+        completed_min = []
+        completed_max = []
+        head = min(group - level.partial_count, count)
+        if head:
+            np.minimum(level.partial_min, mins[:head].min(axis=0), out=level.partial_min)
+            np.maximum(level.partial_max, maxs[:head].max(axis=0), out=level.partial_max)
+            level.partial_count += head
+        if level.partial_count == group:
+            completed_min.append(level.partial_min[np.newaxis].copy())
+            completed_max.append(level.partial_max[np.newaxis].copy())
+            level.partial_min[:] = np.inf
+            level.partial_max[:] = -np.inf
+            level.partial_count = 0
+        full = (count - head) // group
+        end = head + full * group
+        if full:
+            completed_min.append(mins[head:end].reshape(full, group, -1).min(axis=1))
+            completed_max.append(maxs[head:end].reshape(full, group, -1).max(axis=1))
+        if end < count:
+            # only reached when the partial bucket was completed above
+            level.partial_min[:] = mins[end:].min(axis=0)
+            level.partial_max[:] = maxs[end:].max(axis=0)
+            level.partial_count = count - end
+        if not completed_min:
+            return mins[:0], maxs[:0]
+        completed_min = np.concatenate(completed_min)
+        completed_max = np.concatenate(completed_max)
+        level.ring.push_rows(np.hstack((completed_min, completed_max)))
+        return completed_min, completed_max
+
+    def entries(self, index, count):
+        """
+        The newest `count` entries of level `index` (0 is the raw ring) as (mins, maxs,
+        starts), including the bucket that is still filling up; starts are raw row numbers.
+        """
+        if index == 0:
+            count = min(count, self.ring.capacity, self.rows)
+            rows = self.ring.latest(count)
+            return rows, rows, np.arange(self.rows - count, self.rows)
+        level = self.levels[index - 1]
+        complete = min(count, level.ring.capacity, level.ring.write_cursor)
+        stored = level.ring.latest(complete)
+        mins, maxs = stored[:, :self.columns], stored[:, self.columns:]
+        starts = (level.ring.write_cursor - complete + np.arange(complete)) * level.size
+        if level.ring.write_cursor * level.size < self.rows:
+            # the rows after the last complete bucket sit in the partial buckets of this
+            # level and of every level below it
+            below = self.levels[:index]
+            mins = np.vstack((mins, np.min([item.partial_min for item in below], axis=0)))
+            maxs = np.vstack((maxs, np.max([item.partial_max for item in below], axis=0)))
+            starts = np.append(starts, level.ring.write_cursor * level.size)
+        return mins, maxs, starts
+
+    def choose(self, rows, bucket):
+        """
+        Coarsest level whose buckets are not wider than `bucket` rows, or a coarser one if
+        that level does not reach back `rows` rows.
+        """
+        index = 0
+        sizes = [1] + [level.size for level in self.levels]
+        coverages = [self.ring.capacity] + [level.coverage() for level in self.levels]
+        while index + 1 < len(sizes) and sizes[index + 1] <= bucket:
+            index += 1
+        while index + 1 < len(sizes) and coverages[index] < rows:
+            index += 1
+        return index
+
+    def window(self, rows, pixels):
+        """
+        The newest `rows` rows for a plot about `pixels` wide. Returns (x, block, decimated):
+        x are row offsets relative to the newest row (<= 0). When the rows fit the pixels
+        the block holds the raw rows, otherwise it holds alternating min and max rows of
+        pixels // 2 buckets, which keeps every peak visible.
+        """
+        if rows <= pixels and rows <= self.ring.capacity:
+            count = min(rows, self.rows)
+            return np.arange(-count + 1, 1), self.ring.latest(count), False
+        pairs = max(1, pixels // 2)
+        index = self.choose(rows, rows / pairs)
+        size = 1 if index == 0 else self.levels[index - 1].size
+        mins, maxs, starts = self.entries(index, -(-rows // size))
+        if mins.shape[0] == 0:
+            return np.zeros(0), np.zeros((0, self.columns)), True
+        edges = np.unique(np.linspace(0, mins.shape[0], min(pairs, mins.shape[0]) + 1).astype(np.intp)[:-1])
+        block = np.empty((2 * edges.size, self.columns))
+        block[0::2] = np.minimum.reduceat(mins, edges, axis=0)
+        block[1::2] = np.maximum.reduceat(maxs, edges, axis=0)
+        x = np.repeat(starts[edges] - (self.rows - 1), 2)
+        return x, block, True
@@ -0,0 +1,181 @@
+import bisect
+import json
+import logging
+import socket
+import time
+from threading import Thread, Event
+
+# upper bucket edges of the latency histograms in ms, the last bucket is open
+BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram, observe() is a bisect and two additions.
+    """
+    def __init__(self, edges=BUCKETS_MS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.edges, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, fraction):
+        """
+        Upper edge of the bucket that holds the given fraction of the observations.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.edges[index] if index < len(self.edges) else self.max
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5),
+                "p95": self.percentile(0.95),
+                "max": self.max,
+                "buckets": list(self.counts)}
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of the pipeline stages.
+
+    count() and observe() are meant for the hot paths: with enabled=False they return after
+    a single attribute test. Every counter or histogram is updated from one thread only, so
+    no lock is taken. Gauges are callables that are only evaluated by snapshot(), e.g. the
+    counters a parser keeps anyway or the write cursor of a ring.
+    """
+    def __init__(self, enabled=True, source="gui"):
+        self.enabled = enabled
+        self.source = source
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.previous = {}
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        if self.enabled:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, fn):
+        """
+        Register a callable that returns the current value of `name`.
+        """
+        self.gauges[name] = fn
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.previous = {}
+
+    def snapshot(self, reader="default"):
+        """
+        Current counters, gauges and histogram summaries, plus the per-second rates of the
+        counters and gauges since the previous snapshot of the same reader (the status panel
+        and an exporter each see their own rates).
+        """
+        now = time.time()
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as error:
+                logging.debug("gauge {0} failed: {1}".format(name, error))
+        values = dict(self.counters)
+        values.update(gauges)
+        rates = {}
+        previous = self.previous.get(reader)
+        if previous is not None and now > previous[0]:
+            rates = {name: (value - previous[1][name]) / (now - previous[0])
+                     for name, value in values.items()
+                     if isinstance(value, (int, float)) and name in previous[1]}
+        self.previous[reader] = (now, values)
+        return {"source": self.source,
+                "time": now,
+                "counters": dict(self.counters),
+                "gauges": gauges,
+                "rates": rates,
+                "histograms": {name: histogram.summary() for name, histogram in list(self.histograms.items())}}
+
+
+metrics = Metrics()
+
+
+def scoped(snapshot, prefix):
+    """
+    (values, rates) of the metrics of a snapshot named with `prefix`, e.g. "rig2." for a
+    device (see devices.Device), without the prefix; values holds the counters and gauges
+    """
+    values = dict(snapshot["counters"])
+    values.update(snapshot["gauges"])
+    return ({name[len(prefix):]: value for name, value in values.items() if name.startswith(prefix)},
+            {name[len(prefix):]: rate for name, rate in snapshot["rates"].items() if name.startswith(prefix)})
+
+
+class SnapshotExporter:
+    """
+    Exports a snapshot of `metrics` every `interval` seconds in a daemon thread, as one JSON
+    line appended to a file, or as one datagram to a local UDP port with a target like
+    udp://127.0.0.1:9999.
+    """
+    def __init__(self, metrics, target, interval=1.0):
+        self.metrics = metrics
+        self.target = target
+        self.interval = interval
+        self.halt = Event()
+        self.thread = None
+        self.socket = None
+        self.address = None
+        if target.startswith("udp://"):
+            host, port = target[len("udp://"):].rsplit(":", 1)
+            self.address = (host, int(port))
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='metricsExporter', daemon=True)
+        self.thread.start()
+        return self
+
+    def export(self):
+        line = json.dumps(self.metrics.snapshot(reader=self.target))
+        if self.socket is not None:
+            try:
+                self.socket.sendto(line.encode(), self.address)
+            except OSError as error:
+                logging.debug("metrics export failed: {0}".format(error))
+            return
+        with open(self.target, "a") as handle:
+            handle.write(line + "\n")
+
+    def run(self):
+        while not self.halt.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self.halt.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.socket is not None:
+            self.socket.close()
@@ -0,0 +1,132 @@
+import numpy as np
+
+ROW_LENGTH = 18
+
+MAX_DIGITS = 15
+
+KIND_BAD, KIND_DIGIT, KIND_COMMA, KIND_NEWLINE, KIND_SIGN, KIND_SPACE = range(6)
+BYTE_KIND = np.full(256, KIND_BAD, dtype=np.uint8)
+BYTE_KIND[ord("0"):ord("9") + 1] = KIND_DIGIT
+BYTE_KIND[ord(",")] = KIND_COMMA
+BYTE_KIND[ord("\n")] = KIND_NEWLINE
+BYTE_KIND[[ord("-"), ord("+")]] = KIND_SIGN
+BYTE_KIND[[ord(" "), ord("\t"), ord("\r")]] = KIND_SPACE
+
+
+def handleValueErrors(raw_array):
+    """
+    Converts a list of string fields to integers. Returns a tuple (valid, converted_array),
+    valid is False as soon as one of the fields is not an integer.
+    """
+    valid = True
+    converted_array = []
+    for item in raw_array:
+        try:
+            converted_array.append(int(item))
+        except ValueError:
+            valid = False
+            break
+    return (valid, converted_array)
+
+
+def parseLine(line, columns=ROW_LENGTH):
+    """
+    Per-line parsing path: decodes a single raw line and converts its fields.
+    Returns a tuple (valid, row) in which valid also covers the row length.
+    """
+    valid, row = handleValueErrors([item.strip() for item in line.decode('ASCII').split(",")])
+    return (valid and len(row) == columns, row)
+
+
+class RowParser:
+    """
+    Bulk parser for the comma separated telemetry rows.
+
+    Raw bytes are fed in chunks of arbitrary size, a trailing partial line is kept until the
+    next chunk completes it. All complete lines of a chunk are validated and converted in
+    one vectorized pass, malformed lines are discarded by a mask and counted in `rejected`.
+    Accepted fields are optionally signed integers of at most MAX_DIGITS digits.
+    With keep_rejected=True the rejected lines are collected, e.g. to find command responses.
+    """
+    def __init__(self, columns=ROW_LENGTH, keep_rejected=False):
+        self.columns = columns
+        self.remainder = b""
+        self.accepted = 0
+        self.rejected = 0
+        self.keep_rejected = keep_rejected
+        self.rejected_lines = []
+
+    def feed(self, chunk):
+        """
+        Add raw bytes, returns a (rows, columns) int64 block of the lines completed by it.
+        """
+        data = self.remainder + chunk
+        end = data.rfind(b"\n")
+        if end < 0:
+            self.remainder = data
+            return np.empty((0, self.columns), dtype=np.int64)
+        self.remainder = data[end + 1:]
+        return self.parseLines(data[:end + 1])
+
+    def reset(self):
+        self.remainder = b""
+
+    def takeRejected(self):
+        """
+        Returns and clears the collected rejected lines.
+        """
+        lines, self.rejected_lines = self.rejected_lines, []
+        return lines
+
+    def parseLines(self, data):
+        """
+        Converts a bytes object of newline terminated lines into a (rows, columns) int64 block.
+
+        Validation works on the positions of separators, digit runs and signs rather than on
+        every byte, the values of the accepted lines are then converted in a single call.
+        """
+        buf = np.frombuffer(data, dtype=np.uint8)
+        if buf.size == 0:
+            return np.empty((0, self.columns), dtype=np.int64)
+        kind = BYTE_KIND[buf]
+        ends = np.flatnonzero(kind == KIND_NEWLINE)
+        lines = ends.size
+
+        separators = np.flatnonzero((kind == KIND_COMMA) | (kind == KIND_NEWLINE))
+        digit = kind == KIND_DIGIT
+        edge = np.flatnonzero(digit[1:] != digit[:-1]) + 1
+        if digit[0]:
+            edge = np.concatenate(([0], edge))
+        # buffer always ends on a newline, so digit runs come in start/end pairs
+        run_start = edge[0::2]
+        run_end = edge[1::2]
+        run_line = np.searchsorted(ends, run_start)
+        run_field = np.searchsorted(separators, run_start)
+
+        invalid = np.bincount(np.searchsorted(ends, np.flatnonzero(kind == KIND_BAD)), minlength=lines) > 0
+        invalid |= np.bincount(np.searchsorted(ends, separators), minlength=lines) != self.columns
+        invalid |= np.bincount(run_line, minlength=lines) != self.columns
+        invalid[run_line[run_end - run_start > MAX_DIGITS]] = True
+        # two digit runs inside one field, e.g. "12 34", which leaves another field empty
+        invalid[run_line[np.flatnonzero(np.diff(run_field) == 0)]] = True
+        # a sign is only valid directly in front of the digits and after a separator or whitespace
+        signs = np.flatnonzero(kind == KIND_SIGN)
+        if signs.size:
+            before = np.where(signs > 0, kind[signs - 1], KIND_NEWLINE)
+            misplaced = (kind[signs + 1] != KIND_DIGIT) | ((before != KIND_COMMA) & (before != KIND_NEWLINE) & (before != KIND_SPACE))
+            invalid[np.searchsorted(ends, signs[misplaced])] = True
+
+        rejected = int(np.count_nonzero(invalid))
+        self.rejected += rejected
+        self.accepted += lines - rejected
+        if rejected and self.keep_rejected:
+            for index in np.flatnonzero(invalid):
+                start = int(ends[index - 1]) + 1 if index else 0
+                self.rejected_lines.append(data[start:int(ends[index])].rstrip(b"\r"))
+        if rejected == lines:
+            return np.empty((0, self.columns), dtype=np.int64)
+        if rejected:
+            lengths = np.diff(ends, prepend=-1)
+            buf = buf[np.repeat(~invalid, lengths)]
+        text = buf.tobytes().replace(b"\n", b",")
+        return np.fromstring(text, dtype=np.int64, sep=",").reshape(-1, self.columns)
@@ -0,0 +1,531 @@
+import logging
+import time
+from threading import Thread
+
+import numpy as np
+
+from acquisition import openSerial, DEFAULT_PORT
+from channelstats import ChannelStatistics
+from commands import CommandQueue, CommandWriter
+from derived import DerivedChannels
+from framing import FrameLayout, FrameParser, detectProtocol
+from history import HistoryStore
+from instrumentation import metrics
+from parsing import RowParser, ROW_LENGTH, handleValueErrors
+from recording import Recorder
+from ringbuffer import RingBuffer
+from registers import registers
+from schema import ROW_SCHEMA, VOLTAGE, CURRENT, TEMPERATURE, ERRORS
+from timing import SampleClock
+
+# The columns of a row, declared with the frame layout in schema.ROW_SCHEMA
+schema = ROW_SCHEMA
+channels = schema.table
+column_layout = schema.layout()
+# Raw columns of bit flags, latched by the statistics
+error_columns = (schema.index("errors"),)
+# Nominal rows per second of the controller, the filters and spectra are designed for it
+SAMPLE_RATE = 150.0
+# Derived channels of every Data, see derived.DerivedChannels; power in W, energy in Wh,
+# efficiency in g/W
+derived_channels = [
+    ("power", "voltage * current_filtered"),
+    ("energy", "integral(power) / 3600"),
+    ("efficiency", "ratio(thrust, power)"),
+]
+# Filtered channels of every Data, (name, channel, kind, cut-off in Hz, order), computed by
+# one FilterBank pass per block
+filtered_channels = [
+    ("current_filtered", "current", "lowpass", 3.0, 3),
+    ("thrust_filtered", "thrust", "lowpass", 10.0, 3),
+]
+
+def layoutMetadata(derived=None):
+    """
+    Column layout of recorded rows; with `derived` (a DerivedChannels) the rows carry the
+    derived channels behind the raw columns, their expressions are listed under "derived"
+    """
+    layout = dict(column_layout)
+    if derived is not None:
+        layout.update({column: name for name, column in derived.names(ROW_LENGTH).items()})
+    return {
+        "columns_layout": {str(column): name for column, name in layout.items()},
+        "units": schema.units(),
+        "raw_columns": ROW_LENGTH,
+        "derived": dict(derived.definitions()) if derived is not None else {},
+    }
+
+def captureMetadata(cache=None, derived=None, entries=None):
+    """
+    Column layout and register values at the start of a recording: "value" is the register
+    value of the shadow in `cache` (a registers.RegisterCache, None while unknown), "user"
+    the same in user units and "confirmed" the time of its last readback. entries maps
+    register identifications to the text entered for them in the GUI, sent or not.
+    """
+    metadata = layoutMetadata(derived)
+    metadata["registers"] = {}
+    for reg in registers.values():
+        value = cache.values.get(reg.reg_id) if cache is not None else None
+        record = {"reg_id": reg.reg_id,
+                  "name": reg.name,
+                  "default": reg.default_value,
+                  "value": value,
+                  "user": None if value is None else float(reg.transformation.transformRegToUser(value)),
+                  "confirmed": cache.confirmed.get(reg.reg_id) if cache is not None else None}
+        if entries is not None:
+            record["entry"] = entries.get(reg.identification, "")
+        metadata["registers"][reg.identification] = record
+    return metadata
+
+class Data:
+    """
+    Class that abstracts the sample storage. Rows are pushed onto a RingBuffer that keeps
+    `history` windows of `size[0]` rows, the GUI reads the newest window as a view or
+    everything that arrived since its last frame. Rows of the `schema` are stored raw in
+    its compact type and saturated to their columns, they are converted to user units only
+    when a consumer asks.
+    Pushing never calls back into the GUI, the GUI polls the write cursor at its own frame rate.
+    An existing ring, e.g. the shared ring of an AcquisitionEngine, can be passed in; rows
+    another process pushed there reach the history levels through catchUp().
+    Every row also goes into a HistoryStore of min/max levels for long spans and into the
+    ChannelStatistics of the displays, so no row is missed between two frames; the same
+    holds for the TriggeredCapture set as `trigger`.
+    The derived and filtered channels (derived_channels, filtered_channels and those added
+    with derive() and filter()) are evaluated once per pushed block. Snapshots, spans, statistics and the trigger see them as
+    columns behind the raw ones, names() tells which.
+    Every row gets a host time from the SampleClock when it is pushed, kept in the `times`
+    ring next to it; the clock measures the sample rate against the nominal `fs`.
+    The gauges are named with `prefix`, e.g. "rig2." when several devices are acquired.
+    """
+    def __init__(self, size=(300, 18), history=8, ring=None, prefix="", fs=SAMPLE_RATE):
+        self.window = size[0]
+        self.shared = ring is not None
+        self.table = channels if schema.width == size[1] or (ring is not None and schema.width == ring.columns) else None
+        if ring is None:
+            ring = RingBuffer(size[0] * history, size[1], schema.dtype if self.table is not None else np.float64)
+        self.ring = ring
+        self.fit = self.table is not None and self.ring.buffer.dtype.kind in 'iu'
+        self.clipped = np.zeros(self.ring.columns, dtype=np.int64)
+        self.prefix = prefix
+        self.store = HistoryStore(self.ring)
+        self.clock = SampleClock(fs, name=prefix)
+        self.times = RingBuffer(self.ring.capacity, 1)
+        self.times.buffer[:] = np.nan
+        self.derived = DerivedChannels(self.table, column_layout, fs, capacity=self.ring.capacity,
+                                       definitions=derived_channels if self.table is not None else (),
+                                       filters=filtered_channels if self.table is not None else ())
+        self.stats = self.statistics()
+        self.layout = self.resolve()
+        self.trigger = None
+        metrics.gauge(prefix + 'rows', lambda: self.ring.write_cursor)
+        metrics.gauge(prefix + 'ring_wraps', lambda: self.ring.write_cursor // self.ring.capacity)
+        metrics.gauge(prefix + 'ring_overruns', lambda: self.ring.overruns)
+        metrics.gauge(prefix + 'clipped_values', lambda: int(self.clipped.sum()))
+        metrics.gauge(prefix + 'sample_rate', lambda: self.clock.rate())
+        metrics.gauge(prefix + 'sample_jitter_ms', lambda: 1000 * self.clock.jitter())
+        metrics.gauge(prefix + 'gaps', lambda: self.clock.gaps)
+        metrics.gauge(prefix + 'missing_rows', lambda: self.clock.missing_rows)
+        metrics.gauge(prefix + 'rejected_rows', lambda: self.clock.rejected_rows)
+
+    def columns(self):
+        """
+        Raw columns plus derived channels
+        """
+        return self.ring.columns + self.derived.width
+
+    def names(self):
+        """
+        Column of every named channel, raw and derived
+        """
+        return self.layout
+
+    def resolve(self):
+        names = {name: column for column, name in column_layout.items() if column < self.ring.columns}
+        names.update(self.derived.names(self.ring.columns))
+        return names
+
+    def derive(self, name, expression):
+        """
+        Add a derived channel, before the statistics are configured and the acquisition
+        starts; the statistics are created anew to include it
+        """
+        self.derived.define(name, expression, self.ring.write_cursor)
+        self.stats = self.statistics()
+        self.layout = self.resolve()
+
+    def filter(self, name, source, kind='lowpass', cutOff=3.0, order=3):
+        """
+        Add a filtered channel, like derive()
+        """
+        self.derived.filter(name, source, kind, cutOff, order, self.ring.write_cursor)
+        self.stats = self.statistics()
+        self.layout = self.resolve()
+
+    def statistics(self, window=150, alpha=0.05, hold=None):
+        """
+        ChannelStatistics of all columns, latching the error_columns of the schema
+        """
+        return ChannelStatistics(self.columns(), self.table, window, alpha=alpha, hold=hold,
+                                 errors=error_columns if self.table is not None else ())
+
+    def push_row(self, array, stamp=None):
+        """
+        Push an row of data onto the ring, `stamp` is the monotonic time it was read at
+        """
+        return self.push(self.fitted(np.asarray(array, dtype=np.float64)[np.newaxis]), single=True, stamp=stamp)
+
+    def push_block(self, block, stamp=None):
+        """
+        Push a block of rows onto the ring as one operation
+        """
+        return self.push(self.fitted(block), stamp=stamp)
+
+    def push(self, block, single=False, cursor=None, stamp=None):
+        """
+        Stamp, derive, aggregate and trigger on a block already fitted to the schema; the
+        times and derived rows are pushed before the raw ones, so a reader never finds a raw
+        row without them. Returns the derived rows.
+        """
+        times = self.clock.stamp(block.shape[0], stamp)
+        if cursor is not None and cursor > self.times.write_cursor:
+            # rows another process pushed that were lapped before they were read
+            gap = min(cursor - self.times.write_cursor, self.times.capacity)
+            self.times.write_cursor = cursor - gap
+            self.times.push_rows(np.full((gap, 1), np.nan))
+        self.times.push_rows(times[:, np.newaxis])
+        units = None
+        if self.derived.width:
+            units = self.table.apply(block) if self.table is not None else np.asarray(block, dtype=np.float64)
+            values = self.derived.update(block, units, cursor)
+            block = np.hstack((block, values))
+            units = np.hstack((units, values))
+        if cursor is None:
+            if single:
+                self.ring.push_row(block[0, :self.ring.columns])
+            else:
+                self.ring.push_rows(block[:, :self.ring.columns])
+        self.store.push_rows(block[:, :self.ring.columns])
+        self.stats.update(block, units)
+        if self.trigger is not None:
+            self.trigger.update(block)
+        return block[:, self.ring.columns:] if self.derived.width else None
+
+    def flush(self):
+        """
+        Return the newest window of rows for further use
+        """
+        return self.ring.latest(self.window)
+
+    def readNew(self):
+        """
+        Return a copy of all rows that arrived since the previous call
+        """
+        return self.ring.read_new()
+
+    def catchUp(self):
+        """
+        Feed the history levels and statistics with the rows another process pushed onto a
+        shared ring
+        """
+        block = self.ring.read_new()
+        if block.shape[0]:
+            self.push(block, cursor=self.ring.read_cursor - block.shape[0])
+
+    def span(self, rows, pixels):
+        """
+        The newest `rows` rows decimated for a plot `pixels` wide, see HistoryStore.window
+        """
+        x, block, decimated = self.store.window(rows, pixels)
+        if not self.derived.width:
+            return x, block, decimated
+        values = self.derived.store.window(rows, pixels)[1]
+        if values.shape[0] != block.shape[0]:
+            # the derived channels were added after the first rows
+            values = np.full((block.shape[0], self.derived.width), np.nan)
+        return x, np.hstack((block, values)), decimated
+
+    def fitted(self, block):
+        """
+        The block saturated to the columns of the schema; clipped values are counted per
+        column in `clipped`, the first ones of a column are logged. Every consumer (ring,
+        derived channels, statistics, recorder, publisher) gets this one fitted block.
+        """
+        if not self.fit:
+            return block
+        block, clipped = schema.fit(block)
+        if clipped is not None:
+            for column in np.flatnonzero((self.clipped == 0) & (clipped > 0)):
+                logging.warning("{0}{1}: values outside of {2} are clipped".format(
+                    self.prefix, schema.name(column), schema.dtypes[column]))
+            self.clipped += clipped
+        return block
+
+    def timeAxis(self, cursor, rows):
+        """
+        Times of the `rows` rows before `cursor` in seconds relative to the newest of them,
+        NaN for rows that were never pushed
+        """
+        times = self.times.latest(rows, cursor)[:, 0]
+        return times - times[-1] if times.size else times
+
+    def stamps(self, count):
+        """
+        Wall clock times of the newest `count` rows, for recordings
+        """
+        return self.clock.wall(self.times.latest(count)[:, 0])
+
+    def snapshot(self):
+        """
+        Return the write cursor and the newest window of rows ending at that cursor, with
+        the derived channels behind the raw columns
+        """
+        cursor = self.ring.write_cursor
+        if not self.derived.width:
+            return cursor, self.ring.latest(self.window, cursor)
+        cursor = min(cursor, self.derived.ring.write_cursor)
+        return cursor, np.hstack((self.ring.latest(self.window, cursor), self.derived.ring.latest(self.window, cursor)))
+
+
+class ThreadMessage:
+    """
+    Class supports safe exchange of data between multiple threads.
+    Commands go through a bounded FIFO that a dedicated writer drains, the sample data is
+    exchanged lock-free by the single-producer/single-consumer ring in Data.
+    With a publisher (see publish.Publisher) every pushed block is also served to the
+    local clients.
+    """
+    def __init__(self, acknowledge=None, prefix="", fs=SAMPLE_RATE):
+        self.halt_thread = False
+        self.commands = CommandQueue(acknowledge=acknowledge, prefix=prefix)
+        self.data = Data(prefix=prefix, fs=fs)
+        self.recorder = Recorder(ROW_LENGTH)
+        self.publisher = None
+        metrics.gauge(prefix + 'recorder_dropped_rows', lambda: self.recorder.dropped_rows)
+
+    def write(self, message, expectResponse=False):
+        return self.commands.put(message, expectResponse=expectResponse)
+
+    def writeBatch(self, messages, expectResponse=False):
+        return self.commands.putBatch(messages, expectResponse=expectResponse)
+
+    def writeBuffer(self, array, stamp=None):
+        row = self.data.fitted(np.asarray(array, dtype=np.float64)[np.newaxis])
+        self.record(row, self.data.push(row, single=True, stamp=stamp))
+        self.publish(row)
+
+    def writeBlock(self, block, stamp=None):
+        """
+        Push a block of rows, `stamp` is the monotonic time it was read at
+        """
+        block = self.data.fitted(block)
+        self.record(block, self.data.push(block, stamp=stamp))
+        self.publish(block)
+
+    def record(self, block, values):
+        """
+        Record the rows with the times of the sample clock, one per row
+        """
+        if not self.recorder.active:
+            return
+        self.recorder.record(block if values is None or self.recorder.columns == block.shape[1]
+                             else np.hstack((block, values)), self.data.stamps(block.shape[0]))
+
+    def publish(self, block):
+        if self.publisher is not None:
+            self.publisher.publish(block, self.data.ring.write_cursor - block.shape[0])
+
+    def startRecording(self, prefix, metadata=None):
+        """
+        Record the raw rows followed by the derived channels, the column layout of the
+        metadata is set accordingly
+        """
+        if not self.recorder.active:
+            self.recorder.columns = self.data.columns()
+            metadata = dict(metadata or {})
+            metadata.update(layoutMetadata(self.data.derived))
+        self.recorder.start(prefix, metadata)
+
+    def stopRecording(self):
+        self.recorder.stop()
+
+    def readBuffer(self):
+        return self.data.flush()
+
+    def readNew(self):
+        return self.data.readNew()
+
+    def readSnapshot(self):
+        return self.data.snapshot()
+
+    def readSpan(self, rows, pixels):
+        return self.data.span(rows, pixels)
+
+class SerialCommandConsumer:
+    """
+    Class that handles a single instance of a ThreadMessage in the second thread.
+
+    With bulk=True everything waiting in the port buffer is read at once and parsed into a
+    block of rows by a RowParser, instead of reading and converting line by line.
+
+    protocol selects the format on the link: 'csv' rows, 'binary' frames as described by
+    `layout` (see framing.FrameLayout) or 'auto' to detect the format from the first bytes.
+    Binary and auto always read in bulk.
+    Line by line, rows are collected until LINE_BATCH of them are read or LINE_LATENCY
+    seconds passed since the first one, and pushed as one block: pushing a single row costs
+    about as much as pushing a block of them.
+    port is anything acquisition.openSerial accepts: a device, a pySerial URL or a source URL.
+    Metrics are named with `prefix`, see Data.
+    """
+    AUTO_DETECT_LIMIT = 4096
+    LINE_BATCH = 32
+    LINE_LATENCY = 0.02
+
+    def __init__(self, bulk=False, protocol='csv', layout=None, port=DEFAULT_PORT, prefix=""):
+        self.port = port
+        self.prefix = prefix
+        self.bytes_metric = prefix + 'bytes_read'
+        self.bulk = bulk or protocol != 'csv'
+        self.protocol = protocol
+        self.layout = layout if layout is not None else FrameLayout()
+        self.parser = FrameParser(self.layout) if protocol == 'binary' else RowParser()
+        self.pending = b""
+        self.keep_rejected = False
+        self.lost = 0
+        self.rejected = 0
+
+    def __call__(self, threadMessage=None):
+        serialConnection = openSerial(self.port)
+        if isinstance(threadMessage, ThreadMessage):
+            writer = Thread(target=CommandWriter(threadMessage.commands), name='commandWriter',
+                            args=(serialConnection, lambda: threadMessage.halt_thread))
+            writer.start()
+            self.prepare(threadMessage)
+            while not threadMessage.halt_thread:
+                if self.bulk:
+                    self.readBlock(serialConnection, threadMessage)
+                    continue
+                self.readLines(serialConnection, threadMessage)
+            else:
+                logging.info('Received halt condition')
+            writer.join()
+
+    def prepare(self, threadMessage):
+        """
+        Keep rejected lines when the commands are acknowledged and register the parser gauges
+        """
+        self.keep_rejected = threadMessage.commands.acknowledge is not None
+        if isinstance(self.parser, RowParser):
+            self.parser.keep_rejected = self.keep_rejected
+        if self.bulk:
+            # the parsers count anyway, read their counters only when a snapshot is taken
+            metrics.gauge(self.prefix + 'lines_parsed', lambda: self.parser.accepted)
+            metrics.gauge(self.prefix + 'lines_rejected', lambda: self.parser.rejected)
+            metrics.gauge(self.prefix + 'frames_lost', lambda: getattr(self.parser, 'lost_frames', 0))
+
+    def readLines(self, serialConnection, threadMessage):
+        """
+        Read line by line until LINE_BATCH rows are collected, LINE_LATENCY seconds passed
+        since the first of them or the port timed out, and push them as one block stamped
+        with the read time of the last row. Rejected lines are handled as they come.
+        """
+        rows = []
+        first = stamp = None
+        while not threadMessage.halt_thread:
+            raw = serialConnection.readline()
+            now = time.monotonic()
+            if not raw:
+                break
+            metrics.count(self.bytes_metric, len(raw))
+            line = raw.decode('ASCII', errors='replace')
+            dummy = self.handleValueErrors([item.strip() for item in line.split(",")])
+            if not dummy[0] or len(dummy[1]) != ROW_LENGTH:
+                # discard line of a ValueError occurs
+                # or if length is not correct
+                metrics.count(self.prefix + 'lines_rejected')
+                if threadMessage.commands.handleResponse(raw.rstrip(b"\r\n")) is None:
+                    threadMessage.data.clock.flag(rejected=1)
+            else:
+                metrics.count(self.prefix + 'lines_parsed')
+                rows.append(dummy[1])
+                stamp = now
+                if first is None:
+                    first = now
+            if len(rows) >= self.LINE_BATCH or (first is not None and now - first >= self.LINE_LATENCY):
+                break
+        if rows:
+            threadMessage.writeBlock(np.array(rows, dtype=np.float64), stamp)
+
+    def readBlock(self, serialConnection, threadMessage):
+        """
+        Drain the port buffer in one read (waits up to the port timeout for the first byte)
+        and push all complete rows as a single block.
+        """
+        chunk = serialConnection.read(max(1, serialConnection.in_waiting))
+        self.consume(chunk, threadMessage, time.monotonic())
+
+    def consume(self, chunk, threadMessage, stamp=None):
+        """
+        Parse a chunk read from the port at the monotonic time `stamp` (now by default) and
+        push all complete rows as a single block. Frames lost according to their sequence
+        numbers and rejected lines that are no command responses are flagged at the clock.
+        """
+        if stamp is None:
+            stamp = time.monotonic()
+        metrics.count(self.bytes_metric, len(chunk))
+        if self.protocol == 'auto':
+            chunk = self.negotiate(chunk)
+            if chunk is None:
+                return
+        block = self.parser.feed(chunk)
+        if block.shape[0] > 0:
+            threadMessage.writeBlock(block, stamp)
+        responses = 0
+        if isinstance(self.parser, RowParser) and self.parser.rejected_lines:
+            for line in self.parser.takeRejected():
+                if threadMessage.commands.handleResponse(line) is not None:
+                    responses += 1
+        lost = getattr(self.parser, 'lost_frames', 0)
+        if lost != self.lost or self.parser.rejected != self.rejected + responses:
+            threadMessage.data.clock.flag(lost - self.lost, self.parser.rejected - self.rejected - responses)
+        self.lost = lost
+        self.rejected = self.parser.rejected
+
+    def negotiate(self, chunk):
+        """
+        Collect bytes until the protocol can be told from them, then switch to the matching
+        parser and return everything collected so far. Falls back to CSV when undecided.
+        """
+        self.pending += chunk
+        protocol = detectProtocol(self.pending, self.layout)
+        if protocol is None and len(self.pending) < self.AUTO_DETECT_LIMIT:
+            return None
+        self.protocol = protocol if protocol is not None else 'csv'
+        self.parser = FrameParser(self.layout) if self.protocol == 'binary' else RowParser(keep_rejected=self.keep_rejected)
+        logging.info("Detected {0} protocol".format(self.protocol))
+        chunk, self.pending = self.pending, b""
+        return chunk
+
+    def handleValueErrors(self, raw_array):
+        return handleValueErrors(raw_array)
+
+
+
+class SerialCommandProducer:
+    """
+    Class that handles a single instance of a ThreadMessage in the primary thread.
+    """
+
+    def __init__(self, threadMessage=None):
+        self.threadMessage=threadMessage
+
+    def write(self, command):
+        return self.threadMessage.write(command)
+
+    def writeBatch(self, commands, expectResponse=False):
+        return self.threadMessage.writeBatch(commands, expectResponse)
+
+    def startRecording(self, prefix, metadata=None):
+        self.threadMessage.startRecording(prefix, metadata)
+
+    def stopRecording(self):
+        self.threadMessage.stopRecording()
@@ -0,0 +1,458 @@
+import hmac
+import json
+import logging
+import os
+import queue
+import selectors
+import socket
+import stat
+import struct
+import time
+from threading import Lock, Thread
+
+import numpy as np
+
+from instrumentation import metrics
+
+MAGIC = b"SCTL"
+# magic, kind, sequence number, first row, rows, payload length
+HEADER = struct.Struct("<4sB3xQQII")
+HELLO, DATA, RESPONSE = range(3)
+POLICIES = ('skip', 'disconnect')
+DEFAULT_ADDRESS = "tcp://127.0.0.1:5760"
+# longest request line a client may send
+LINE_LIMIT = 4096
+
+
+def parseAddress(address):
+    """
+    (family, address) of "tcp://HOST:PORT" or "unix:///PATH"
+    """
+    if address.startswith("unix://") and len(address) > len("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        if port.isdigit():
+            return socket.AF_INET, (host or "127.0.0.1", int(port))
+    raise ValueError("Address {0!r} is not tcp://HOST:PORT or unix:///PATH".format(address))
+
+
+def readToken(path):
+    """
+    The shared secret of the clients that may send commands, the first line of a file
+    """
+    try:
+        with open(path) as handle:
+            token = handle.readline().strip()
+    except OSError as error:
+        raise ValueError("Token file {0}: {1}".format(path, error.strerror))
+    if not token:
+        raise ValueError("Token file {0} is empty".format(path))
+    return token
+
+
+def encode(kind, sequence, first, rows, payload):
+    return HEADER.pack(MAGIC, kind, sequence, first, rows, len(payload)) + payload
+
+
+class Client:
+    """
+    A connected subscriber. Messages go through a bounded queue to a sender thread of its
+    own, offer() never waits; the server thread reads its requests.
+    """
+    def __init__(self, connection, name, queue_size):
+        self.connection = connection
+        self.name = name
+        self.queue = queue.Queue(queue_size)
+        self.buffer = b""
+        self.authorized = False
+        self.requests = 0
+        self.skipped = 0
+        self.closed = False
+        self.thread = Thread(target=self.run, name='publisher.' + name, daemon=True)
+
+    def offer(self, message):
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            return False
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self.connection.sendall(message)
+            except OSError:
+                break
+        self.close()
+
+    def close(self):
+        """
+        Stop the sender and shut the connection down, the server thread sees the end of the
+        stream and forgets the client
+        """
+        if self.closed:
+            return
+        self.closed = True
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Publisher:
+    """
+    Serves the rows of a ThreadMessage to local clients (loggers, dashboards, test scripts)
+    over TCP or a Unix domain socket, see parseAddress.
+
+    The producer calls publish() with every block it pushed; rows are batched until `batch`
+    rows or `interval` seconds are pending (the server thread flushes them when no block
+    follows in time), encoded once and offered to every client. Every
+    client has a bounded queue of `queue_size` messages and its own sender thread, so a slow
+    client never stalls the acquisition: with policy 'skip' the messages that do not fit
+    are skipped for that client (a gap in their sequence numbers), with 'disconnect' the
+    client is dropped.
+
+    Messages are a HEADER followed by the payload:
+
+        HELLO      JSON: columns, dtype and `metadata`, e.g. the column layout and units
+        DATA       `rows` raw rows from row number `first` on, little endian `dtype`
+        RESPONSE   text answer to the request numbered `sequence`, "OK ..." or "ERR ..."
+
+    DATA messages are numbered from 0, HELLO carries the number of the next one.
+    Clients send text lines: "AUTH TOKEN", then "SET REGISTER=VALUE" (user value, e.g.
+    SET Sd=1.5) or "RAW COMMAND". Without a token nobody may send commands. Commands are
+    only queued by the server thread; the owner of the command path executes them with
+    dispatch(), e.g. from the Tk event loop.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, schema=None, metadata=None, batch=64, interval=0.05,
+                 queue_size=256, policy='skip', token=None, prefix=""):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {0}, one of {1}".format(policy, ", ".join(POLICIES)))
+        self.family, self.address = parseAddress(address)
+        self.schema = schema
+        self.dtype = np.dtype(schema.dtype if schema is not None else np.float64).newbyteorder('<')
+        self.metadata = dict(metadata or {})
+        self.batch = batch
+        self.interval = interval
+        self.queue_size = queue_size
+        self.policy = policy
+        self.token = token
+        self.pending = []
+        self.pending_rows = 0
+        self.first = None
+        self.flushed = time.perf_counter()
+        # pending rows are flushed by the producer or, when it goes quiet, the server thread
+        self.lock = Lock()
+        self.sequence = 0
+        self.clients = []
+        self.connections = 0
+        self.requests = queue.Queue()
+        self.dropped_messages = 0
+        self.disconnected = 0
+        self.listener = None
+        self.selector = None
+        self.thread = None
+        self.running = False
+        metrics.gauge(prefix + 'publisher_clients', lambda: len(self.clients))
+        metrics.gauge(prefix + 'publisher_dropped_messages', lambda: self.dropped_messages)
+
+    def start(self):
+        self.listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.address) and stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.unlink(self.address)
+            self.listener.bind(self.address)
+            # only the user running the acquisition may connect
+            os.chmod(self.address, 0o600)
+        else:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(self.address)
+            self.address = self.listener.getsockname()
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.running = True
+        self.thread = Thread(target=self.run, name='publisher', daemon=True)
+        self.thread.start()
+        logging.info("Publishing on {0}".format(self.url()))
+        return self
+
+    def url(self):
+        if self.family == socket.AF_UNIX:
+            return "unix://" + self.address
+        return "tcp://{0}:{1}".format(*self.address)
+
+    def hello(self):
+        hello = dict(self.metadata)
+        hello.update(columns=self.schema.width if self.schema is not None else None, dtype=self.dtype.str,
+                     batch=self.batch, policy=self.policy, commands=self.token is not None)
+        return hello
+
+    def publish(self, block, cursor):
+        """
+        Add a block of raw rows, `cursor` is the row number of its first row. Called by the
+        producer only; without clients nothing is kept.
+        """
+        with self.lock:
+            if not self.clients:
+                self.pending = []
+                self.pending_rows = 0
+                self.first = None
+                return
+            if self.first is None:
+                self.first = cursor
+            self.pending.append(block)
+            self.pending_rows += block.shape[0]
+            now = time.perf_counter()
+            if self.pending_rows >= self.batch or now - self.flushed >= self.interval:
+                self.flush(now)
+
+    def expire(self):
+        """
+        Flush rows that are pending for `interval` seconds, from the server thread
+        """
+        with self.lock:
+            now = time.perf_counter()
+            if self.pending and now - self.flushed >= self.interval:
+                self.flush(now)
+
+    def flush(self, now=None):
+        """
+        Send the pending rows as one DATA message, with the lock held
+        """
+        rows = self.pending[0] if len(self.pending) == 1 else np.concatenate(self.pending)
+        message = encode(DATA, self.sequence, self.first, rows.shape[0],
+                         np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.sequence += 1
+        self.pending = []
+        self.pending_rows = 0
+        self.first = None
+        self.flushed = now if now is not None else time.perf_counter()
+        for client in self.clients:
+            if not client.closed:
+                self.deliver(client, message)
+
+    def deliver(self, client, message):
+        if client.offer(message):
+            return
+        if self.policy == 'disconnect':
+            self.disconnected += 1
+            logging.info("Publisher: dropped the slow client {0}".format(client.name))
+            client.close()
+        else:
+            client.skipped += 1
+            self.dropped_messages += 1
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(self.interval):
+                if key.fileobj is self.listener:
+                    self.accept()
+                else:
+                    self.receive(key.data)
+            self.expire()
+
+    def accept(self):
+        try:
+            connection, peer = self.listener.accept()
+        except OSError:
+            return
+        connection.setblocking(True)
+        if self.family != socket.AF_UNIX:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += 1
+        client = Client(connection, "{0}".format(peer or self.connections), self.queue_size)
+        client.offer(encode(HELLO, self.sequence, 0, 0, json.dumps(self.hello()).encode()))
+        self.selector.register(connection, selectors.EVENT_READ, client)
+        # the producer iterates the list, it is replaced instead of changed in place
+        self.clients = self.clients + [client]
+        client.thread.start()
+        logging.info("Publisher: client {0} connected".format(client.name))
+
+    def receive(self, client):
+        try:
+            chunk = client.connection.recv(LINE_LIMIT)
+        except OSError:
+            chunk = b""
+        if chunk:
+            client.buffer += chunk
+            *lines, client.buffer = client.buffer.split(b"\n")
+            for line in lines:
+                self.request(client, line.decode('utf-8', errors='replace').strip())
+            if len(client.buffer) <= LINE_LIMIT:
+                return
+        self.forget(client)
+
+    def forget(self, client):
+        self.selector.unregister(client.connection)
+        self.clients = [item for item in self.clients if item is not client]
+        client.close()
+        client.thread.join()
+        client.connection.close()
+        logging.info("Publisher: client {0} disconnected".format(client.name))
+
+    def request(self, client, line):
+        if not line:
+            return
+        client.requests += 1
+        verb, _, argument = line.partition(" ")
+        verb = verb.upper()
+        if verb == "AUTH":
+            client.authorized = self.token is not None and hmac.compare_digest(argument.strip().encode(),
+                                                                                self.token.encode())
+            self.respond(client, client.requests, "OK" if client.authorized else "ERR not authorized")
+        elif verb not in ("SET", "RAW"):
+            self.respond(client, client.requests, "ERR unknown request {0}, one of AUTH, SET, RAW".format(verb))
+        elif not client.authorized:
+            self.respond(client, client.requests, "ERR not authorized")
+        else:
+            self.requests.put((client, client.requests, verb, argument.strip()))
+
+    def respond(self, client, number, text):
+        if not client.closed:
+            self.deliver(client, encode(RESPONSE, number, 0, 0, text.encode()))
+
+    def dispatch(self, cache, send):
+        """
+        Execute the queued commands in the calling thread: SET through cache.apply (a
+        registers.RegisterCache, so the value is validated and the shadow stays right), RAW
+        as it is; send(list of command strings) is the command path of the caller, e.g.
+        SerialCommander.writeCommands. Returns the number of requests handled.
+        """
+        handled = 0
+        while True:
+            try:
+                client, number, verb, argument = self.requests.get_nowait()
+            except queue.Empty:
+                return handled
+            handled += 1
+            try:
+                if verb == "SET":
+                    key, separator, value = argument.partition("=")
+                    if not separator:
+                        raise ValueError("not SET REGISTER=VALUE")
+                    key = key.strip()
+                    changes = cache.apply({int(key, 0) if key[:1].isdigit() else key: value.strip()}, send,
+                                          force=True)
+                    text = "OK " + " ".join(register.writeCommand(regValue).strip() for register, regValue in changes)
+                else:
+                    if not argument:
+                        raise ValueError("not RAW COMMAND")
+                    send([argument + "\n"])
+                    text = "OK"
+            except (ValueError, queue.Full) as error:
+                text = "ERR {0}".format(error)
+            logging.info("Publisher: {0} {1} from {2}: {3}".format(verb, argument, client.name, text))
+            self.respond(client, number, text)
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        for client in self.clients:
+            self.forget(client)
+        self.selector.close()
+        self.listener.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class Subscriber:
+    """
+    Client of a Publisher for scripts and tools:
+
+        subscriber = Subscriber("tcp://127.0.0.1:5760", token="...")
+        first, rows = subscriber.read()
+        subscriber.request("SET Sd=1.5")
+
+    read() returns the next block of raw rows; DATA messages the publisher skipped for this
+    client are counted in lost_messages.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, token=None, timeout=5.0):
+        family, target = parseAddress(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(target)
+        self.requests = 0
+        self.backlog = []
+        self.responses = {}
+        self.lost_messages = 0
+        kind, self.sequence, _, _, payload = self.receive()
+        if kind != HELLO:
+            raise ValueError("Publisher did not say hello")
+        self.metadata = json.loads(payload)
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.columns = self.metadata["columns"]
+        if token is not None:
+            response = self.request("AUTH " + token)
+            if not response.startswith("OK"):
+                raise ValueError("Publisher refused the token: " + response)
+
+    def exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Publisher closed the connection")
+            data += chunk
+        return data
+
+    def receive(self):
+        """
+        The next message as (kind, sequence, first row, rows, payload)
+        """
+        magic, kind, sequence, first, rows, length = HEADER.unpack(self.exactly(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("Not a publisher stream")
+        return kind, sequence, first, rows, self.exactly(length)
+
+    def next(self):
+        """
+        Receive one message, keep data and responses
+        """
+        kind, sequence, first, rows, payload = self.receive()
+        if kind == RESPONSE:
+            self.responses[sequence] = payload.decode()
+            return
+        if kind != DATA:
+            return
+        self.lost_messages += sequence - self.sequence
+        self.sequence = sequence + 1
+        block = np.frombuffer(payload, dtype=self.dtype)
+        self.backlog.append((first, block.reshape(rows, -1) if rows else block.reshape(0, self.columns or 0)))
+
+    def read(self):
+        """
+        (row number of the first row, (rows, columns) raw rows) of the next DATA message
+        """
+        while not self.backlog:
+            self.next()
+        return self.backlog.pop(0)
+
+    def request(self, line):
+        """
+        Send a request and wait for its response
+        """
+        self.socket.sendall(line.strip().encode() + b"\n")
+        self.requests += 1
+        while self.requests not in self.responses:
+            self.next()
+        return self.responses.pop(self.requests)
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import queue
+import struct
+import time
+from threading import Thread
+
+import numpy as np
+
+MAGIC = b"SCCAPT01"
+HEADER_SIZE = 1 << 16
+# magic, number of rows, length of the JSON metadata
+PREFIX = struct.Struct("<8sQI")
+
+
+def captureDtype(columns):
+    """
+    Row layout of a capture: host timestamp (seconds since the epoch) and the raw columns.
+    """
+    return np.dtype([('time', '<f8'), ('data', '<f8', (columns,))])
+
+
+class CaptureWriter:
+    """
+    Appends rows to a preallocated, memory-mapped capture file that grows by doubling.
+
+    The file starts with a HEADER_SIZE header holding MAGIC, the number of valid rows and
+    the metadata as JSON (column layout, register values, ...), the rows follow as records
+    of captureDtype. The row count is updated after every append, so a capture that was
+    not closed properly can still be opened.
+    """
+    def __init__(self, path, columns, metadata=None, initial_rows=1 << 16):
+        self.path = path
+        self.columns = columns
+        self.dtype = captureDtype(columns)
+        self.metadata = dict(metadata or {})
+        self.metadata.update(columns=columns, dtype=self.dtype.descr, started=time.time())
+        encoded = json.dumps(self.metadata).encode()
+        if PREFIX.size + len(encoded) > HEADER_SIZE:
+            raise ValueError("Capture metadata does not fit in the header")
+        self.rows = 0
+        self.allocated = 0
+        with open(path, "wb") as handle:
+            handle.write(PREFIX.pack(MAGIC, 0, len(encoded)) + encoded)
+        self.header = np.memmap(path, dtype=np.uint8, mode="r+", shape=(HEADER_SIZE,))
+        self.grow(initial_rows)
+
+    def grow(self, rows):
+        self.allocated = max(rows, 2 * self.allocated)
+        with open(self.path, "r+b") as handle:
+            handle.truncate(HEADER_SIZE + self.allocated * self.dtype.itemsize)
+        self.records = np.memmap(self.path, dtype=self.dtype, mode="r+",
+                                 offset=HEADER_SIZE, shape=(self.allocated,))
+
+    def append(self, timestamps, block):
+        """
+        Append a (rows, columns) block with one host timestamp per row (or one for all rows).
+        """
+        count = block.shape[0]
+        if self.rows + count > self.allocated:
+            self.records.flush()
+            self.grow(self.rows + count)
+        target = self.records[self.rows:self.rows + count]
+        target['time'] = timestamps
+        target['data'] = block
+        self.rows += count
+        self.header[8:16] = np.frombuffer(struct.pack("<Q", self.rows), dtype=np.uint8)
+
+    def size(self):
+        return HEADER_SIZE + self.rows * self.dtype.itemsize
+
+    def close(self):
+        """
+        Flush and cut the preallocated tail off the file.
+        """
+        self.records.flush()
+        self.header.flush()
+        del self.records
+        del self.header
+        with open(self.path, "r+b") as handle:
+            handle.truncate(self.size())
+
+
+def openCapture(path):
+    """
+    Returns (metadata, rows) of a capture. rows is a read-only memmap of captureDtype
+    records, so even captures of several GB open instantly and are paged in on access.
+    """
+    with open(path, "rb") as handle:
+        magic, rows, length = PREFIX.unpack(handle.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError("{0} is not a capture file".format(path))
+        metadata = json.loads(handle.read(length))
+    dtype = captureDtype(metadata['columns'])
+    if rows == 0:
+        return metadata, np.empty(0, dtype=dtype)
+    return metadata, np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(rows,))
+
+
+class Recorder:
+    """
+    Records blocks of rows in a background thread, record() only puts the block on a
+    bounded queue and never waits for the disk. When the queue is full the block is
+    dropped and counted in `dropped_rows`.
+
+    Files are named <prefix>-<start time>.cap and rotated when they exceed max_bytes or
+    are older than max_seconds (None disables either limit).
+    """
+    def __init__(self, columns, max_bytes=None, max_seconds=None, queue_size=1024):
+        self.columns = columns
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.queue = queue.Queue(queue_size)
+        self.active = False
+        self.thread = None
+        self.writer = None
+        self.files = []
+        self.dropped_rows = 0
+
+    def start(self, prefix, metadata=None):
+        """
+        Start recording into files with the given path prefix, the metadata is written to
+        the header of every file.
+        """
+        if self.active:
+            return
+        self.prefix = prefix
+        self.metadata = metadata
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.thread = Thread(target=self.run, name='recorder')
+        self.active = True
+        self.thread.start()
+
+    def record(self, block, timestamp=None):
+        """
+        Queue a block, timestamp is one time for all rows or one per row (seconds since the
+        epoch), now by default
+        """
+        if not self.active:
+            return
+        try:
+            self.queue.put_nowait((time.time() if timestamp is None else timestamp, block.copy()))
+        except queue.Full:
+            self.dropped_rows += block.shape[0]
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamps, block = item
+            timestamp = float(np.max(timestamps))
+            if self.writer is None or self.rotate(timestamp):
+                self.open(timestamp)
+            self.writer.append(timestamps, block)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def rotate(self, timestamp):
+        if self.max_bytes is not None and self.writer.size() >= self.max_bytes:
+            return True
+        return self.max_seconds is not None and timestamp - self.opened >= self.max_seconds
+
+    def open(self, timestamp):
+        if self.writer is not None:
+            self.writer.close()
+        path = "{0}-{1}.cap".format(self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp)))
+        if path in self.files:
+            path = "{0}-{1}-{2}.cap".format(self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp)), len(self.files))
+        self.writer = CaptureWriter(path, self.columns, self.metadata)
+        self.opened = timestamp
+        self.files.append(path)
+        logging.info("Recording to {0}".format(path))
@@ -1,196 +1,39 @@
 from tkinter import Tk, Text, Scrollbar, Button, Label, Frame, RIGHT, LEFT, X, BOTTOM, TOP, NONE, BOTH, Entry, StringVar
 from tkinter.constants import INSERT
-import serial
+from tkinter import filedialog
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from threading import Thread, Lock
+from threading import Thread
+import argparse
 import logging
 import time
+from collections import deque
 import numpy as np
-from filtering import Filter
+from acquisition import AcquisitionEngine, DEFAULT_PORT
+import pipeline
+from pipeline import (Data, ThreadMessage, SerialCommandConsumer, SerialCommandProducer,
+                      ERRORS, channels, error_columns)
+from registers import (registers, RegisterCache, RegisterPoller, readbackAcknowledge,
+                       saveProfile, loadProfile)
+from devices import DeviceManager, parseDevices
+from derived import parseDerived, parseFilters
+from transforms import ChannelTransform, ChannelBlock, IDENTITY
+from spectrum import WelchPSD
+from trigger import Trigger, TriggeredCapture, MODES
+from instrumentation import metrics, scoped, SnapshotExporter
+from publish import DEFAULT_ADDRESS, Publisher, readToken
 
 logging.basicConfig(level=logging.DEBUG, format='%(message)s',)
 
-root = Tk()
-root.wm_title("Console tool")
-user_interface = Frame(root)
-user_interface.pack(side = LEFT)
-visuals = Frame(root)
-visuals.pack(side = RIGHT)
-
-upper_visuals = Frame(visuals)
-upper_visuals.pack(side=TOP)
-lower_visuals = Frame(visuals)
-lower_visuals.pack(side=TOP)
-bottom_displays = Frame(visuals)
-bottom_displays.pack(side=TOP)
-
-content_text = Text(user_interface, wrap='word')
-
-def UNLIMITED(val):
-    return True
-
-def between(a,b):
-    return lambda x: x in range(a,b)
-
-def zeroTo(until):
-    return lambda x: x in range(0,until)
-
-class Transformation:
-    def __init__(self,regToUser = None,userToReg = None):
-        self.reg_to_user = regToUser
-        self.user_to_reg = userToReg
-    
-    def initRegToUser(self,fn):
-        self.reg_to_user = fn
-        
-    def initUserToReg(self, fn):
-        self.user_to_reg = fn
-        
-    def transformRegToUser(self,value):
-        if self.reg_to_user == None:
-            return value
-        return self.reg_to_user(value)
-    
-    def transformUserToReg(self,value):
-        if self.user_to_reg == None:
-            return value
-        return self.user_to_reg(value)
-
-NO_TRANSFORMATION = Transformation()
-
-class Data:
-    """
-    Class that abstract the binary storage approach. If one used for writing data to, the other is 
-    used to read data from. If the first is full, a switch is made between the two.
-    """
-    def __init__(self, size=(300, 18)):
-        self.buffer1 = np.empty(size)
-        self.buffer2 = np.empty(size)
-        self.validToRead1 = False
-        self.__buffer_index = 0
-        self.__buffer_index_max = size[0]
-
-    def push_row(self, array):
-        """
-        Push an row of data onto the available buffer
-        """
-        if self.validToRead1:
-            self.buffer2[self.__buffer_index, :] = array
-        else:
-            self.buffer1[self.__buffer_index, :] = array
-        self.__buffer_index += 1
-
-        if self.__buffer_index == self.__buffer_index_max:
-            self.validToRead1 = not self.validToRead1
-            self.__buffer_index = 0
-            root.event_generate("<<GeneratePlots>>", when="tail")
-            #logging.debug("buffer full")
-
-    def flush(self):
-        """
-        Return the valid buffer for further user
-        """
-        if self.validToRead1:
-            return self.buffer1
-        else:
-            return self.buffer2
-
-
-class ThreadMessage:
-    """
-    Class supports safe exchange of data between multiple threads.
-    """
-    def __init__(self):
-        self.lock = Lock()
-        self.write_message = ""
-        self.new_message = False
-        self.halt_thread = False
-        self.data = Data()
-
-    def write(self, message):
-        self.lock.acquire(True)
-        try:
-            self.write_message = message
-            self.new_message = True
-        finally:
-            self.lock.release()
-
-    def toggle_new_message(self):
-        with self.lock:
-            self.new_message = not self.new_message
-
-    def writeBuffer(self, array):
-        #NOTE: is lock necessary?
-        with self.lock:
-            self.data.push_row(array)
-
-    def readBuffer(self):
-        #NOTE: is lock necessary?
-        with self.lock:
-            return self.data.flush()
-
-class SerialCommandConsumer:
-    """
-    Class that handles a single instance of a ThreadMessage in the second thread.
-    """
-    def __init__(self):
-        pass
-
-    def __call__(self, threadMessage=None):
-        serialConnection = serial.Serial(port="/dev/rfcomm3",
-                                baudrate=115200,
-                                bytesize=serial.EIGHTBITS,
-                                parity=serial.PARITY_NONE,
-                                stopbits=serial.STOPBITS_ONE,
-                                timeout=1,
-                                xonxoff=0,
-                                rtscts=0)
-        if isinstance(threadMessage, ThreadMessage):
-            while not threadMessage.halt_thread:
-                if not threadMessage.new_message:
-                    #TODO: check for timeout of readline
-                    line = serialConnection.readline().decode('ASCII')
-                    dummy = self.handleValueErrors([item.strip() for item in line.split(",")])
-                    if not dummy[0] or len(dummy[1]) != 18:
-                        # discard line of a ValueError occurs
-                        # or if length is not correct
-                        continue
-                    
-                    logging.debug(dummy[1])
-                    threadMessage.writeBuffer(dummy[1])
-                    continue
-                else:
-                    serialConnection.write(threadMessage.write_message)
-                    threadMessage.toggle_new_message()
-                #time.sleep(0.005)
-            else:
-                logging.info('Received halt condition')
-
-    def handleValueErrors(self, raw_array):
-        valid = True
-        converted_array = []
-        for item in raw_array:
-            try:
-                converted_array.append(int(item))
-            except ValueError:
-                valid = False
-                break
-        return (valid, converted_array)
-
-
-
-class SerialCommandProducer:
-    """
-    Class that handles a single instance of a ThreadMessage in the primary thread.
-    """
-
-    def __init__(self, threadMessage=None):
-        self.threadMessage=threadMessage
-
-    def write(self, command):
-        threadMessage.write(command)
-    
+# The widgets are only created by buildGui(), importing this module does not need a display.
+root = None
+content_text = None
+statusPanel = None
+renderScheduler = None
+editors = {}
+displays = {}
+figures = {}
 
 class SerialCommander:
     
@@ -202,7 +45,15 @@ class SerialCommander:
 
     def writeCommand(self,command):
         self.logCommand(command)
-        self.threadProducer.write(command.encode())
+        return self.threadProducer.write(command.encode())
+
+    def writeCommands(self, commands):
+        """
+        Send several commands back-to-back as one batch
+        """
+        for command in commands:
+            self.logCommand(command)
+        return self.threadProducer.writeBatch([command.encode() for command in commands])
     
     def read(self):
         pass
@@ -212,36 +63,20 @@ class SerialCommander:
 
 threadMessage = ThreadMessage() #used as a global
 serialCommander = SerialCommander(SerialCommandProducer(threadMessage))
+registerCache = RegisterCache()
 
 class RegisterEditor:
-    def __init__(self,registerId, identification, 
-                 defaultValue = 0,
-                 transformation = NO_TRANSFORMATION,
-                 name = "NO NAME",
-                 regRange = UNLIMITED,
-                 description = "",
-                 writable = True,
-                 readable = True):
-        self.transformation = transformation
-        self.identification = identification
-        self.default_value = defaultValue
-        self.name = name
-        self.regRange = regRange
-        self.description = description
-        self.reg_id = registerId
-        self.writable = writable
-        self.readable = readable
+    """
+    Entry, write button and description of a register (see registers.Register).
+    Attributes not found here are taken from the register.
+    """
+    def __init__(self, register):
+        self.register = register
         self.serialCommander = serialCommander
 
-    def getRegId(self):
-        return self.reg_id
-  
-    def isWritable(self):
-        return self.writable
-    
-    def isReadable(self):
-        return self.readable
-    
+    def __getattr__(self, name):
+        return getattr(self.register, name)
+
     def draw(self,container):
         Label(container,text=self.name).pack(side=LEFT, fill=NONE)
         self.entry = Entry(container)
@@ -249,268 +84,62 @@ class RegisterEditor:
         Button(container, text="write", command = self.write).pack(side=LEFT, fill=NONE)
         Label(container,text=self.description).pack(side=LEFT, fill=NONE)
 
-    def write(self):
+    def value(self):
+        """
+        Returns the value in the entry, None if there is no valid value
+        """
         regValue = self.entry.get()
         if regValue.isdigit():
-            transformedRegValue = self.transformation.transformUserToReg(float(regValue))
-            self.serialCommander.writeCommand(self.identification + str(int(transformedRegValue)) + "\n")
-
-
-registers = {}
-
-def addReg(newRegister):
-    if newRegister.getRegId() in registers.keys():
-        raise Exception("Double definition of register") 
-    registers[newRegister.getRegId()] = newRegister
-    return newRegister
-
-addReg(RegisterEditor(0x50,"Mc"
-                ,defaultValue = 0
-                ,regRange = zeroTo(8)
-                ,name = "OUTPUT CONTROL: \nctrl_mode"
-                ,description = "(0)=PWM; (1)=RPM; (2)=current; (3)=FOC"))
-
-addReg(RegisterEditor(0xD, "Sd"
-                ,regRange = between(-2048,2047)
-                ,defaultValue = 0
-                ,name ="Id_setpoint"
-                ,description = "setpoint direct current (in FOC-mode)"#    -50.0 A to + 50.0 A        (value * 40.95994)
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(x / 40.95994),
-                    userToReg=lambda x: (x * 40.95994))))
-
-addReg(RegisterEditor(0xE, "Sq"
-                ,regRange = between(-2048,2047)
-                ,defaultValue = 0
-                ,name ="Iq_setpoint"
-                ,description = "setpoint quadrature current (in FOC-mode)"#    -50.0 A to + 50.0 A        (value * 40.95994)
-
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(x / 40.95994),
-                    userToReg=lambda x: (x * 40.95994))))#temp RMS
-
-addReg(RegisterEditor(0xF, "Sp"
-                ,regRange = zeroTo(2000)
-                ,defaultValue = 0
-                ,name ="PWM_setpoint"
-                ,description = "Set duty-cycle 0.0% to 100.0%"#    0.0 % to 100.0 %        value * 20
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(x) *20,
-                    userToReg=lambda x: (x * 20))))#temp RMS
-
-addReg(RegisterEditor(0x13,"Sr"
-                ,regRange = between(-30000,30000)
-                ,defaultValue = 0
-                ,name ="RPM_setpoint"
-                ,description = "setpoint for RPM"))#    -30000 to 30000        value * 1
-
-addReg(RegisterEditor(0x15,"Sf"
-                ,regRange = zeroTo(2000)
-                ,defaultValue = 1953
-                ,name ="ac_freq"
-                ,description = "Set frequency of the AC output"# 0.0% to 100.0% valye *20
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(97656 /x),
-                    userToReg=lambda x: (97656/x))))
-
-addReg(RegisterEditor(0x20,"Td"
-                ,regRange = between(10,100)
-                ,defaultValue = 32
-                ,name ="dead_time"
-                ,description = "Set output dead time (ns)"
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(x*10),
-                    userToReg=lambda x: (x/10))))
-
-addReg(RegisterEditor(0x22,"Ts"
-                ,regRange = zeroTo(10000)
-                ,defaultValue = 500
-                ,name ="slope"
-                ,description = "set PWM rate of change in % per us"
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(x) *1, #not defined yet
-                    userToReg=lambda x: (x*1))))
-
-addReg(RegisterEditor(0x23,"Tp"
-                ,regRange = between(-1023, 1023)
-                ,defaultValue = 32
-                ,name ="phase_shift"
-                ,description = "set phase-shift in degrees"
-                ,transformation=Transformation(
-                    regToUser=lambda x: float(x) *0.3525625,
-                    userToReg=lambda x: (x/ 0.3525626))))
-
-addReg(RegisterEditor(0xB, "Im"
-                ,regRange = zeroTo(0xFFF)
-                ,defaultValue = 0x800
-                ,name ="Imax"
-                ,description = "Max current in PID-loop output for current control"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float((x - 2048)) * 40.95994
-                    ,userToReg = lambda x : int((x * 40.95994) + 2048)))) 
-
-addReg(RegisterEditor(0x30, "Lp"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 60
-                ,name ="CONTROL LOOPS: \n P_gain_0"
-                ,description = "Kp in RPM control-loop (0 to 10)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x / 20.47)
-                    ,userToReg = lambda x : (x * 20.47)))) 
-
-addReg(RegisterEditor(0x31, "Li"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 40
-                ,name ="I_gain_0"
-                ,description = "Ki in RPM control-loop (0 to 10)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x / 20.47)
-                    ,userToReg = lambda x : (x * 20.47)))) 
-
-addReg(RegisterEditor(0x32, "Ld"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 0
-                ,name ="d_gain_0"
-                ,description = "Kd in rpm control-loop (0 to 10)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x / 20.47)
-                    ,userToReg = lambda x : (x * 20.47)))) 
-                    
-addReg(RegisterEditor(0x33, "Lf"
-                ,regRange = between(125, 6250000)
-                ,defaultValue = 62500
-                ,name ="PID_0_f"
-                ,description = "RPM control loop frequency (Hz)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(62500000 / x)
-                    ,userToReg = lambda x : (62500000/x)))) 
-
-addReg(RegisterEditor(0x34, "Lq"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 60
-                ,name ="P_gain_1"
-                ,description = "Kp in current source control-loop (0 to 10)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x /20.47)
-                    ,userToReg = lambda x : (x *20.47)))) 
-
-addReg(RegisterEditor(0x35, "Lr"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 40
-                ,name ="I_gain_1"
-                ,description = "Ki in current source control-loop (0 to 10)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x /20.47)
-                    ,userToReg = lambda x : (x *20.47)))) 
-
-addReg(RegisterEditor(0x36, "Ls"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 0
-                ,name ="D_gain_1"
-                ,description = "Kd in current source control-loop (0 to 10)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x /20.47)
-                    ,userToReg = lambda x : (x *20.47)))) 
-
-addReg(RegisterEditor(0x37, "Lg"
-                ,regRange = between(125, 6250000)
-                ,defaultValue = 1250 # 50 kHz
-                ,name ="PID_1_f"
-                ,description = "current source control loop frequency (Hz)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(62500000 / x)
-                    ,userToReg = lambda x : (62500000 / x)))) 
-
-addReg(RegisterEditor(0x42, "Et"
-                ,regRange = zeroTo(2047)
-                ,defaultValue = 2344
-                ,name ="LIMITS: \n temp_limit"
-                ,description = "Temperature limit MOSFETs (deg C)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float(x - 1940/3.85333)
-                    ,userToReg = lambda x : (x*3.85333)+1940))) 
-
-addReg(RegisterEditor(0xC, "Il"
-                ,regRange = zeroTo(0xFFF)
-                ,defaultValue = 3276
-                ,name ="OC_lim_i"
-                ,description = "Over-current (input) protection (A)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float((x - 2048)) * 40.95994
-                    ,userToReg = lambda x : (x * 40.95994) + 2048)))
-
-addReg(RegisterEditor(0x7, "Ia"
-                ,defaultValue = 4000
-                ,regRange = zeroTo(0xFFF)
-                ,name = "OC_lim_o"
-                ,description = "Over-current (output) protection (A)"
-                ,transformation = Transformation(
-                    regToUser = lambda x : float((x - 2048)) * 40.95994
-                    ,userToReg = lambda x : (x * 40.95994) + 2048)))
-
-addReg(RegisterEditor(0x4,"Vb"
-                ,defaultValue = 0
-                ,regRange = zeroTo(0xFFF)
-                ,name = "Vs_under"
-                ,description = "under-voltage protection threshold (V)"
-                ,transformation = Transformation(
-                    regToUser=lambda x: float(x/128.189)
-                    ,userToReg=lambda x: (x *128*189))))
-
-addReg(RegisterEditor(0x6,"Vs"
-                ,defaultValue = 2047
-                ,regRange = zeroTo(0xFFF)
-                ,name = "Vs_over"
-                ,description = "over-voltage protection threshold (V)"
-                ,transformation = Transformation(
-                    regToUser=lambda x: float(x/128.189)
-                    ,userToReg=lambda x: (x *128*189))))
-
-addReg(RegisterEditor(0x24,"Te"
-                ,defaultValue = 1000
-                ,regRange = zeroTo(100000000)
-                ,name = "t_error"
-                ,description = "time before error detection (us)"
-                ,transformation = Transformation(
-                    regToUser=lambda x: float(x/100000)
-                    ,userToReg=lambda x: (x *100000))))
-
-addReg(RegisterEditor(0x51,"Ms"
-                ,defaultValue = 0
-                ,regRange = zeroTo(8)
-                ,name = "DISPLAYS: \n scope_mode"
-                ,description = "VGA_scope presets(0-8)"))
-
-addReg(RegisterEditor(0x14,"St"
-                ,defaultValue = 0
-                ,regRange = between(-2048, 2048)
-                ,name = "scp_thresh"
-                ,description = "Threshold for VGA-oscilloscope"))
-
-addReg(RegisterEditor(0xEF,"D"
-                ,defaultValue = 11
-                ,regRange = zeroTo(15)
-                ,name = "disp_set"
-                ,description = "data switch for 7-segment display"))
-
-for reg in registers.values():
-    frame = Frame(user_interface)
-    reg.draw(frame)
-    frame.pack()
+            return regValue
+        return None
+
+    def command(self):
+        """
+        Returns the command for the value in the entry, None if there is no valid value
+        """
+        regValue = self.value()
+        if regValue is not None:
+            return self.register.command(regValue)
+        return None
+
+    def write(self):
+        """
+        Write the entry even if the shadow says the controller holds that value already
+        """
+        regValue = self.value()
+        if regValue is not None:
+            applyProfile({self.identification: regValue}, force=True)
+
 
 class DisplayCompositor:
+    """
+    Label with one value of a column: the latest one, or with statistic= one of
+    channelstats.STATISTICS (e.g. 'mean', 'peak', 'latched'). Statistics are in the units
+    of the channel table, the transformations only apply to the latest value.
+    The column may be a channel name (e.g. "power"), named channels are in user units;
+    the name is resolved once per layout of the rows, see bind().
+    """
     def __init__(self, parent
             ,identification
             ,column
             ,formatType="{0}"
-            ,transformations=[]
+            ,transformations=None
             ,side=LEFT
             ,fill=X
             ,**kwarfs):
         self.identification = identification
         self.column = column
         self.formatType = formatType
-        self.transformations = transformations
+        self.transformations = ChannelTransform.wrap(transformations)
+        self.device = kwarfs.get('device')
+        self.statistic = kwarfs.get('statistic')
+        self.layout = None
+        self.bound = None
+        self.drawn_cursor = None
+        self.text = ""
+        self.var = None
+        if parent is None:
+            return
         self.var = StringVar()
         self.frame = Frame(parent)
         self.labelId = Label(self.frame, text=identification)
@@ -519,11 +148,34 @@ class DisplayCompositor:
         self.labelData.pack(side=LEFT)
         self.frame.pack(side=side, fill=X, padx=80)
 
-    def draw(self, data):
+    def draw(self, data, statistics=None):
         """
-        Fill the display with latest available value.
+        Fill the display with latest available value, or its statistic from `statistics`
+        (a ChannelStatistics).
+        Accepts a raw block or a ChannelBlock shared with the other figures and displays.
         """
-        self.var.set(self.formatType.format(self.transformations(data[-1, self.column])))
+        if not isinstance(data, ChannelBlock):
+            data = ChannelBlock(data)
+        if self.layout is not data.names:
+            self.bind(data.names, data.table)
+        column, transform = self.bound
+        if self.statistic is not None and statistics is not None:
+            value = statistics.value(self.statistic, column)
+        else:
+            value = data.value(column, transform)
+        text = self.formatType.format(value)
+        if text == self.text:
+            return
+        self.text = text
+        if self.var is not None:
+            self.var.set(self.text)
+
+    def bind(self, names, table=None):
+        """
+        Resolve the column for rows laid out as `names`, see ChannelBlock.resolve
+        """
+        self.bound = ChannelBlock.resolve(self.column, self.transformations, names, table)
+        self.layout = names
 
     def getDisId(self):
         return self.identification
@@ -537,20 +189,6 @@ class DisplayCompositor:
             logging.debug("added display")
         return newDisplay
 
-displays = {}
-DisplayCompositor.addDisplay(displays, DisplayCompositor(bottom_displays
-                            ,"MOSFETS temperature: "
-                            ,4
-                            ,formatType="{0:.1f} [degrees Celcius]"
-                            ,transformations=lambda x:float(x-1940)/3.853
-                            ))
-
-DisplayCompositor.addDisplay(displays, DisplayCompositor(bottom_displays
-                            ,"Errors: "
-                            ,14
-                            ,formatType="{0:b}"
-                            ,transformations=lambda x:int(x)
-                            ))
 
 class FigureCompositor:
     def __init__(self, parent
@@ -558,7 +196,6 @@ class FigureCompositor:
             ,columns
             ,ylabel = [""]
             ,transformations=[]
-            ,cross=False
             ,legend=False
             ,figsize=(9,3)
             ,dpi=100
@@ -566,56 +203,102 @@ class FigureCompositor:
             ,fill=BOTH
             ,**kwargs):
         self.identification = identification
-        self.transformations = transformations
         if isinstance(columns, list) and isinstance(transformations, list):
             self.columns = columns
             if len(transformations) == 0:
-                for item in range(len(columns)):
-                    self.transformations.append(lambda x : x)
+                transformations = [IDENTITY] * len(columns)
+        self.transformations = [ChannelTransform.wrap(item) for item in transformations]
         self.figure = plt.Figure(figsize=figsize, dpi=dpi)
         self.ax = self.figure.add_subplot(111)
         self.ylabel=ylabel
         self.legend = legend
-        self.cross = cross
 
-        self.filter = None
         self.ylimits = None
+        self.span = None
+        self.pixels = int(figsize[0] * dpi)
+        self.cursor = None
+        self.blit = False
+        self.lines = []
+        self.background = None
+        self.frame_times = deque(maxlen=100)
+        self.metric = "draw." + identification
+        self.drawn_cursor = None
+        self.drawn_at = 0.0
+        self.device = None
+        self.layout = None
+        self.bound = None
         if kwargs is not None:
             for key, value in kwargs.items():
-                if key == 'filters':
-                    self.filter = value
+                if key == 'device':
+                    self.device = value
+                if key == 'blit':
+                    self.blit = value
+                if key == 'span':
+                    self.span = value
                 if key == 'ylimits':
                     if isinstance(value, tuple) and len(value) == 2:
                         self.ylimits = value
 
-        self.canvas = FigureCanvasTkAgg(self.figure, parent)
-        self.canvas.get_tk_widget().pack(side=side, fill=fill)
+        if parent is None:
+            self.canvas = FigureCanvasAgg(self.figure)
+        else:
+            self.canvas = FigureCanvasTkAgg(self.figure, parent)
+            self.canvas.get_tk_widget().pack(side=side, fill=fill)
+        self.canvas.mpl_connect('draw_event', self.onDraw)
         #self.canvas.draw()
 
-    def draw(self, data):
+    def draw(self, data, cursor=None, x=None, decimated=False):
         """
-        Fill the figure with data.
+        Fill the figure with data, a raw block or a ChannelBlock shared with the other figures.
+        Filtered channels are computed by the pipeline, see pipeline.filtered_channels.
+        x positions the rows, e.g. the row offsets of a span from HistoryStore.window;
+        decimated (min/max) rows are drawn as an envelope.
         """
-        self.ax.clear()
-        x_items = list(range(0, data.shape[0]))
-
-        #Apply transformations and filtering
-        dummy = []
-        for counter, column in enumerate(self.columns):
-            dummy.append(list(map(self.transformations[counter], data[:, column])))
-            if self.filter is not None:
-                if isinstance(self.filter, list):
-                    try:
-                        self.filter[counter]
-                    except IndexError:
-                        continue
-                    dummy[counter] = self.filter[counter].butter_lowpass_filter(dummy[counter])
-
+        start = time.perf_counter()
+        x_items, dummy = self.series(data, cursor, x, decimated)
+        if self.blit:
+            self.drawBlit(x_items, dummy)
         else:
-            if self.cross:
-                #FIXME: assumes just 2 columns
-                dummy.append([item[0]*item[1] for item in zip(dummy[0], dummy[1])])
+            self.drawFull(x_items, dummy)
+        elapsed = time.perf_counter() - start
+        self.frame_times.append(elapsed)
+        metrics.observe(self.metric, elapsed)
+
+    def series(self, data, cursor=None, x=None, decimated=False):
+        """
+        Apply transformations, returns the x items and one series per line.
+        Columns given by name (e.g. "power", see pipeline.derived_channels) are taken in
+        user units as they come, without transformation.
+        """
+        self.cursor = None if decimated else cursor
+        if not isinstance(data, ChannelBlock):
+            data = ChannelBlock(data)
+        x_items = np.arange(data.shape[0]) if x is None else x
+        dummy = [data.column(column, transform) for column, transform in self.resolved(data)]
+        return x_items, dummy
+
+    def bind(self, names, table=None):
+        """
+        Resolve the column names for rows laid out as `names` once, instead of on every
+        draw; a Data hands out the same names until its channels change.
+        """
+        self.bound = [ChannelBlock.resolve(column, transform, names, table)
+                      for column, transform in zip(self.columns, self.transformations)]
+        self.layout = names
+
+    def resolved(self, data):
+        """
+        (column, transform) of every line for the rows of a ChannelBlock
+        """
+        if self.layout is not data.names:
+            self.bind(data.names, data.table)
+        return self.bound
 
+    def drawFull(self, x_items, dummy):
+        """
+        Clear the axes and redraw lines and decorations from scratch
+        """
+        self.ax.clear()
         for index in range(len(dummy)):
             self.ax.plot(x_items, dummy[index])
         else:
@@ -625,7 +308,120 @@ class FigureCompositor:
             if self.ylimits is not None:
                 self.ax.set_ylim([self.ylimits[0], self.ylimits[1]])
             self.ax.set_title(self.identification)
+            self.decorate()
+            self.canvas.draw()
+
+    def decorate(self):
+        """
+        Hook for extra decorations of a full redraw
+        """
+        pass
+
+    def drawBlit(self, x_items, dummy):
+        """
+        Update the persistent lines and blit the axes region against the cached background.
+        Lines and decorations are only (re)created when the number of lines or samples changes,
+        a full redraw is only done when the data leaves the current y-limits.
+        """
+        if len(self.lines) != len(dummy) or len(self.lines[0].get_xdata()) != len(x_items) \
+                or self.widened(x_items):
+            self.setupBlit(x_items, dummy)
+        else:
+            for line, values in zip(self.lines, dummy):
+                line.set_data(x_items, values)
+        if self.ylimits is None and self.rescale(dummy):
+            self.canvas.draw()
+            return
+        if self.background is None:
             self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.canvas.blit(self.ax.bbox)
+
+    def setupBlit(self, x_items, dummy):
+        self.ax.clear()
+        self.lines = [self.ax.plot(x_items, values, animated=True)[0] for values in dummy]
+        if self.legend:
+            self.ax.legend(self.lines, self.ylabel)
+        self.ax.grid()
+        finite = x_items[np.isfinite(x_items)]
+        if finite.size > 1 and finite[-1] > finite[0]:
+            self.ax.set_xlim(finite[0], finite[-1])
+        if self.ylimits is not None:
+            self.ax.set_ylim([self.ylimits[0], self.ylimits[1]])
+        self.ax.set_title(self.identification)
+        self.background = None
+
+    def widened(self, x_items):
+        """
+        Whether the x items reach out of the x-limits, e.g. while the window fills up or
+        the measured sample rate drops
+        """
+        finite = x_items[np.isfinite(x_items)]
+        if finite.size == 0:
+            return False
+        left, right = self.ax.get_xlim()
+        return finite[0] < left - 0.02 * (right - left)
+
+    def rescale(self, dummy):
+        """
+        Widen the y-limits when the data leaves them
+        """
+        low = min(np.min(values) for values in dummy)
+        high = max(np.max(values) for values in dummy)
+        if not (np.isfinite(low) and np.isfinite(high)):
+            return False
+        bottom, top = self.ax.get_ylim()
+        if low >= bottom and high <= top:
+            return False
+        margin = 0.1 * (high - low) if high > low else 1.0
+        self.ax.set_ylim(low - margin, high + margin)
+        return True
+
+    def onDraw(self, event):
+        """
+        Cache the background (everything but the animated lines) after every full draw,
+        which includes resizes of the window
+        """
+        if not self.blit or len(self.lines) == 0:
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.canvas.blit(self.ax.bbox)
+
+    def visible(self):
+        """
+        False while the canvas is not on screen, e.g. the window is iconified
+        """
+        if not hasattr(self.canvas, 'get_tk_widget'):
+            return True
+        return bool(self.canvas.get_tk_widget().winfo_viewable())
+
+    def due(self, cursor, now, hidden_interval):
+        """
+        Whether a frame ending at `cursor` would change the figure: a span figure waits for
+        at least one pixel worth of new rows, a hidden figure for `hidden_interval` seconds.
+        """
+        if cursor == self.drawn_cursor:
+            return False
+        if self.span is not None and self.drawn_cursor is not None \
+                and cursor - self.drawn_cursor < self.span / self.pixels:
+            return False
+        if now - self.drawn_at < hidden_interval and not self.visible():
+            return False
+        return True
+
+    def frameStats(self):
+        """
+        Returns (ms per frame, frames per second) averaged over the latest draws
+        """
+        if len(self.frame_times) == 0:
+            return (0.0, 0.0)
+        mean = sum(self.frame_times) / len(self.frame_times)
+        return (mean * 1000, 1 / mean if mean > 0 else 0.0)
 
     def getFigId(self):
         return self.identification
@@ -639,57 +435,420 @@ class FigureCompositor:
         return newFigure
 
 
-figures = {}
-FigureCompositor.addFigure(figures, FigureCompositor(upper_visuals
-                           ,"current/voltage/power"
-                           ,[1,0]
-                           ,transformations=[lambda x: float(x - 2048)/40.95, lambda x: float(x/128.189)]
-                           ,ylabel=["current [A]", "voltage [V]", "power [W]"]
-                           ,legend=True
-                           ,cross=True
-                           ,filters=[Filter(3,150)]
-                           ))
-
-FigureCompositor.addFigure(figures, FigureCompositor(upper_visuals
-                           ,"thrust"
-                           ,[2]
-                           ,ylabel=["Thrust [g]"]
-                           ,filters=[Filter(10,150)]
-                           ,ylimits=(0,1500)
-                           ,legend=True
-                           ))
-
-FigureCompositor.addFigure(figures, FigureCompositor(lower_visuals
-                          ,"current"
-                           ,[1,1]
-                           ,transformations=[lambda x: float(x - 2048)/40.95,lambda x: float(x - 2048)/40.95]
-                           ,ylabel=["filtered current [A]", "raw current[A]"]
-                           ,legend=True
-                           ,filters=[Filter(3, 150)]
-                           ,ylimits=(-1,1)
-                           ))
-
-FigureCompositor.addFigure(figures, FigureCompositor(lower_visuals
-                           ,"rpm"
-                           ,[3]
-                           ,ylabel=["rpm [1/min]"]
-                           ,legend=True
-                           ,ylimits=(0, 30000)
-                           ,))
-
-def visualsUpdateCallback(*args):
-    """
-    Uses 2 globals: figures map and threadMessage instance
-    """
-    for key, value in figures.items():
-        value.draw(threadMessage.readBuffer())
-    for key, value in displays.items():
-        value.draw(threadMessage.readBuffer())
-
-root.bind("<<GeneratePlots>>", visualsUpdateCallback)
+class SpectrumCompositor(FigureCompositor):
+    """
+    Running Welch PSD of the columns in dB over frequency, see spectrum.WelchPSD. With
+    waterfall=N the figure shows the newest N spectra of the first column as an image.
+    Only the rows that arrived since the previous frame are fed, which needs the write
+    cursor; when more rows arrived than the window holds, the pending segment restarts
+    instead of stitching over the gap. Nothing is redrawn until another segment completed.
+    """
+    def __init__(self, parent, identification, columns, segment=256, overlap=0.5, fs=150.0, average=16,
+                 waterfall=0, **kwargs):
+        FigureCompositor.__init__(self, parent, identification, columns, **kwargs)
+        self.psd = WelchPSD(len(self.columns), segment, overlap, fs, average=average, waterfall=waterfall)
+        self.image = None
+        self.drawn_segments = 0
+        self.figure.subplots_adjust(bottom=0.18)
+
+    def series(self, data, cursor=None, x=None, decimated=False):
+        fresh = data.shape[0]
+        if cursor is not None and self.cursor is not None:
+            fresh = cursor - self.cursor
+            if fresh > data.shape[0]:
+                self.psd.reset()
+                fresh = data.shape[0]
+        self.cursor = cursor
+        if not isinstance(data, ChannelBlock):
+            data = ChannelBlock(data)
+        if fresh > 0:
+            self.psd.feed(np.column_stack([data.column(column, transformation)[-fresh:]
+                                           for column, transformation in self.resolved(data)]))
+        decibels = self.psd.decibels()
+        return self.psd.frequencies, [decibels[:, index] for index in range(len(self.columns))]
+
+    def drawFull(self, x_items, dummy):
+        if self.psd.segments == self.drawn_segments:
+            return
+        self.drawn_segments = self.psd.segments
+        if self.psd.waterfall is not None:
+            return self.drawWaterfall()
+        FigureCompositor.drawFull(self, x_items, dummy)
+        self.ax.set_xlabel("frequency [Hz]")
+
+    def drawBlit(self, x_items, dummy):
+        if self.psd.segments == self.drawn_segments:
+            return
+        self.drawn_segments = self.psd.segments
+        if self.psd.waterfall is not None:
+            return self.drawWaterfall()
+        FigureCompositor.drawBlit(self, x_items, dummy)
+
+    def setupBlit(self, x_items, dummy):
+        FigureCompositor.setupBlit(self, x_items, dummy)
+        self.ax.set_xlabel("frequency [Hz]")
+        self.ax.set_ylabel("PSD [dB]")
+
+    def drawWaterfall(self):
+        """
+        Image of the waterfall ring, newest spectrum on top; the image keeps the size of
+        the ring, rows that were not filled yet stay empty
+        """
+        spectra = self.psd.spectrogram(0)
+        if spectra.shape[0] == 0:
+            return
+        ring = self.psd.waterfall
+        image = np.full((ring.capacity, self.psd.frequencies.size), np.nan)
+        image[ring.capacity - spectra.shape[0]:] = spectra
+        low, high = np.percentile(spectra, 5), spectra.max()
+        if self.image is None:
+            self.ax.clear()
+            seconds = ring.capacity * self.psd.step / self.psd.fs
+            self.image = self.ax.imshow(image, aspect='auto', origin='lower', interpolation='nearest',
+                                        extent=(0, self.psd.fs / 2, -seconds, 0), animated=self.blit)
+            self.ax.set_xlabel("frequency [Hz]")
+            self.ax.set_ylabel("seconds")
+            self.ax.set_title(self.identification)
+            self.lines = [self.image]
+            self.background = None
+        self.image.set_data(image)
+        self.image.set_clim(low, max(high, low + 1))
+        if not self.blit or self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.image)
+        self.canvas.blit(self.ax.bbox)
+
+
+class CaptureCompositor(FigureCompositor):
+    """
+    The latest capture of a TriggeredCapture (`capture`) with the trigger row at x = 0,
+    redrawn only when another capture completed or it was frozen or unfrozen.
+    """
+    def __init__(self, parent, identification, columns, capture=None, **kwargs):
+        FigureCompositor.__init__(self, parent, identification, columns, **kwargs)
+        self.capture = capture
+        self.drawn_number = None
+        self.drawn_frozen = False
+
+    def due(self, cursor, now, hidden_interval):
+        latest = self.capture.latest if self.capture is not None else None
+        return latest is not None and (latest.number, self.capture.frozen) != (self.drawn_number, self.drawn_frozen)
+
+    def draw(self, data, cursor=None, x=None, decimated=False):
+        latest = self.capture.latest
+        self.drawn_number = latest.number
+        self.drawn_frozen = self.capture.frozen
+        names = data.names if isinstance(data, ChannelBlock) else None
+        FigureCompositor.draw(self, ChannelBlock(latest.rows, channels, names), None, latest.x())
+
+    def decorate(self):
+        latest = self.capture.latest
+        self.ax.axvline(0, color='k', linewidth=0.8, linestyle='--')
+        self.ax.set_title("{0} #{1}{2}{3}".format(self.identification, latest.number,
+                                                  " (auto)" if latest.forced else "",
+                                                  " frozen" if self.capture.frozen else ""))
+
+
+def createDisplays(parent=None):
+    """
+    The displays under the plots, without a parent they are not shown (benchmarks, tests)
+    """
+    displays = {}
+    DisplayCompositor.addDisplay(displays, DisplayCompositor(parent
+                                ,"MOSFETS temperature: "
+                                ,"temperature"
+                                ,formatType="{0:.1f} [degrees Celcius]"
+                                ,statistic='mean'
+                                ))
+
+    DisplayCompositor.addDisplay(displays, DisplayCompositor(parent
+                                ,"peak: "
+                                ,"temperature"
+                                ,formatType="{0:.1f} [degrees Celcius]"
+                                ,statistic='peak'
+                                ))
+
+    DisplayCompositor.addDisplay(displays, DisplayCompositor(parent
+                                ,"current rms: "
+                                ,"current"
+                                ,formatType="{0:.2f} [A]"
+                                ,statistic='rms'
+                                ))
+
+    DisplayCompositor.addDisplay(displays, DisplayCompositor(parent
+                                ,"power: "
+                                ,"power"
+                                ,formatType="{0:.1f} [W]"
+                                ,statistic='mean'
+                                ))
+
+    DisplayCompositor.addDisplay(displays, DisplayCompositor(parent
+                                ,"energy: "
+                                ,"energy"
+                                ,formatType="{0:.3f} [Wh]"
+                                ))
+
+    DisplayCompositor.addDisplay(displays, DisplayCompositor(parent
+                                ,"Errors: "
+                                ,error_columns[0]
+                                ,formatType="{0:b}"
+                                ,transformations=ERRORS
+                                ,statistic='latched'
+                                ))
+
+    return displays
+
+def createFigures(upper=None, lower=None):
+    """
+    The four figures, drawn into an off-screen canvas when upper/lower are None.
+    Power and the filtered channels are derived channels of the pipeline, computed once
+    per block for all figures, see pipeline.derived_channels and filtered_channels.
+    """
+    figures = {}
+    FigureCompositor.addFigure(figures, FigureCompositor(upper
+                               ,"current/voltage/power"
+                               ,["current_filtered", "voltage", "power"]
+                               ,ylabel=["current [A]", "voltage [V]", "power [W]"]
+                               ,legend=True
+                               ,blit=True
+                               ))
+
+    FigureCompositor.addFigure(figures, FigureCompositor(upper
+                               ,"thrust"
+                               ,["thrust_filtered"]
+                               ,ylabel=["Thrust [g]"]
+                               ,ylimits=(0,1500)
+                               ,legend=True
+                               ,blit=True
+                               ))
+
+    FigureCompositor.addFigure(figures, FigureCompositor(lower
+                              ,"current"
+                               ,["current_filtered", "current"]
+                               ,ylabel=["filtered current [A]", "raw current[A]"]
+                               ,legend=True
+                               ,ylimits=(-1,1)
+                               ,blit=True
+                               ))
+
+    FigureCompositor.addFigure(figures, FigureCompositor(lower
+                               ,"rpm"
+                               ,["rpm"]
+                               ,ylabel=["rpm [1/min]"]
+                               ,legend=True
+                               ,ylimits=(0, 30000)
+                               ,blit=True
+                               ))
+    return figures
+
+def createSpectra(parent=None, fs=pipeline.SAMPLE_RATE):
+    """
+    Spectrum and waterfall figures for tuning the control loops, off-screen without a parent;
+    fs is the nominal sample rate, the SampleClock of the Data checks it
+    """
+    figures = {}
+    FigureCompositor.addFigure(figures, SpectrumCompositor(parent
+                               ,"spectrum"
+                               ,["thrust", "current", "rpm"]
+                               ,fs=fs
+                               ,ylabel=["thrust", "current", "rpm"]
+                               ,legend=True
+                               ,blit=True
+                               ))
+
+    FigureCompositor.addFigure(figures, SpectrumCompositor(parent
+                               ,"current waterfall"
+                               ,["current"]
+                               ,fs=fs
+                               ,waterfall=128
+                               ,blit=True
+                               ))
+    return figures
+
+def createCaptureFigures(capture, parent=None):
+    """
+    The figure of the triggered captures
+    """
+    figures = {}
+    FigureCompositor.addFigure(figures, CaptureCompositor(parent
+                               ,"capture"
+                               ,["current", "voltage"]
+                               ,capture=capture
+                               ,ylabel=["current [A]", "voltage [V]"]
+                               ,legend=True
+                               ))
+    return figures
+
+class RenderScheduler:
+    """
+    Redraws figures and displays from the Tk event loop at up to `fps` frames per second.
+    Every frame polls the write cursors and, when rows arrived, takes one snapshot per
+    source that all figures and displays bound to it share; the acquisition threads never
+    call into Tk. A figure or display with a `device` reads devices[device] (a
+    ThreadMessage), the others read `threadMessage`.
+    Frames stay on a fixed grid: a frame that overruns its period drops the frames it ran
+    into instead of queueing them, the next one simply shows the newest rows.
+    Figures that are not on screen are drawn every `hidden_interval` seconds, see
+    FigureCompositor.due. The x axis is the host time of the rows in seconds before the
+    newest one, see Data.timeAxis; a gap in the data is a gap in the lines.
+    """
+    def __init__(self, threadMessage, figures, displays, fps=30, hidden_interval=1.0):
+        self.threadMessage = threadMessage
+        self.devices = {}
+        self.figures = figures
+        self.displays = displays
+        self.period = 1.0 / fps
+        self.hidden_interval = hidden_interval
+        self.deadline = None
+        self.root = None
+        self.pending = None
+
+    def start(self, root):
+        self.root = root
+        self.deadline = time.perf_counter()
+        self.tick()
+        return self
+
+    def stop(self):
+        if self.pending is not None:
+            self.root.after_cancel(self.pending)
+            self.pending = None
+
+    def tick(self):
+        self.frame()
+        now = time.perf_counter()
+        self.deadline += self.period
+        if now > self.deadline:
+            skipped = int((now - self.deadline) / self.period) + 1
+            self.deadline += skipped * self.period
+            metrics.count('frames_skipped', skipped)
+        self.pending = self.root.after(max(1, int(1000 * (self.deadline - now))), self.tick)
+
+    def source(self, device):
+        return self.threadMessage if device is None else self.devices[device]
+
+    def snapshot(self, snapshots, device):
+        """
+        Write cursor, ChannelBlock and time axis of the newest window of a source, taken
+        once per frame
+        """
+        if device not in snapshots:
+            source = self.source(device)
+            cursor, window = source.readSnapshot()
+            snapshots[device] = (cursor, ChannelBlock(window, channels, source.data.names()),
+                                 source.data.timeAxis(cursor, window.shape[0]))
+        return snapshots[device]
+
+    def frame(self):
+        """
+        Draw whatever is due, returns the number of figures drawn
+        """
+        start = time.perf_counter()
+        for threadMessage in [self.threadMessage] + list(self.devices.values()):
+            if threadMessage.data.shared:
+                threadMessage.data.catchUp()
+        snapshots = {}
+        drawn = 0
+        for figure in self.figures.values():
+            threadMessage = self.source(figure.device)
+            if not figure.due(threadMessage.data.ring.write_cursor, start, self.hidden_interval):
+                continue
+            cursor, block, x = self.snapshot(snapshots, figure.device)
+            if figure.span is None:
+                figure.draw(block, cursor, x)
+            else:
+                x, rows, decimated = threadMessage.readSpan(figure.span, figure.pixels)
+                # row offsets at the measured sample rate
+                x = x / threadMessage.data.clock.rate()
+                figure.draw(ChannelBlock(rows, channels, block.names), None if decimated else cursor, x, decimated)
+            figure.drawn_cursor = cursor
+            figure.drawn_at = start
+            drawn += 1
+        for display in self.displays.values():
+            if self.source(display.device).data.ring.write_cursor == display.drawn_cursor:
+                continue
+            display.drawn_cursor, block, _ = self.snapshot(snapshots, display.device)
+            display.draw(block, self.source(display.device).data.stats)
+        if snapshots:
+            metrics.count('frames')
+            metrics.observe('frame', time.perf_counter() - start)
+        return drawn
+
+
+class StatusPanel:
+    """
+    Compact pipeline health line under the plots, refreshed from the metrics every
+    `interval` ms: throughput, rejected lines, ring wraps and overruns, dropped recorder
+    rows, the measured sample rate, its jitter and the gaps, the render frame time and
+    skipped frames and the draw time of every figure.
+    `prefixes` are those of the metrics of the acquired devices (see devices.Device): the
+    counts are summed over them, the sample clock is shown per device.
+    """
+    def __init__(self, parent, metrics, interval=500, prefixes=("",)):
+        self.metrics = metrics
+        self.interval = interval
+        self.prefixes = list(prefixes)
+        self.var = StringVar()
+        self.label = Label(parent, textvariable=self.var, justify=LEFT, font=("TkFixedFont", 9))
+        self.label.pack(side=TOP, fill=X)
+
+    def format(self, snapshot):
+        values = dict(snapshot["counters"])
+        values.update(snapshot["gauges"])
+        histograms = snapshot["histograms"]
+        devices = [scoped(snapshot, prefix) for prefix in self.prefixes]
+        total = lambda name: sum(device[0].get(name, 0) for device in devices)
+        rate = lambda name: sum(device[1].get(name, 0.0) for device in devices)
+        first = "rows/s {0:8.0f}   bytes/s {1:9.0f}   rejected {2:6d}   wraps {3:6d}   overruns {4:6d}   dropped {5:6d}".format(
+            rate('rows'), rate('bytes_read'), total('lines_rejected'),
+            total('ring_wraps'), total('ring_overruns'), total('recorder_dropped_rows'))
+        for prefix, (clock, _) in zip(self.prefixes, devices):
+            first += "\n{0}fs {1:7.1f} Hz   jitter {2:6.2f} ms   gaps {3:5d}   missing {4:6d}   rejected rows {5:6d}".format(
+                prefix[:-1] + ": " if prefix else "", clock.get('sample_rate', 0.0), clock.get('sample_jitter_ms', 0.0),
+                clock.get('gaps', 0), clock.get('missing_rows', 0), clock.get('rejected_rows', 0))
+        rates = snapshot["rates"]
+        frame = histograms.get('frame')
+        second = "frame p50/p95 {0:.1f}/{1:.1f} ms".format(frame["p50"], frame["p95"]) if frame else "frame -"
+        second += "   fps {0:4.1f}   skipped {1:5d}".format(rates.get('frames', 0.0), values.get('frames_skipped', 0))
+        draws = ["{0} {1:.1f}".format(name[len("draw."):], histogram["mean"])
+                 for name, histogram in sorted(histograms.items()) if name.startswith("draw.")]
+        if draws:
+            second += "   draw ms: " + ", ".join(draws)
+        return first + "\n" + second
+
+    def update(self):
+        if self.metrics.enabled:
+            self.var.set(self.format(self.metrics.snapshot(reader="panel")))
+        else:
+            self.var.set("instrumentation disabled")
+        root.after(self.interval, self.update)
+
 
 def restoreDefaults():
     serialCommander.writeCommand("R\n")
+    registerCache.restoreDefaults()
+
+def clearPeaks():
+    """
+    Release the peak-hold and the latched error bits of the displays
+    """
+    threadMessage.data.stats.release()
+    for device in renderScheduler.devices.values():
+        device.data.stats.release()
+    content_text.insert(INSERT, "[PEAKS CLEARED]\n")
+
+def armCapture(capture):
+    capture.arm()
+    content_text.insert(INSERT, "[TRIGGER ARMED]\n")
+
+def freezeCapture(capture):
+    """
+    Keep the shown capture for inspection, or follow the new captures again
+    """
+    capture.freeze(not capture.frozen)
+    content_text.insert(INSERT, "[CAPTURE FROZEN]\n" if capture.frozen else "[CAPTURE FOLLOWING]\n")
 
 def resetSystem():
     serialCommander.writeCommand("X\n")
@@ -700,20 +859,295 @@ def standbySystem():
 def armSystem():
     serialCommander.writeCommand("Z\n")
 
-Button(user_interface,text = "restore defaults",command = restoreDefaults).pack(side=BOTTOM)
-Button(user_interface,text = "reset",command = resetSystem).pack(side=BOTTOM)
-Button(user_interface,text = "standby",command = standbySystem).pack(side=BOTTOM)
-Button(user_interface,text = "arm",command = armSystem).pack(side=BOTTOM)
+CAPTURE_PREFIX = "captures/capture"
+
+def captureMetadata(derived=None):
+    """
+    Column layout and register values at the start of a recording, from the register
+    shadow and the entries of the editors, with the derived channels of `derived` for rows
+    that carry them
+    """
+    return pipeline.captureMetadata(registerCache, derived,
+                                    {editor.identification: editor.entry.get() for editor in editors.values()})
+
+def startRecording():
+    serialCommander.threadProducer.startRecording(CAPTURE_PREFIX, captureMetadata())
+    content_text.insert(INSERT, "[RECORDING STARTED]\n")
 
-content_text.pack(expand='yes', fill='both')
-scroll_bar = Scrollbar(content_text)
-content_text.configure(yscrollcommand=scroll_bar.set)
-scroll_bar.config(command=content_text.yview)
-scroll_bar.pack(side='right', fill='y')
+def stopRecording():
+    serialCommander.threadProducer.stopRecording()
+    content_text.insert(INSERT, "[RECORDING STOPPED]\n")
+
+def applyProfile(profile, units='user', force=False):
+    """
+    Validate a whole profile first, then write the registers that differ from the
+    shadow (all of them with force) as one back-to-back batch
+    """
+    try:
+        changes = registerCache.apply(profile, serialCommander.writeCommands, units, force)
+    except ValueError as error:
+        content_text.insert(INSERT, "[INVALID]: " + str(error) + "\n")
+        return None
+    if not changes:
+        content_text.insert(INSERT, "[UNCHANGED]: nothing to write\n")
+    return changes
+
+def writeAllRegisters():
+    """
+    Write every register with a changed value in its entry as one back-to-back batch
+    """
+    values = {editor.identification: editor.value() for editor in editors.values()}
+    applyProfile({key: value for key, value in values.items() if value is not None})
+
+def saveRegisterProfile():
+    path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("register profile", "*.json")])
+    if path:
+        saveProfile(path, registerCache)
+        content_text.insert(INSERT, "[PROFILE SAVED]: " + path + "\n")
+
+def loadRegisterProfile():
+    path = filedialog.askopenfilename(filetypes=[("register profile", "*.json")])
+    if path:
+        values, units = loadProfile(path)
+        applyProfile(values, units)
+
+def dispatchRemote(publisher, interval=100):
+    """
+    Execute the commands of the publisher clients in the Tk thread, through the same path
+    as the buttons, every `interval` ms
+    """
+    publisher.dispatch(registerCache, serialCommander.writeCommands)
+    root.after(interval, dispatchRemote, publisher, interval)
+
+
+def configureChannels(data, filterings, derivations):
+    """
+    Add the --filter and --derive channels to a Data, filters first so expressions can use them
+    """
+    for filtering in filterings:
+        data.filter(*filtering)
+    for derivation in derivations:
+        data.derive(*derivation)
+
+def buildGui(fps=30, spectra=False, capture=None, fs=pipeline.SAMPLE_RATE):
+    """
+    Create the Tk window with register editors, figures, displays, status panel and buttons,
+    with spectra also a row with the spectrum and waterfall figures (for the nominal sample
+    rate fs), with a TriggeredCapture the capture figure and its buttons.
+    Nothing of the GUI exists before this is called.
+    """
+    global root, content_text, statusPanel, renderScheduler
+    root = Tk()
+    root.wm_title("Console tool")
+    user_interface = Frame(root)
+    user_interface.pack(side = LEFT)
+    visuals = Frame(root)
+    visuals.pack(side = RIGHT)
+
+    upper_visuals = Frame(visuals)
+    upper_visuals.pack(side=TOP)
+    lower_visuals = Frame(visuals)
+    lower_visuals.pack(side=TOP)
+    if spectra:
+        spectrum_visuals = Frame(visuals)
+        spectrum_visuals.pack(side=TOP)
+    if capture is not None:
+        capture_visuals = Frame(visuals)
+        capture_visuals.pack(side=TOP)
+    bottom_displays = Frame(visuals)
+    bottom_displays.pack(side=TOP)
+
+    content_text = Text(user_interface, wrap='word')
+
+    for register in registers.values():
+        editor = editors[register.getRegId()] = RegisterEditor(register)
+        frame = Frame(user_interface)
+        editor.draw(frame)
+        frame.pack()
+
+    displays.update(createDisplays(bottom_displays))
+    figures.update(createFigures(upper_visuals, lower_visuals))
+    if spectra:
+        figures.update(createSpectra(spectrum_visuals, fs))
+    if capture is not None:
+        figures.update(createCaptureFigures(capture, capture_visuals))
+    renderScheduler = RenderScheduler(threadMessage, figures, displays, fps)
+    statusPanel = StatusPanel(visuals, metrics)
+
+    Button(user_interface,text = "stop recording",command = stopRecording).pack(side=BOTTOM)
+    Button(user_interface,text = "record",command = startRecording).pack(side=BOTTOM)
+    Button(user_interface,text = "write all",command = writeAllRegisters).pack(side=BOTTOM)
+    Button(user_interface,text = "save profile",command = saveRegisterProfile).pack(side=BOTTOM)
+    Button(user_interface,text = "load profile",command = loadRegisterProfile).pack(side=BOTTOM)
+    Button(user_interface,text = "restore defaults",command = restoreDefaults).pack(side=BOTTOM)
+    if capture is not None:
+        Button(user_interface,text = "freeze capture",command = lambda: freezeCapture(capture)).pack(side=BOTTOM)
+        Button(user_interface,text = "re-arm trigger",command = lambda: armCapture(capture)).pack(side=BOTTOM)
+    Button(user_interface,text = "clear peaks",command = clearPeaks).pack(side=BOTTOM)
+    Button(user_interface,text = "reset",command = resetSystem).pack(side=BOTTOM)
+    Button(user_interface,text = "standby",command = standbySystem).pack(side=BOTTOM)
+    Button(user_interface,text = "arm",command = armSystem).pack(side=BOTTOM)
+
+    content_text.pack(expand='yes', fill='both')
+    scroll_bar = Scrollbar(content_text)
+    content_text.configure(yscrollcommand=scroll_bar.set)
+    scroll_bar.config(command=content_text.yview)
+    scroll_bar.pack(side='right', fill='y')
+    return root
 
 if __name__ == '__main__':
-    serialThread = Thread(target=SerialCommandConsumer(), name='serialCommander', args=(threadMessage,))
-    serialThread.start()
-    root.mainloop()
-    threadMessage.halt_thread = True
-    serialThread.join()
+    arguments = argparse.ArgumentParser(description="Console tool")
+    arguments.add_argument('--port', default=DEFAULT_PORT,
+                           help="serial device, pySerial URL (loop://, socket://host:port) or "
+                                "source URL (synthetic://?rate=1000, replay:///path/capture.cap?speed=4, pty+synthetic://)")
+    arguments.add_argument('--protocol', default='csv', choices=['csv', 'binary', 'auto'])
+    arguments.add_argument('--process', action='store_true', help="run the acquisition in a separate process")
+    arguments.add_argument('--no-metrics', action='store_true', help="disable the pipeline instrumentation")
+    arguments.add_argument('--metrics-export', default=None,
+                           help="append metric snapshots to this file or send them to udp://host:port")
+    arguments.add_argument('--metrics-interval', type=float, default=1.0, help="seconds between exported snapshots")
+    arguments.add_argument('--span', type=int, default=None,
+                           help="rows shown by the figures, long spans are drawn from min/max history levels")
+    arguments.add_argument('--device', action='append', default=[], metavar="NAME=PORT",
+                           help="acquire several devices, the first one gets the register editors and buttons")
+    arguments.add_argument('--bind', action='append', default=[], metavar="FIGURE=DEVICE",
+                           help="show a figure (or display) of another --device, e.g. rpm=rig2")
+    arguments.add_argument('--workers', type=int, default=1, help="threads reading the --device ports")
+    arguments.add_argument('--stats-window', type=int, default=150,
+                           help="rows of the mean, rms, min and max shown by the displays")
+    arguments.add_argument('--stats-alpha', type=float, default=0.05, help="weight of a new row in the ema")
+    arguments.add_argument('--peak-hold', type=int, default=None, metavar="ROWS",
+                           help="release the peak-hold every ROWS rows, default only with \"clear peaks\"")
+    arguments.add_argument('--spectrum', action='store_true', help="add the spectrum and waterfall figures")
+    arguments.add_argument('--trigger', default=None, metavar="COLUMN:KIND:VALUE",
+                           help="triggered capture, e.g. 14:mask:0xffff (any error bit) or 1:rising:5.5")
+    arguments.add_argument('--trigger-mode', default='normal', choices=MODES)
+    arguments.add_argument('--pre', type=int, default=1000, help="rows before the trigger")
+    arguments.add_argument('--post', type=int, default=1000, help="rows from the trigger on")
+    arguments.add_argument('--capture-prefix', default=None, help="write every capture to a file")
+    arguments.add_argument('--derive', action='append', default=[], metavar="NAME=EXPRESSION",
+                           help="add a derived channel, e.g. \"thrust_per_rpm=ratio(thrust, rpm)\"")
+    arguments.add_argument('--filter', action='append', default=[], metavar="NAME=CHANNEL:KIND:CUTOFF[:ORDER]",
+                           help="add a filtered channel, e.g. rpm_notch=rpm:notch:50 or current_hp=current:highpass:1")
+    arguments.add_argument('--fps', type=float, default=30, help="maximum frame rate of the figures")
+    arguments.add_argument('--readback', type=float, default=None, metavar="SECONDS",
+                           help="read the registers back into the shadow, a few every SECONDS")
+    arguments.add_argument('--fs', type=float, default=pipeline.SAMPLE_RATE,
+                           help="nominal sample rate in Hz the filters and spectra are designed for, "
+                                "a measured rate that deviates is logged")
+    arguments.add_argument('--publish', nargs='?', const=DEFAULT_ADDRESS, default=None, metavar="ADDRESS",
+                           help="serve the rows to local clients on tcp://HOST:PORT or unix:///PATH")
+    arguments.add_argument('--token-file', default=None,
+                           help="file with the secret that lets --publish clients send commands")
+    options = arguments.parse_args()
+    try:
+        devices = parseDevices(options.device)
+    except ValueError as error:
+        arguments.error(str(error))
+    if devices and options.process:
+        arguments.error("--device and --process do not go together")
+    if options.publish and options.process:
+        arguments.error("--publish needs the acquisition in this process")
+    metrics.enabled = not options.no_metrics
+    if options.fs != pipeline.SAMPLE_RATE:
+        threadMessage.data = Data(fs=options.fs)
+    try:
+        filterings = parseFilters(options.filter)
+        derivations = parseDerived(options.derive)
+        configureChannels(threadMessage.data, filterings, derivations)
+    except ValueError as error:
+        arguments.error(str(error))
+    capture = None
+    if options.trigger is not None:
+        try:
+            capture = TriggeredCapture(Trigger.parse(options.trigger, channels, threadMessage.data.names()),
+                                       options.pre, options.post, options.trigger_mode, prefix=options.capture_prefix)
+        except ValueError as error:
+            arguments.error(str(error))
+    buildGui(options.fps, options.spectrum, capture, options.fs)
+    if capture is not None:
+        # the register state when a capture is taken, the entries are left to the Tk thread
+        capture.metadata = lambda: pipeline.captureMetadata(registerCache, threadMessage.data.derived)
+    if options.span is not None:
+        for figure in figures.values():
+            figure.span = options.span
+    exporter = None
+    if options.metrics_export and metrics.enabled:
+        exporter = SnapshotExporter(metrics, options.metrics_export, options.metrics_interval).start()
+    manager = None
+    if devices:
+        manager = DeviceManager(options.workers)
+        for name, port in devices:
+            device = manager.add(name, port, options.protocol, fs=options.fs)
+            configureChannels(device.threadMessage.data, filterings, derivations)
+        primary = manager[devices[0][0]]
+        threadMessage = renderScheduler.threadMessage = primary.threadMessage
+        serialCommander.threadProducer = primary.producer
+        registerCache = primary.registers
+        renderScheduler.devices = {device.name: device.threadMessage for device in manager}
+        statusPanel.prefixes = [device.name + "." for device in manager]
+        for binding in options.bind:
+            key, _, name = binding.partition("=")
+            if name not in renderScheduler.devices:
+                arguments.error("--bind {0}: no device {1!r}".format(binding, name))
+            for compositor in list(figures.values()) + list(displays.values()):
+                if compositor.identification.strip().rstrip(":") == key:
+                    compositor.device = name
+    engine = None
+    if options.process:
+        engine = AcquisitionEngine(port=options.port, protocol=options.protocol,
+                                   metrics_target=options.metrics_export if metrics.enabled else None)
+        threadMessage.data = Data(ring=engine.start(), fs=options.fs)
+        configureChannels(threadMessage.data, filterings, derivations)
+        serialCommander.threadProducer = SerialCommandProducer(engine)
+    for source in [threadMessage] + list(renderScheduler.devices.values()):
+        source.data.stats = source.data.statistics(options.stats_window, alpha=options.stats_alpha,
+                                                   hold=options.peak_hold)
+    threadMessage.data.trigger = capture
+    publisher = None
+    if options.publish:
+        try:
+            publisher = Publisher(options.publish, pipeline.schema, pipeline.layoutMetadata(),
+                                  token=readToken(options.token_file) if options.token_file else None)
+            threadMessage.publisher = publisher.start()
+        except (ValueError, OSError) as error:
+            arguments.error("--publish: {0}".format(error))
+        dispatchRemote(publisher)
+    statusPanel.update()
+    renderScheduler.start(root)
+    if manager is not None:
+        poller = None
+        if options.readback is not None:
+            threadMessage.commands.acknowledge = readbackAcknowledge
+            poller = RegisterPoller(registerCache, threadMessage.writeBatch, options.readback).start()
+        manager.start()
+        root.mainloop()
+        if poller is not None:
+            poller.stop()
+        manager.stop()
+    elif engine is not None:
+        if options.readback is not None:
+            logging.warning("Register readback is not available with --process")
+        root.mainloop()
+        engine.stop()
+    else:
+        poller = None
+        if options.readback is not None:
+            threadMessage.commands.acknowledge = readbackAcknowledge
+            poller = RegisterPoller(registerCache, threadMessage.writeBatch, options.readback).start()
+        serialThread = Thread(target=SerialCommandConsumer(bulk=True, protocol=options.protocol, port=options.port),
+                              name='serialCommander', args=(threadMessage,))
+        serialThread.start()
+        root.mainloop()
+        if poller is not None:
+            poller.stop()
+        threadMessage.halt_thread = True
+        serialThread.join()
+        threadMessage.stopRecording()
+    if capture is not None:
+        capture.close()
+    if publisher is not None:
+        threadMessage.publisher = None
+        publisher.close()
+    if exporter is not None:
+        exporter.stop()
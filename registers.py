@@ -0,0 +1,570 @@
+import json
+import re
+import time
+from threading import Thread, Event
+
+from transforms import ChannelTransform
+
+# a register is read back by sending its identification followed by READ_SUFFIX, the
+# controller answers with the identification and the register value, e.g. "Sd61"
+READ_SUFFIX = "?"
+READBACK = re.compile(rb"^\s*([A-Za-z]+)\s*(-?\d+)\s*$")
+
+def UNLIMITED(val):
+    return True
+
+def between(a,b):
+    return lambda x: x in range(a,b)
+
+def zeroTo(until):
+    return lambda x: x in range(0,until)
+
+class Transformation:
+    """
+    Register value transformations. regToUser is applied through a ChannelTransform so it
+    also converts whole arrays of register values.
+    """
+    def __init__(self,regToUser = None,userToReg = None):
+        self.reg_to_user = None if regToUser is None else ChannelTransform.wrap(regToUser)
+        self.user_to_reg = userToReg
+    
+    def initRegToUser(self,fn):
+        self.reg_to_user = ChannelTransform.wrap(fn)
+        
+    def initUserToReg(self, fn):
+        self.user_to_reg = fn
+        
+    def transformRegToUser(self,value):
+        if self.reg_to_user == None:
+            return value
+        return self.reg_to_user(value)
+    
+    def transformUserToReg(self,value):
+        if self.user_to_reg == None:
+            return value
+        return self.user_to_reg(value)
+
+NO_TRANSFORMATION = Transformation()
+
+class Register:
+    """
+    Definition of a register of the controller: id, command identification, default value,
+    user/register value transformation and the valid range. Knows nothing about the GUI,
+    so scripts and the headless CLI can program registers with it.
+    """
+    def __init__(self,registerId, identification, 
+                 defaultValue = 0,
+                 transformation = NO_TRANSFORMATION,
+                 name = "NO NAME",
+                 regRange = UNLIMITED,
+                 description = "",
+                 writable = True,
+                 readable = True):
+        self.transformation = transformation
+        self.identification = identification
+        self.default_value = defaultValue
+        self.name = name
+        self.regRange = regRange
+        self.description = description
+        self.reg_id = registerId
+        self.writable = writable
+        self.readable = readable
+
+    def getRegId(self):
+        return self.reg_id
+  
+    def isWritable(self):
+        return self.writable
+    
+    def isReadable(self):
+        return self.readable
+
+    def toRegister(self, value):
+        """
+        Register value of the user value `value`
+        """
+        transformedRegValue = self.transformation.transformUserToReg(float(value))
+        return int(transformedRegValue)
+
+    def inRange(self, regValue):
+        return self.regRange(regValue)
+
+    def command(self, value):
+        """
+        Returns the command that writes the user value `value`
+        """
+        return self.writeCommand(self.toRegister(value))
+
+    def writeCommand(self, regValue):
+        """
+        Returns the command that writes the register value `regValue`
+        """
+        return self.identification + str(int(regValue)) + "\n"
+
+    def readCommand(self):
+        return self.identification + READ_SUFFIX + "\n"
+
+
+registers = {}
+
+def addReg(newRegister):
+    if newRegister.getRegId() in registers.keys():
+        raise Exception("Double definition of register") 
+    registers[newRegister.getRegId()] = newRegister
+    return newRegister
+
+addReg(Register(0x50,"Mc"
+                ,defaultValue = 0
+                ,regRange = zeroTo(8)
+                ,name = "OUTPUT CONTROL: \nctrl_mode"
+                ,description = "(0)=PWM; (1)=RPM; (2)=current; (3)=FOC"))
+
+addReg(Register(0xD, "Sd"
+                ,regRange = between(-2048,2047)
+                ,defaultValue = 0
+                ,name ="Id_setpoint"
+                ,description = "setpoint direct current (in FOC-mode)"#    -50.0 A to + 50.0 A        (value * 40.95994)
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(x / 40.95994),
+                    userToReg=lambda x: (x * 40.95994))))
+
+addReg(Register(0xE, "Sq"
+                ,regRange = between(-2048,2047)
+                ,defaultValue = 0
+                ,name ="Iq_setpoint"
+                ,description = "setpoint quadrature current (in FOC-mode)"#    -50.0 A to + 50.0 A        (value * 40.95994)
+
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(x / 40.95994),
+                    userToReg=lambda x: (x * 40.95994))))#temp RMS
+
+addReg(Register(0xF, "Sp"
+                ,regRange = zeroTo(2000)
+                ,defaultValue = 0
+                ,name ="PWM_setpoint"
+                ,description = "Set duty-cycle 0.0% to 100.0%"#    0.0 % to 100.0 %        value * 20
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(x) *20,
+                    userToReg=lambda x: (x * 20))))#temp RMS
+
+addReg(Register(0x13,"Sr"
+                ,regRange = between(-30000,30000)
+                ,defaultValue = 0
+                ,name ="RPM_setpoint"
+                ,description = "setpoint for RPM"))#    -30000 to 30000        value * 1
+
+addReg(Register(0x15,"Sf"
+                ,regRange = zeroTo(2000)
+                ,defaultValue = 1953
+                ,name ="ac_freq"
+                ,description = "Set frequency of the AC output"# 0.0% to 100.0% valye *20
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(97656 /x),
+                    userToReg=lambda x: (97656/x))))
+
+addReg(Register(0x20,"Td"
+                ,regRange = between(10,100)
+                ,defaultValue = 32
+                ,name ="dead_time"
+                ,description = "Set output dead time (ns)"
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(x*10),
+                    userToReg=lambda x: (x/10))))
+
+addReg(Register(0x22,"Ts"
+                ,regRange = zeroTo(10000)
+                ,defaultValue = 500
+                ,name ="slope"
+                ,description = "set PWM rate of change in % per us"
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(x) *1, #not defined yet
+                    userToReg=lambda x: (x*1))))
+
+addReg(Register(0x23,"Tp"
+                ,regRange = between(-1023, 1023)
+                ,defaultValue = 32
+                ,name ="phase_shift"
+                ,description = "set phase-shift in degrees"
+                ,transformation=Transformation(
+                    regToUser=lambda x: float(x) *0.3525625,
+                    userToReg=lambda x: (x/ 0.3525626))))
+
+addReg(Register(0xB, "Im"
+                ,regRange = zeroTo(0xFFF)
+                ,defaultValue = 0x800
+                ,name ="Imax"
+                ,description = "Max current in PID-loop output for current control"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float((x - 2048)) * 40.95994
+                    ,userToReg = lambda x : int((x * 40.95994) + 2048)))) 
+
+addReg(Register(0x30, "Lp"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 60
+                ,name ="CONTROL LOOPS: \n P_gain_0"
+                ,description = "Kp in RPM control-loop (0 to 10)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x / 20.47)
+                    ,userToReg = lambda x : (x * 20.47)))) 
+
+addReg(Register(0x31, "Li"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 40
+                ,name ="I_gain_0"
+                ,description = "Ki in RPM control-loop (0 to 10)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x / 20.47)
+                    ,userToReg = lambda x : (x * 20.47)))) 
+
+addReg(Register(0x32, "Ld"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 0
+                ,name ="d_gain_0"
+                ,description = "Kd in rpm control-loop (0 to 10)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x / 20.47)
+                    ,userToReg = lambda x : (x * 20.47)))) 
+                    
+addReg(Register(0x33, "Lf"
+                ,regRange = between(125, 6250000)
+                ,defaultValue = 62500
+                ,name ="PID_0_f"
+                ,description = "RPM control loop frequency (Hz)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(62500000 / x)
+                    ,userToReg = lambda x : (62500000/x)))) 
+
+addReg(Register(0x34, "Lq"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 60
+                ,name ="P_gain_1"
+                ,description = "Kp in current source control-loop (0 to 10)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x /20.47)
+                    ,userToReg = lambda x : (x *20.47)))) 
+
+addReg(Register(0x35, "Lr"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 40
+                ,name ="I_gain_1"
+                ,description = "Ki in current source control-loop (0 to 10)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x /20.47)
+                    ,userToReg = lambda x : (x *20.47)))) 
+
+addReg(Register(0x36, "Ls"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 0
+                ,name ="D_gain_1"
+                ,description = "Kd in current source control-loop (0 to 10)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x /20.47)
+                    ,userToReg = lambda x : (x *20.47)))) 
+
+addReg(Register(0x37, "Lg"
+                ,regRange = between(125, 6250000)
+                ,defaultValue = 1250 # 50 kHz
+                ,name ="PID_1_f"
+                ,description = "current source control loop frequency (Hz)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(62500000 / x)
+                    ,userToReg = lambda x : (62500000 / x)))) 
+
+addReg(Register(0x42, "Et"
+                ,regRange = zeroTo(2047)
+                ,defaultValue = 2344
+                ,name ="LIMITS: \n temp_limit"
+                ,description = "Temperature limit MOSFETs (deg C)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float(x - 1940/3.85333)
+                    ,userToReg = lambda x : (x*3.85333)+1940))) 
+
+addReg(Register(0xC, "Il"
+                ,regRange = zeroTo(0xFFF)
+                ,defaultValue = 3276
+                ,name ="OC_lim_i"
+                ,description = "Over-current (input) protection (A)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float((x - 2048)) * 40.95994
+                    ,userToReg = lambda x : (x * 40.95994) + 2048)))
+
+addReg(Register(0x7, "Ia"
+                ,defaultValue = 4000
+                ,regRange = zeroTo(0xFFF)
+                ,name = "OC_lim_o"
+                ,description = "Over-current (output) protection (A)"
+                ,transformation = Transformation(
+                    regToUser = lambda x : float((x - 2048)) * 40.95994
+                    ,userToReg = lambda x : (x * 40.95994) + 2048)))
+
+addReg(Register(0x4,"Vb"
+                ,defaultValue = 0
+                ,regRange = zeroTo(0xFFF)
+                ,name = "Vs_under"
+                ,description = "under-voltage protection threshold (V)"
+                ,transformation = Transformation(
+                    regToUser=lambda x: float(x/128.189)
+                    ,userToReg=lambda x: (x *128*189))))
+
+addReg(Register(0x6,"Vs"
+                ,defaultValue = 2047
+                ,regRange = zeroTo(0xFFF)
+                ,name = "Vs_over"
+                ,description = "over-voltage protection threshold (V)"
+                ,transformation = Transformation(
+                    regToUser=lambda x: float(x/128.189)
+                    ,userToReg=lambda x: (x *128*189))))
+
+addReg(Register(0x24,"Te"
+                ,defaultValue = 1000
+                ,regRange = zeroTo(100000000)
+                ,name = "t_error"
+                ,description = "time before error detection (us)"
+                ,transformation = Transformation(
+                    regToUser=lambda x: float(x/100000)
+                    ,userToReg=lambda x: (x *100000))))
+
+addReg(Register(0x51,"Ms"
+                ,defaultValue = 0
+                ,regRange = zeroTo(8)
+                ,name = "DISPLAYS: \n scope_mode"
+                ,description = "VGA_scope presets(0-8)"))
+
+addReg(Register(0x14,"St"
+                ,defaultValue = 0
+                ,regRange = between(-2048, 2048)
+                ,name = "scp_thresh"
+                ,description = "Threshold for VGA-oscilloscope"))
+
+addReg(Register(0xEF,"D"
+                ,defaultValue = 11
+                ,regRange = zeroTo(15)
+                ,name = "disp_set"
+                ,description = "data switch for 7-segment display"))
+
+def findRegister(key):
+    """
+    Look a register up by its identification ("Sd"), its name ("Id_setpoint") or its id
+    """
+    for register in registers.values():
+        if key in (register.identification, register.name.split()[-1], register.reg_id):
+            return register
+    raise KeyError("Unknown register {0}".format(key))
+
+def lookupRegister(key):
+    """
+    Register by id, or by anything findRegister accepts
+    """
+    if key in registers:
+        return registers[key]
+    return findRegister(key)
+
+
+class RegisterCache:
+    """
+    Shadow of the values the controller holds, keyed by reg_id (None while unknown).
+
+    Values are staged from a profile, which is validated as a whole before anything is
+    sent: unknown or read-only registers and register values outside regRange raise a
+    ValueError listing every problem. flush() then writes only the registers whose staged
+    value differs from the shadow, back-to-back as one batch. Readback (RegisterPoller)
+    refreshes the shadow from the controller.
+    """
+    def __init__(self, registers=registers):
+        self.registers = registers
+        self.values = {reg_id: None for reg_id in registers}
+        self.confirmed = {}
+        self.staged = {}
+
+    def __getitem__(self, key):
+        return self.values[lookupRegister(key).reg_id]
+
+    def resolve(self, profile, units='user'):
+        """
+        Validate a profile {register key: value} and return [(register, register value)].
+        units is 'user' for values as entered in the GUI or 'register' for raw values.
+        """
+        resolved = []
+        problems = []
+        for key, value in profile.items():
+            try:
+                register = lookupRegister(key)
+            except KeyError:
+                problems.append("unknown register {0}".format(key))
+                continue
+            if not register.isWritable():
+                problems.append("{0} is not writable".format(register.identification))
+                continue
+            try:
+                regValue = register.toRegister(value) if units == 'user' else int(value)
+            except (ValueError, TypeError, ZeroDivisionError):
+                problems.append("{0}: invalid value {1!r}".format(register.identification, value))
+                continue
+            if not register.inRange(regValue):
+                problems.append("{0}: register value {1} out of range".format(register.identification, regValue))
+                continue
+            resolved.append((register, regValue))
+        if problems:
+            raise ValueError("Invalid profile: " + "; ".join(problems))
+        return resolved
+
+    def stage(self, profile, units='user'):
+        resolved = self.resolve(profile, units)
+        for register, regValue in resolved:
+            self.staged[register.reg_id] = regValue
+        return resolved
+
+    def dirty(self):
+        """
+        Staged (register, register value) pairs that differ from the shadow, in register order
+        """
+        return [(register, self.staged[reg_id]) for reg_id, register in self.registers.items()
+                if reg_id in self.staged and self.values[reg_id] != self.staged[reg_id]]
+
+    def flush(self, send, force=False):
+        """
+        Send the dirty registers (all staged ones with force) as one batch through
+        send(list of command strings) and update the shadow. Returns the written pairs.
+        """
+        if force:
+            changes = [(self.registers[reg_id], regValue) for reg_id, regValue in self.staged.items()]
+        else:
+            changes = self.dirty()
+        self.staged = {}
+        if changes:
+            send([register.writeCommand(regValue) for register, regValue in changes])
+            for register, regValue in changes:
+                self.values[register.reg_id] = regValue
+        return changes
+
+    def apply(self, profile, send, units='user', force=False):
+        """
+        Validate, stage and flush a profile in one go
+        """
+        self.stage(profile, units)
+        return self.flush(send, force)
+
+    def restoreDefaults(self):
+        """
+        The controller was told to restore its defaults
+        """
+        for reg_id, register in self.registers.items():
+            self.values[reg_id] = register.default_value
+        self.staged = {}
+
+    def invalidate(self):
+        for reg_id in self.values:
+            self.values[reg_id] = None
+
+    def update(self, identification, regValue):
+        """
+        A readback of the controller
+        """
+        register = lookupRegister(identification)
+        self.values[register.reg_id] = regValue
+        self.confirmed[register.reg_id] = time.time()
+
+    def profile(self):
+        """
+        The known register values as {identification: register value}
+        """
+        return {register.identification: self.values[reg_id]
+                for reg_id, register in self.registers.items() if self.values[reg_id] is not None}
+
+
+def saveProfile(path, cache):
+    with open(path, "w") as handle:
+        json.dump({"units": "register", "values": cache.profile()}, handle, indent=1)
+
+
+def loadProfile(path):
+    """
+    Returns (values, units) of a profile file; a plain {register: value} mapping holds
+    user values
+    """
+    with open(path) as handle:
+        content = json.load(handle)
+    if "values" in content:
+        return content["values"], content.get("units", "user")
+    return content, "user"
+
+
+def parseReadback(line):
+    """
+    (identification, register value) of a readback line, None for any other line
+    """
+    match = READBACK.match(line)
+    if match is None:
+        return None
+    return match.group(1).decode('ASCII'), int(match.group(2))
+
+
+def readbackAcknowledge(line, command):
+    """
+    Acknowledge predicate for CommandQueue: matches readback lines to read commands
+    """
+    payload = command.payload.strip()
+    if not payload.endswith(READ_SUFFIX.encode()):
+        return False
+    parsed = parseReadback(line)
+    return parsed is not None and parsed[0].encode() == payload[:-len(READ_SUFFIX)]
+
+
+class RegisterPoller:
+    """
+    Reads the readable registers back into a RegisterCache, `batch` registers every
+    `interval` seconds round-robin, so the readback adds a few short lines to the link
+    and never a burst. The command queue has to acknowledge with readbackAcknowledge.
+    writeBatch(payloads, expectResponse) is the one of a ThreadMessage or producer.
+    """
+    def __init__(self, cache, writeBatch, interval=1.0, batch=4, timeout=0.5):
+        self.cache = cache
+        self.writeBatch = writeBatch
+        self.interval = interval
+        self.batch = batch
+        self.timeout = timeout
+        self.halt = Event()
+        self.thread = None
+        self.next = 0
+        self.misses = 0
+
+    def readable(self):
+        return [register for register in self.cache.registers.values() if register.isReadable()]
+
+    def poll(self):
+        """
+        Read the next batch of registers, returns the number of answers
+        """
+        readable = self.readable()
+        if not readable:
+            return 0
+        chosen = [readable[(self.next + index) % len(readable)] for index in range(min(self.batch, len(readable)))]
+        self.next = (self.next + len(chosen)) % len(readable)
+        commands = self.writeBatch([register.readCommand().encode() for register in chosen], True)
+        if not commands:
+            return 0
+        answered = 0
+        deadline = time.perf_counter() + self.timeout
+        for command in commands:
+            response = command.wait(max(0.0, deadline - time.perf_counter()))
+            parsed = None if response is None else parseReadback(response)
+            if parsed is None:
+                self.misses += 1
+                continue
+            self.cache.update(*parsed)
+            answered += 1
+        return answered
+
+    def run(self):
+        while not self.halt.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='registerPoller', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.halt.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated single-producer/single-consumer ring of rows.
+
+    The producer only moves write_cursor, the consumer only moves read_cursor. Both are
+    monotonically increasing row counts, a row with cursor c lives at c % capacity. The
+    producer publishes the cursor after the rows are in place, so no lock is needed as
+    long as there is one thread on either side.
+    """
+    def __init__(self, capacity, columns, dtype=np.float64):
+        self.capacity = capacity
+        self.columns = columns
+        self.buffer = np.zeros((capacity, columns), dtype=dtype)
+        self.write_cursor = 0
+        self.read_cursor = 0
+        self.overruns = 0
+
+    def push_row(self, row):
+        """
+        Push a single row, prefer push_rows for more than one.
+        """
+        self.buffer[self.write_cursor % self.capacity, :] = row
+        self.write_cursor += 1
+
+    def push_rows(self, block):
+        """
+        Push a (rows, columns) block with at most two slice copies.
+        """
+        count = block.shape[0]
+        cursor = self.write_cursor
+        if count > self.capacity:
+            # only the newest rows survive anyway
+            cursor += count - self.capacity
+            block = block[-self.capacity:]
+            count = self.capacity
+        start = cursor % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first, :] = block[:first]
+        self.buffer[:count - first, :] = block[first:]
+        self.write_cursor = cursor + count
+
+    def available(self):
+        """
+        Number of rows written since the last read_new.
+        """
+        return self.write_cursor - self.read_cursor
+
+    def latest(self, n, cursor=None):
+        """
+        Return the newest n rows, oldest first, optionally ending at an earlier write cursor.
+        This is a view into the ring unless the rows wrap around its end, then it is a copy.
+        A view stays valid until the producer has written capacity - n further rows.
+        """
+        if cursor is None:
+            cursor = self.write_cursor
+        n = min(n, self.capacity)
+        end = cursor % self.capacity
+        if end == 0:
+            end = self.capacity if cursor else 0
+        if n <= end:
+            return self.buffer[end - n:end]
+        return np.concatenate((self.buffer[self.capacity - (n - end):], self.buffer[:end]))
+
+    def read_new(self, limit=None):
+        """
+        Return a copy of everything written since the previous call and advance read_cursor.
+        Rows the producer has overwritten before they were read are counted in overruns.
+        """
+        write_cursor = self.write_cursor
+        start = self.read_cursor
+        if write_cursor - start > self.capacity:
+            self.overruns += write_cursor - self.capacity - start
+            start = write_cursor - self.capacity
+        if limit is not None:
+            write_cursor = min(write_cursor, start + limit)
+        rows = self.copy(start, write_cursor)
+
+        # rows that were overwritten while copying cannot be trusted
+        lapped = min(self.write_cursor - self.capacity - start, rows.shape[0])
+        if lapped > 0:
+            self.overruns += lapped
+            rows = rows[lapped:]
+        self.read_cursor = write_cursor
+        return rows
+
+    def copy(self, start, end):
+        """
+        Copy the rows with cursors in [start, end).
+        """
+        first = start % self.capacity
+        count = end - start
+        if first + count <= self.capacity:
+            return self.buffer[first:first + count].copy()
+        return np.concatenate((self.buffer[first:], self.buffer[:count - (self.capacity - first)]))
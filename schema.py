@@ -0,0 +1,125 @@
+import numpy as np
+
+from parsing import ROW_LENGTH
+from transforms import ChannelTable, ChannelTransform, IDENTITY
+
+
+class Column:
+    """
+    One declared column of a row: the name it is referred to by, its index in the row, the
+    native type of the raw readings, the unit and the register-to-user transformation.
+    A `mask` column holds bit flags: it is never saturated, only cut to its width.
+    """
+    def __init__(self, name, index, dtype='int16', unit="", transform=None, mask=False):
+        self.name = name
+        self.index = index
+        self.dtype = np.dtype(dtype)
+        self.unit = unit
+        self.transform = ChannelTransform.wrap(transform)
+        self.mask = mask
+
+
+class ChannelSchema:
+    """
+    Named, typed layout of the `width` columns of a row; undeclared columns are raw
+    readings of type `default`, wide enough for whatever the device sends there.
+
+    Rows are stored with the smallest type that holds every column (`dtype`, e.g. int16
+    when all columns are int16, int32 for int16 and uint16 columns) instead of float64;
+    fit() saturates readings that do not fit their column and counts them; the bits of mask
+    columns are kept, a flag word that arrived sign-extended (0x8001 as -32767) is only cut
+    to the width of the column. The conversion to user units is
+    left to the consumers: `table` converts whole blocks in one go when they ask for it.
+    Names are resolved with index(), once when a figure or display is set up.
+    """
+    def __init__(self, columns, width, default='int32'):
+        self.columns = sorted(columns, key=lambda column: column.index)
+        self.width = width
+        self.by_name = {}
+        dtypes = [np.dtype(default)] * width
+        for column in self.columns:
+            if column.name in self.by_name:
+                raise ValueError("Double definition of column {0}".format(column.name))
+            if not 0 <= column.index < width:
+                raise ValueError("Column {0}: index {1} outside of the {2} columns".format(column.name, column.index, width))
+            self.by_name[column.name] = column
+            dtypes[column.index] = column.dtype
+        self.dtypes = dtypes
+        self.dtype = np.result_type(*dtypes)
+        self.minimum = np.array([np.iinfo(dtype).min if dtype.kind in 'iu' else -np.inf for dtype in dtypes],
+                                dtype=np.float64)
+        self.maximum = np.array([np.iinfo(dtype).max if dtype.kind in 'iu' else np.inf for dtype in dtypes],
+                                dtype=np.float64)
+        self.masks = np.array([column.index for column in self.columns if column.mask], dtype=np.intp)
+        self.bits = np.array([(1 << 8 * column.dtype.itemsize) - 1 for column in self.columns if column.mask],
+                             dtype=np.int64)
+        self.minimum[self.masks] = -np.inf
+        self.maximum[self.masks] = np.inf
+        self.table = ChannelTable(width, {column.index: column.transform for column in self.columns
+                                          if column.transform is not IDENTITY})
+
+    def index(self, name):
+        try:
+            return self.by_name[name].index
+        except KeyError:
+            raise KeyError("No column {0!r}, one of {1}".format(name, ", ".join(self.by_name)))
+
+    def layout(self):
+        """
+        {index: name} of the declared columns
+        """
+        return {column.index: column.name for column in self.columns}
+
+    def units(self):
+        return {column.name: column.unit for column in self.columns}
+
+    def fit(self, block):
+        """
+        (block, clipped): the raw block saturated to the range of every column, ready to be
+        stored as `dtype`, and the number of values clipped per column. When nothing had to
+        be clipped the block itself is returned with clipped None. Mask columns are cut to
+        their width and never count as clipped.
+        """
+        if self.masks.size:
+            flags = block[:, self.masks]
+            if (flags < 0).any() or (flags > self.bits).any():
+                block = block.copy()
+                block[:, self.masks] = flags.astype(np.int64) & self.bits
+        low = block < self.minimum
+        high = block > self.maximum
+        if not (low.any() or high.any()):
+            return block, None
+        return np.clip(block, self.minimum, self.maximum), np.count_nonzero(low | high, axis=0)
+
+    def name(self, index):
+        """
+        Name of a column, "column N" for undeclared ones
+        """
+        for column in self.columns:
+            if column.index == index:
+                return column.name
+        return "column {0}".format(index)
+
+    def fields(self):
+        """
+        Little endian type codes of the columns in a binary frame, see framing.FrameLayout:
+        16 bit columns as declared, the others as int16
+        """
+        return [dtype.newbyteorder('<').str if dtype.itemsize == 2 else '<i2' for dtype in self.dtypes]
+
+
+# Shared channel transformations, channels in the table are converted for all columns at once
+VOLTAGE = ChannelTransform.affine(scale=1/128.189)
+CURRENT = ChannelTransform.affine(scale=1/40.95, offset=2048)
+TEMPERATURE = ChannelTransform.affine(scale=1/3.853, offset=1940)
+ERRORS = ChannelTransform.expression(np.int64)
+# The columns of a row: ADC readings are 12 bit, thrust and rpm signed (the Sr setpoint
+# spans -30000..30000), the error flags a 16 bit mask; the other columns are kept as int32
+ROW_SCHEMA = ChannelSchema([
+    Column("voltage", 0, 'uint16', "V", VOLTAGE),
+    Column("current", 1, 'uint16', "A", CURRENT),
+    Column("thrust", 2, 'int16', "g"),
+    Column("rpm", 3, 'int16', "1/min"),
+    Column("temperature", 4, 'uint16', "degrees Celsius", TEMPERATURE),
+    Column("errors", 14, 'uint16', mask=True),
+], ROW_LENGTH)
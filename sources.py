@@ -0,0 +1,287 @@
+import os
+import time
+import tty
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from framing import FrameLayout
+from parsing import ROW_LENGTH
+from recording import openCapture
+
+
+def sine(amplitude, frequency, offset=0.0):
+    return lambda t, rng: offset + amplitude * np.sin(2 * np.pi * frequency * t)
+
+def noise(sigma, offset=0.0):
+    return lambda t, rng: offset + rng.normal(0.0, sigma, t.shape)
+
+def step(low, high, period):
+    return lambda t, rng: np.where((t % period) < period / 2, low, high)
+
+def constant(value):
+    return lambda t, rng: np.full(t.shape, value, dtype=np.float64)
+
+# roughly what the controller sends: voltage, current, thrust, rpm, temperature, ..., errors
+DEFAULT_PATTERNS = {
+    0: noise(4, 1538),
+    1: sine(200, 2, 2048),
+    2: step(200, 900, 4),
+    3: sine(8000, 0.25, 12000),
+    4: noise(2, 2100),
+    14: constant(0),
+}
+
+
+def encodeRows(rows, protocol='csv', layout=None, sequence=0):
+    """
+    Encode a block of rows in the wire format of the controller.
+    """
+    if protocol == 'binary':
+        return (layout if layout is not None else FrameLayout()).encode(rows, sequence)
+    rows = np.asarray(rows, dtype=np.int64)
+    line = ",".join(["%d"] * rows.shape[1]) + "\r\n"
+    # one format operation for the whole block
+    return ((line * rows.shape[0]) % tuple(rows.ravel().tolist())).encode('ASCII')
+
+
+class SyntheticSource:
+    """
+    Generates rows from per-column patterns (sine, noise, step, constant; the remaining
+    columns are zero) at `rate` rows per second. A fraction `malformed` of the rows is
+    damaged on the wire: CSV lines are cut short, binary frames get a flipped byte.
+    With rate=None rows are produced as fast as they are read, `burst` rows at a time.
+    """
+    def __init__(self, rate=150.0, columns=ROW_LENGTH, patterns=None, malformed=0.0,
+                 protocol='csv', layout=None, burst=1000, seed=0):
+        self.rate = rate
+        self.columns = columns
+        self.patterns = DEFAULT_PATTERNS if patterns is None else patterns
+        self.malformed = malformed
+        self.protocol = protocol
+        self.layout = layout
+        self.burst = burst
+        self.rng = np.random.default_rng(seed)
+        self.produced = 0
+
+    def rows(self, count):
+        """
+        The next `count` rows as an int64 block.
+        """
+        t = (self.produced + np.arange(count)) / (self.rate or 150.0)
+        block = np.zeros((count, self.columns))
+        for column, pattern in self.patterns.items():
+            block[:, column] = pattern(t, self.rng)
+        self.produced += count
+        return np.rint(block).astype(np.int64)
+
+    def due(self, elapsed):
+        if self.rate is None:
+            return self.burst
+        return max(0, int(elapsed * self.rate) - self.produced)
+
+    def bytesUntil(self, elapsed):
+        """
+        Wire bytes of all rows due `elapsed` seconds after the start.
+        """
+        count = self.due(elapsed)
+        if count == 0:
+            return b""
+        sequence = self.produced
+        data = encodeRows(self.rows(count), self.protocol, self.layout, sequence)
+        if self.malformed:
+            data = self.damage(data, count)
+        return data
+
+    def damage(self, data, count):
+        broken = self.rng.random(count) < self.malformed
+        if not broken.any():
+            return data
+        if self.protocol == 'binary':
+            size = (self.layout if self.layout is not None else FrameLayout()).size
+            raw = bytearray(data)
+            for index in np.flatnonzero(broken):
+                raw[index * size + size // 2] ^= 0xFF
+            return bytes(raw)
+        lines = data.split(b"\r\n")
+        for index in np.flatnonzero(broken):
+            lines[index] = lines[index][:len(lines[index]) // 2]
+        return b"\r\n".join(lines)
+
+
+class ReplaySource:
+    """
+    Plays back a capture file with its recorded timing, `speed` times faster than real time
+    (speed=None plays it back as fast as it is read).
+    """
+    def __init__(self, path, speed=1.0, protocol='csv', layout=None, burst=1000):
+        self.metadata, self.records = openCapture(path)
+        self.speed = speed
+        self.protocol = protocol
+        self.layout = layout
+        self.burst = burst
+        # recordings keep the derived channels behind the raw columns, they are derived anew
+        self.columns = self.metadata.get('raw_columns', self.metadata['columns'])
+        times = self.records['time']
+        self.offsets = times - times[0] if len(times) else times
+        self.produced = 0
+
+    def bytesUntil(self, elapsed):
+        if self.speed is None:
+            end = min(len(self.records), self.produced + self.burst)
+        else:
+            end = int(np.searchsorted(self.offsets, elapsed * self.speed, side='right'))
+        if end <= self.produced:
+            return b""
+        rows = np.rint(self.records['data'][self.produced:end, :self.columns])
+        data = encodeRows(rows, self.protocol, self.layout, self.produced)
+        self.produced = end
+        return data
+
+    def finished(self):
+        return self.produced >= len(self.records)
+
+
+class SourcePort:
+    """
+    Serial-port look-alike (read, readline, in_waiting, write, flush, close) on top of a
+    synthetic or replay source, so the acquisition pipeline runs without hardware and
+    without the 115200 baud limit. Written commands are kept in `written`.
+    """
+    def __init__(self, source, timeout=1):
+        self.source = source
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.written = []
+        self.start = time.perf_counter()
+        self.is_open = True
+
+    def fill(self):
+        self.buffer += self.source.bytesUntil(time.perf_counter() - self.start)
+
+    @property
+    def in_waiting(self):
+        self.fill()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        deadline = time.perf_counter() + (self.timeout if self.timeout is not None else 1e9)
+        self.fill()
+        while not self.buffer and time.perf_counter() < deadline:
+            time.sleep(0.001)
+            self.fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self):
+        deadline = time.perf_counter() + (self.timeout if self.timeout is not None else 1e9)
+        self.fill()
+        while b"\n" not in self.buffer and time.perf_counter() < deadline:
+            time.sleep(0.001)
+            self.fill()
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        return self.read(end) if end else b""
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def openSource(url, timeout=1):
+    """
+    Open a source URL as a SourcePort:
+        synthetic://?rate=1000&malformed=0.01&protocol=binary   (rate=0 means unlimited)
+        replay:///path/to/capture.cap?speed=10                   (speed=0 means unlimited)
+    """
+    return SourcePort(createSource(url), timeout=timeout)
+
+
+def createSource(url):
+    """
+    The SyntheticSource or ReplaySource of a source URL, see openSource
+    """
+    parsed = urlparse(url)
+    options = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+    protocol = options.get('protocol', 'csv')
+    if parsed.scheme == 'synthetic':
+        rate = float(options.get('rate', 150))
+        source = SyntheticSource(rate=rate or None, malformed=float(options.get('malformed', 0)),
+                                 protocol=protocol, seed=int(options.get('seed', 0)))
+    elif parsed.scheme == 'replay':
+        speed = float(options.get('speed', 1))
+        source = ReplaySource(parsed.netloc + parsed.path, speed=speed or None, protocol=protocol)
+    else:
+        raise ValueError("Unknown source {0}".format(url))
+    return source
+
+
+# a source URL behind this prefix is fed through a pseudo terminal and read like a serial device
+PTY_PREFIX = "pty+"
+
+def isSourceUrl(port):
+    return isinstance(port, str) and port.startswith(("synthetic://", "replay://"))
+
+
+def isPtyUrl(port):
+    return isinstance(port, str) and port.startswith(PTY_PREFIX) and isSourceUrl(port[len(PTY_PREFIX):])
+
+
+def openPtyPair():
+    """
+    Returns (master_fd, slave_fd, slave_path) of a raw pseudo terminal pair. The acquisition
+    opens slave_path like a real serial device while a feeder writes into master_fd; the
+    slave_fd is held open until the feeder stops, so the pty does not hang up in between.
+    """
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def feedPty(source, master, halt, interval=0.005):
+    """
+    Write a source into the master side of a pty pair until halt() returns True.
+    Runs in its own thread, see startPtyFeeder. The master is written without blocking and
+    the source is only asked for more once everything before is written, so a slow reader
+    holds back an unlimited source instead of the feeder.
+    """
+    os.set_blocking(master, False)
+    start = time.perf_counter()
+    data = b""
+    while not halt():
+        if not data:
+            data = source.bytesUntil(time.perf_counter() - start)
+        try:
+            while data:
+                data = data[os.write(master, data):]
+        except BlockingIOError:
+            pass
+        time.sleep(interval)
+
+
+def startPtyFeeder(source):
+    """
+    Create a pty pair fed by `source` in a daemon thread, returns (slave_path, stop).
+    stop() ends the thread and closes both sides of the pair.
+    """
+    master, slave, path = openPtyPair()
+    stopped = []
+    thread = Thread(target=feedPty, args=(source, master, lambda: bool(stopped)), name='ptyFeeder', daemon=True)
+    thread.start()
+
+    def stop():
+        if stopped:
+            return
+        stopped.append(True)
+        thread.join()
+        os.close(slave)
+        os.close(master)
+    return path, stop
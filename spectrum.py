@@ -0,0 +1,94 @@
+import numpy as np
+from scipy.signal import get_window
+
+from ringbuffer import RingBuffer
+
+
+class WelchPSD:
+    """
+    Running Welch power spectral density of several channels.
+
+    feed() takes the rows that arrived since the previous call. Every `segment` rows with an
+    overlap of `overlap` form a segment; all segments that are complete are cut from the
+    pending rows as strided views, detrended, windowed into a preallocated buffer and
+    transformed in one rfft call over all segments and channels. Their power is averaged in
+    place: a plain mean over the first `average` segments, then exponentially with weight
+    1 / average, so the estimate follows changes of the spectrum.
+
+    At most `limit` segments are transformed per call, the oldest of a larger backlog are
+    skipped, so the cost of a frame stays bounded however long the GUI was stalled.
+    With waterfall=N the newest N spectra (in dB) are kept in a RingBuffer.
+    """
+    def __init__(self, channels=1, segment=256, overlap=0.5, fs=150.0, window='hann', average=16,
+                 limit=8, waterfall=0):
+        self.channels = channels
+        self.segment = segment
+        self.step = max(1, int(round(segment * (1 - overlap))))
+        self.fs = fs
+        self.average = average
+        self.limit = limit
+        self.window = get_window(window, segment)
+        # density scaling of scipy.signal.welch, one-sided
+        self.scale = np.full(segment // 2 + 1, 2.0 / (fs * np.sum(self.window ** 2)))
+        self.scale[0] /= 2
+        if segment % 2 == 0:
+            self.scale[-1] /= 2
+        self.frequencies = np.fft.rfftfreq(segment, 1.0 / fs)
+        self.buffer = np.empty((limit, segment, channels))
+        self.pending = np.empty((0, channels))
+        self.psd = np.zeros((self.frequencies.size, channels))
+        self.segments = 0
+        self.waterfall = RingBuffer(waterfall, self.frequencies.size * channels) if waterfall else None
+
+    def reset(self):
+        """
+        Drop the pending rows, e.g. after a gap in the data; the average is kept
+        """
+        self.pending = np.empty((0, self.channels))
+
+    def feed(self, rows):
+        """
+        Add (rows, channels) new rows, returns the number of segments transformed
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.channels)
+        pending = np.concatenate((self.pending, rows)) if self.pending.shape[0] else rows
+        count = (pending.shape[0] - self.segment) // self.step + 1 if pending.shape[0] >= self.segment else 0
+        if count == 0:
+            self.pending = pending
+            return 0
+        consumed = (count - 1) * self.step + self.segment
+        skipped = max(0, count - self.limit)
+        count -= skipped
+        # (segments, channels, segment) views into the pending rows, no copy
+        views = np.lib.stride_tricks.sliding_window_view(pending[:consumed], self.segment, axis=0)[skipped * self.step::self.step]
+        work = self.buffer[:count]
+        np.copyto(work, views.transpose(0, 2, 1))
+        work -= work.mean(axis=1, keepdims=True)
+        work *= self.window[:, np.newaxis]
+        spectra = np.fft.rfft(work, axis=1)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        power *= self.scale[:, np.newaxis]
+        for index in range(count):
+            self.segments += 1
+            weight = 1.0 / min(self.segments, self.average)
+            # psd += weight * (power - psd), in place
+            self.psd *= 1 - weight
+            self.psd += weight * power[index]
+            if self.waterfall is not None:
+                self.waterfall.push_row(10 * np.log10(power[index].T.ravel() + 1e-20))
+        self.pending = pending[consumed - self.segment + self.step:].copy()
+        return count
+
+    def decibels(self):
+        """
+        The averaged density in dB, (frequencies, channels)
+        """
+        return 10 * np.log10(self.psd + 1e-20)
+
+    def spectrogram(self, channel=0):
+        """
+        The waterfall of one channel as (spectra, frequencies) in dB, oldest first
+        """
+        bins = self.frequencies.size
+        count = min(self.waterfall.write_cursor, self.waterfall.capacity)
+        return self.waterfall.latest(count)[:, channel * bins:(channel + 1) * bins]
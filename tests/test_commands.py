@@ -0,0 +1,28 @@
+from commands import CommandQueue, CommandWriter, echoAcknowledge
+
+
+class AnsweringPort:
+    """
+    Target that acknowledges a command before write() returns
+    """
+    def __init__(self, commandQueue):
+        self.commandQueue = commandQueue
+        self.answered = []
+
+    def write(self, data):
+        self.answered.append(self.commandQueue.handleResponse(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def test_a_response_during_the_write_is_matched():
+    commands = CommandQueue(acknowledge=echoAcknowledge)
+    command = commands.put(b"R 12\n", expectResponse=True)
+    port = AnsweringPort(commands)
+    CommandWriter(commands).send(port, commands.drain(0))
+    assert port.answered == [command]
+    assert command.wait(0) == b"R 12\n"
+    assert command.sent is not None
+    assert not commands.pending
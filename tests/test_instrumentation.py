@@ -0,0 +1,26 @@
+from commands import CommandQueue, CommandWriter
+from instrumentation import Metrics, metrics, scoped
+
+
+class NullPort:
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def test_scoped_reads_the_metrics_of_one_device():
+    registry = Metrics()
+    registry.gauge('rig1.sample_rate', lambda: 150.0)
+    registry.gauge('rig2.sample_rate', lambda: 1000.0)
+    registry.count('rig2.bytes_read', 64)
+    values, _ = scoped(registry.snapshot(), 'rig2.')
+    assert values == {'sample_rate': 1000.0, 'bytes_read': 64}
+
+
+def test_command_latency_is_named_per_device():
+    commands = CommandQueue(prefix='rig2.')
+    commands.put(b"R\n")
+    CommandWriter(commands).send(NullPort(), commands.drain(0))
+    assert metrics.histograms['rig2.command_latency'].count == 1
@@ -0,0 +1,40 @@
+import logging
+
+import numpy as np
+
+from framing import FrameLayout
+from pipeline import ThreadMessage, SerialCommandConsumer, error_columns, schema
+from trigger import Trigger
+
+
+def consumeFrames(rows, layout):
+    threadMessage = ThreadMessage()
+    consumer = SerialCommandConsumer(protocol='binary', layout=layout)
+    consumer.consume(layout.encode(rows), threadMessage)
+    return threadMessage.data
+
+
+def test_error_flags_survive_the_binary_path(caplog):
+    errors = error_columns[0]
+    rows = np.zeros((4, schema.width))
+    rows[:, errors] = 0x8001
+    for layout in (FrameLayout(), FrameLayout(['<i2'] * schema.width)):
+        with caplog.at_level(logging.WARNING):
+            data = consumeFrames(rows, layout)
+        assert (data.ring.latest(4)[:, errors] == 0x8001).all()
+        assert data.stats.latched[list(data.stats.errors).index(errors)] == 0x8001
+        for bit in (0x0001, 0x8000):
+            assert Trigger(errors, 'mask', mask=bit).matches(data.ring.latest(4)).all()
+        assert data.clipped.sum() == 0
+    assert "clipped" not in caplog.text
+
+
+def test_out_of_range_readings_are_clipped_and_counted():
+    rows = np.zeros((2, schema.width))
+    rows[:, schema.index("voltage")] = 70000
+    rows[:, schema.index("rpm")] = -1500
+    fitted, clipped = schema.fit(rows)
+    assert (fitted[:, schema.index("voltage")] == 65535).all()
+    assert (fitted[:, schema.index("rpm")] == -1500).all()
+    assert clipped[schema.index("voltage")] == 2
+    assert clipped.sum() == 2
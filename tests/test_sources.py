@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+
+from acquisition import openSerial
+from parsing import RowParser, ROW_LENGTH
+
+
+def openDescriptors():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_pty_source_is_read_like_a_serial_device():
+    before = openDescriptors()
+    connection = openSerial("pty+synthetic://?rate=1000", timeout=0.05)
+    parser = RowParser(columns=ROW_LENGTH)
+    rows = np.empty((0, ROW_LENGTH))
+    for _ in range(200):
+        rows = np.vstack((rows, parser.feed(connection.read(4096))))
+        if rows.shape[0] >= 50:
+            break
+    connection.close()
+    assert rows.shape[0] >= 50
+    assert parser.rejected == 0
+    assert openDescriptors() == before
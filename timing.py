@@ -0,0 +1,124 @@
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+
+class SampleClock:
+    """
+    Sample clock of a device reconstructed from the host times its blocks were read at
+    (time.monotonic() right after the read), the rows themselves carry no time.
+
+    rate() is the measured sample rate, rows per second over the reads of the last `window`
+    seconds, jitter() the standard deviation of the read times around the straight line
+    through them. stamp() gives every row of a block a time: the newest row gets the read
+    time, the others one period apart before it, squeezed in after the previous row when
+    the block came early, so the times never go back.
+
+    Gaps are counted when the parser reports lost frames (the sequence numbers of the
+    binary protocol, missing_rows) and when nothing arrived for `stall` seconds; rejected
+    rows are counted apart. check() compares the measured rate with the nominal `fs` the
+    filters and spectra are designed for, a deviation beyond `tolerance` is logged as soon
+    as `window` / 2 seconds were measured.
+    """
+    def __init__(self, fs=150.0, window=5.0, stall=0.5, tolerance=0.05, name=""):
+        self.fs = fs
+        self.window = window
+        self.stall = stall
+        self.tolerance = tolerance
+        self.name = name
+        self.points = deque()
+        self.rows = 0
+        self.previous = None
+        # wall clock time of monotonic time 0, for recordings
+        self.epoch = time.time() - time.monotonic()
+        self.gaps = 0
+        self.stalls = 0
+        self.missing_rows = 0
+        self.rejected_rows = 0
+        self.deviation = None
+
+    def rate(self):
+        """
+        Measured rows per second, the nominal fs until two reads are known
+        """
+        if len(self.points) < 2:
+            return self.fs
+        first, before = self.points[0]
+        last, after = self.points[-1]
+        if last <= first or after == before:
+            return self.fs
+        return (after - before) / (last - first)
+
+    def jitter(self):
+        """
+        Standard deviation of the read times around the measured clock in seconds
+        """
+        if len(self.points) < 3:
+            return 0.0
+        stamps, rows = np.array(self.points).T
+        fit = np.polyfit(rows, stamps - stamps[0], 1)
+        return float(np.std(stamps - stamps[0] - np.polyval(fit, rows)))
+
+    def stamp(self, count, stamp=None):
+        """
+        Times of the `count` rows of a block read at `stamp`
+        """
+        if stamp is None:
+            stamp = time.monotonic()
+        if count == 0:
+            return np.empty(0)
+        period = 1.0 / self.rate()
+        if self.previous is not None and stamp - self.previous > self.stall:
+            self.stalls += 1
+            self.gaps += 1
+        start = stamp - period * (count - 1)
+        if self.previous is not None and start <= self.previous:
+            times = self.previous + (stamp - self.previous) * np.arange(1, count + 1) / count
+        else:
+            times = start + period * np.arange(count)
+        self.rows += count
+        self.previous = stamp
+        self.points.append((stamp, self.rows))
+        while len(self.points) > 2 and self.points[0][0] < stamp - self.window:
+            self.points.popleft()
+        self.validate()
+        return times
+
+    def flag(self, lost=0, rejected=0):
+        """
+        Rows the parser lost (sequence gaps) or rejected since the previous call
+        """
+        if lost:
+            self.gaps += 1
+            self.missing_rows += lost
+        self.rejected_rows += rejected
+
+    def check(self):
+        """
+        None while the measured rate matches fs (or is not measured long enough), a
+        message otherwise
+        """
+        if len(self.points) < 2 or self.points[-1][0] - self.points[0][0] < self.window / 2:
+            return None
+        rate = self.rate()
+        if abs(rate - self.fs) <= self.tolerance * self.fs:
+            return None
+        return "{0}measured sample rate {1:.1f} Hz, the filters and spectra assume {2:.1f} Hz".format(
+            self.name, rate, self.fs)
+
+    def validate(self):
+        deviation = self.check()
+        if (deviation is None) != (self.deviation is None):
+            if deviation is not None:
+                logging.warning(deviation)
+            else:
+                logging.info("{0}sample rate back at {1:.1f} Hz".format(self.name, self.rate()))
+        self.deviation = deviation
+
+    def wall(self, times):
+        """
+        Monotonic times as seconds since the epoch
+        """
+        return times + self.epoch
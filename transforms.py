@@ -0,0 +1,177 @@
+import numpy as np
+
+
+class ChannelTransform:
+    """
+    Register-to-user transformation of a channel that works on whole columns.
+
+    Transformations are declared as affine, (x - offset) * scale, as reciprocal,
+    numerator / x, or as any expression that accepts NumPy arrays. Plain scalar functions
+    (the lambdas used so far) are still accepted and are applied through np.vectorize.
+    Scalars go in and come out as scalars, arrays as arrays.
+    """
+    AFFINE, RECIPROCAL, EXPRESSION, SCALAR = range(4)
+
+    def __init__(self, kind, scale=1.0, offset=0.0, numerator=1.0, fn=None):
+        self.kind = kind
+        self.scale = scale
+        self.offset = offset
+        self.numerator = numerator
+        self.fn = fn
+        self.vectorized = np.vectorize(fn) if kind == ChannelTransform.SCALAR else None
+
+    @staticmethod
+    def affine(scale=1.0, offset=0.0):
+        return ChannelTransform(ChannelTransform.AFFINE, scale=scale, offset=offset)
+
+    @staticmethod
+    def reciprocal(numerator):
+        return ChannelTransform(ChannelTransform.RECIPROCAL, numerator=numerator)
+
+    @staticmethod
+    def expression(fn):
+        return ChannelTransform(ChannelTransform.EXPRESSION, fn=fn)
+
+    @staticmethod
+    def wrap(fn):
+        """
+        Returns fn itself if it already is a ChannelTransform, the identity for None and a
+        vectorized wrapper for any other callable.
+        """
+        if isinstance(fn, ChannelTransform):
+            return fn
+        if fn is None:
+            return IDENTITY
+        return ChannelTransform(ChannelTransform.SCALAR, fn=fn)
+
+    def __call__(self, values):
+        if self.kind == ChannelTransform.SCALAR:
+            if np.ndim(values) == 0:
+                return self.fn(values)
+            values = np.asarray(values)
+            if values.size == 0:
+                return values.astype(np.float64)
+            return self.vectorized(values)
+        if self.kind == ChannelTransform.EXPRESSION:
+            return self.fn(np.asarray(values) if np.ndim(values) else values)
+        if self.kind == ChannelTransform.RECIPROCAL:
+            with np.errstate(divide='ignore'):
+                return self.numerator / np.asarray(values, dtype=np.float64)
+        return (np.asarray(values, dtype=np.float64) - self.offset) * self.scale
+
+IDENTITY = ChannelTransform.affine()
+# the layout of rows without named channels
+NO_NAMES = {}
+
+
+class ChannelTable:
+    """
+    Transformations of all columns of a row. apply() converts a whole (rows, columns) block;
+    all affine and identity columns in one array operation, reciprocal columns in a second
+    one and only the remaining expressions column by column.
+    """
+    def __init__(self, columns, transforms=None):
+        self.columns = columns
+        self.transforms = [IDENTITY] * columns
+        for column, transform in (transforms or {}).items():
+            self.transforms[column] = ChannelTransform.wrap(transform)
+
+        self.scales = np.ones(columns)
+        self.offsets = np.zeros(columns)
+        reciprocal = []
+        self.others = []
+        for column, transform in enumerate(self.transforms):
+            if transform.kind == ChannelTransform.AFFINE:
+                self.scales[column] = transform.scale
+                self.offsets[column] = transform.offset
+            elif transform.kind == ChannelTransform.RECIPROCAL:
+                reciprocal.append(column)
+            else:
+                self.others.append(column)
+        self.reciprocal = np.array(reciprocal, dtype=np.intp)
+        self.numerators = np.array([self.transforms[column].numerator for column in reciprocal])
+
+    def __getitem__(self, column):
+        return self.transforms[column]
+
+    def apply(self, data):
+        """
+        Returns the block in user units as float64.
+        """
+        units = (data - self.offsets) * self.scales
+        if self.reciprocal.size:
+            with np.errstate(divide='ignore'):
+                units[:, self.reciprocal] = self.numerators / data[:, self.reciprocal]
+        for column in self.others:
+            units[:, column] = self.transforms[column](data[:, column])
+        return units
+
+
+class ChannelBlock:
+    """
+    One block of raw rows together with the transformed columns computed from it.
+    Every (column, transform) pair is computed once, so figures and displays that show the
+    same channel share the result. Columns whose transform is the one of the table are
+    taken from the table conversion of the whole block.
+    Rows may carry derived channels behind the columns of the table; `names` maps channel
+    names to columns, a channel asked for by name is always in user units. Figures and
+    displays resolve their names once with resolve() and ask by column.
+    """
+    def __init__(self, data, table=None, names=None):
+        self.raw = data
+        self.table = table
+        self.names = names if names is not None else NO_NAMES
+        self.units = None
+        self.cache = {}
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    def column(self, column, transform=None):
+        if isinstance(column, str):
+            return self.named(column)
+        transform = ChannelTransform.wrap(transform)
+        if self.table is not None and column < self.table.columns and transform is self.table[column]:
+            if self.units is None:
+                self.units = self.table.apply(self.raw[:, :self.table.columns])
+            return self.units[:, column]
+        key = (column, transform)
+        if key not in self.cache:
+            self.cache[key] = transform(self.raw[:, column])
+        return self.cache[key]
+
+    def value(self, column, transform=None, row=-1):
+        """
+        Transformed value of a single row, the whole column is only converted when it is
+        shared through the table anyway.
+        """
+        if isinstance(column, str):
+            return self.named(column)[row]
+        transform = ChannelTransform.wrap(transform)
+        if self.table is not None and column < self.table.columns and transform is self.table[column]:
+            return self.column(column, transform)[row]
+        return transform(self.raw[row, column])
+
+    def named(self, name):
+        """
+        A channel by name, raw columns converted by the table, derived channels as they are
+        """
+        return self.column(*ChannelBlock.resolve(name, None, self.names, self.table))
+
+    @staticmethod
+    def resolve(column, transform, names, table=None):
+        """
+        (column, transform) of a channel name in rows laid out as `names`: raw columns with
+        the transform of the table, derived channels with none. Columns given by number are
+        returned as they are.
+        """
+        if not isinstance(column, str):
+            return column, ChannelTransform.wrap(transform)
+        try:
+            index = names[column]
+        except KeyError:
+            raise KeyError("No channel {0!r}, one of {1}".format(column, ", ".join(names)))
+        if table is not None and index < table.columns:
+            return index, table[index]
+        return index, IDENTITY
@@ -0,0 +1,255 @@
+import logging
+import os
+import queue
+import time
+from threading import Thread
+
+import numpy as np
+
+from recording import CaptureWriter
+from ringbuffer import RingBuffer
+from transforms import IDENTITY
+
+MODES = ('single', 'normal', 'auto')
+
+
+class Trigger:
+    """
+    Trigger condition on one column, evaluated for a whole block at once:
+
+        rising    the value crosses `level` upwards
+        falling   the value crosses `level` downwards
+        level     the value is at or above `level`
+        mask      any of the bits of `mask` is set in the raw value, e.g. column 14 with
+                  0xffff fires on any error flag
+
+    Levels are compared in the units of `transform`, masks with the raw integers. The
+    column may be a derived channel behind the raw columns, see pipeline.Data.
+    """
+    KINDS = ('rising', 'falling', 'level', 'mask')
+
+    def __init__(self, column, kind='rising', level=0.0, mask=0, transform=IDENTITY):
+        if kind not in Trigger.KINDS:
+            raise ValueError("Unknown trigger {0}, one of {1}".format(kind, ", ".join(Trigger.KINDS)))
+        self.column = column
+        self.kind = kind
+        self.level = level
+        self.mask = mask
+        self.transform = transform
+        self.previous = None
+
+    @staticmethod
+    def parse(definition, table=None, names=None):
+        """
+        Trigger from "COLUMN:KIND:VALUE", e.g. "14:mask:0xffff", "1:rising:5.5" or
+        "power:level:200"; COLUMN is a number or a name of `names` (see pipeline.Data.names),
+        levels are in the units of the table column, derived channels are compared as they are
+        """
+        try:
+            column, kind, value = definition.split(":")
+            if names is not None and column in names:
+                column = names[column]
+            else:
+                column = int(column)
+            if kind == 'mask':
+                return Trigger(column, kind, mask=int(value, 0))
+            transform = table[column] if table is not None and column < table.columns else IDENTITY
+            return Trigger(column, kind, level=float(value), transform=transform)
+        except ValueError as error:
+            raise ValueError("Trigger {0!r} is not COLUMN:KIND:VALUE ({1})".format(definition, error))
+
+    def matches(self, block):
+        """
+        Boolean per row of the block; crossings are also detected against the last row of
+        the previous block
+        """
+        raw = block[:, self.column]
+        if self.kind == 'mask':
+            return (raw.astype(np.int64) & self.mask) != 0
+        values = np.asarray(self.transform(raw), dtype=np.float64)
+        if self.kind == 'level':
+            hits = values >= self.level
+        else:
+            before = np.empty_like(values)
+            before[0] = values[0] if self.previous is None else self.previous
+            before[1:] = values[:-1]
+            if self.kind == 'rising':
+                hits = (before < self.level) & (values >= self.level)
+            else:
+                hits = (before > self.level) & (values <= self.level)
+        self.previous = values[-1]
+        return hits
+
+
+class Capture:
+    """
+    A frozen capture: `rows` raw rows of which row `pre` is the trigger row. forced
+    captures were taken by the auto mode without a trigger. context is the metadata of the
+    TriggeredCapture when it was taken.
+    """
+    def __init__(self, number, rows, pre, cursor, forced, timestamp):
+        self.number = number
+        self.rows = rows
+        self.pre = pre
+        self.cursor = cursor
+        self.forced = forced
+        self.timestamp = timestamp
+        self.context = {}
+
+    def x(self):
+        """
+        Row offsets relative to the trigger row
+        """
+        return np.arange(self.rows.shape[0]) - self.pre
+
+    def metadata(self):
+        return {"trigger": {"number": self.number, "pre": self.pre, "cursor": self.cursor,
+                            "forced": self.forced, "time": self.timestamp}}
+
+
+class TriggeredCapture:
+    """
+    Oscilloscope style capture on the producer side. Every pushed block goes into a ring
+    that holds the pre-trigger history; the trigger is evaluated over the block in one go.
+    A capture of `pre` rows before and `post` rows from the trigger row on is copied out of
+    the ring once the post-trigger rows arrived. Blocks pushed by a Data carry the derived
+    channels, so do the captures.
+
+        single   capture once, then stop until arm() is called
+        normal   re-arm after every capture, capture only on a trigger
+        auto     like normal, but force a capture when no trigger came for `auto` rows
+
+    latest is the newest Capture; while frozen it is kept for inspection and newer
+    captures are only counted and saved. With a prefix every capture is written to its
+    own capture file by a background thread, a full queue drops the capture instead of
+    stalling the acquisition (dropped_captures). `metadata` goes into every capture file,
+    a function returning it is called when the capture is taken, e.g. for the register
+    values at that moment.
+    arm(), freeze() and changes of the mode only set attributes the producer reads, the
+    producer stays the only writer of the ring and of the state.
+    """
+    def __init__(self, trigger, pre=1000, post=1000, mode='normal', auto=None, prefix=None, metadata=None,
+                 queue_size=16):
+        if mode not in MODES:
+            raise ValueError("Unknown trigger mode {0}, one of {1}".format(mode, ", ".join(MODES)))
+        self.trigger = trigger
+        self.pre = pre
+        self.post = post
+        self.mode = mode
+        self.auto = auto if auto is not None else pre + post
+        self.ring = None
+        self.armed = True
+        self.arm_pending = False
+        self.armed_at = 0
+        self.triggered_at = None
+        self.forced = False
+        self.frozen = False
+        self.latest = None
+        self.captures = 0
+        self.prefix = prefix
+        self.metadata = metadata if callable(metadata) else dict(metadata or {})
+        self.queue = queue.Queue(queue_size)
+        self.dropped_captures = 0
+        self.thread = None
+        if prefix is not None:
+            directory = os.path.dirname(prefix)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.thread = Thread(target=self.run, name='captureWriter', daemon=True)
+            self.thread.start()
+
+    def arm(self):
+        """
+        Wait for the next trigger from the next pushed block on, e.g. after a single capture
+        """
+        self.arm_pending = True
+
+    def freeze(self, frozen=True):
+        self.frozen = frozen
+
+    def update(self, block):
+        """
+        Push a raw block and look for the trigger in it, returns the captures completed
+        """
+        count = block.shape[0]
+        if count == 0:
+            return []
+        if self.ring is None:
+            self.ring = RingBuffer(max(4096, 2 * (self.pre + self.post)), block.shape[1])
+        if count > self.ring.capacity // 2:
+            # a capture must still be in the ring when the block that completes it is pushed
+            step = self.ring.capacity // 2
+            return [capture for offset in range(0, count, step) for capture in self.update(block[offset:offset + step])]
+        start = self.ring.write_cursor
+        if self.arm_pending:
+            self.arm_pending = False
+            self.armed = True
+            self.armed_at = start
+            self.triggered_at = None
+        self.ring.push_rows(block)
+        end = self.ring.write_cursor
+        hits = self.trigger.matches(block)
+        completed = []
+        while True:
+            if self.triggered_at is None:
+                if not self.armed:
+                    break
+                offset = max(0, self.armed_at - start)
+                found = np.flatnonzero(hits[offset:])
+                if found.size:
+                    self.triggered_at = start + offset + int(found[0])
+                    self.forced = False
+                elif self.mode == 'auto' and end - self.armed_at >= self.auto:
+                    self.triggered_at = max(self.armed_at, end - 1)
+                    self.forced = True
+                else:
+                    break
+            if end < self.triggered_at + self.post:
+                break
+            completed.append(self.complete())
+        return completed
+
+    def complete(self):
+        """
+        Copy the capture out of the ring and re-arm according to the mode
+        """
+        first = max(0, self.triggered_at - self.pre, self.ring.write_cursor - self.ring.capacity)
+        rows = self.ring.copy(first, self.triggered_at + self.post)
+        self.captures += 1
+        capture = Capture(self.captures, rows, self.triggered_at - first, self.triggered_at, self.forced, time.time())
+        if not self.frozen:
+            self.latest = capture
+        if self.prefix is not None:
+            capture.context = self.metadata() if callable(self.metadata) else self.metadata
+            try:
+                self.queue.put_nowait(capture)
+            except queue.Full:
+                self.dropped_captures += 1
+        self.armed_at = self.triggered_at + self.post
+        self.triggered_at = None
+        if self.mode == 'single':
+            self.armed = False
+        return capture
+
+    def run(self):
+        while True:
+            capture = self.queue.get()
+            if capture is None:
+                break
+            path = "{0}-{1}-{2:04d}.cap".format(self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(capture.timestamp)),
+                                               capture.number)
+            metadata = dict(capture.context)
+            metadata.update(capture.metadata())
+            writer = CaptureWriter(path, capture.rows.shape[1], metadata, initial_rows=capture.rows.shape[0])
+            writer.append(capture.timestamp, capture.rows)
+            writer.close()
+            logging.info("Capture {0} written to {1}".format(capture.number, path))
+
+    def close(self):
+        """
+        Write the queued captures and stop the writer
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None